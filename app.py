@@ -1,9 +1,19 @@
-from controllers.app_controller import chunk_document, chunk_document_semantically, chunk_document_with_layout, query_ai_model, retrieve_and_query_ai_model
-from fastapi import FastAPI
-from models.app_models import DocumentProcessRequest, QueryRequest
-from services.chroma_db_service import connect_to_chroma_db, disconnect_chroma_db, get_document_count
+from controllers.app_controller import chunk_document, chunk_document_semantically, chunk_document_small_to_big, chunk_document_with_layout, chunk_documents_in_batch, purge_stores, query_ai_model, restore_stores, retrieve_and_query_ai_model, snapshot_stores, stream_ai_model, stream_retrieval_and_ai_model
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from models.app_models import BatchProcessRequest, DocumentProcessRequest, PurgeRequest, QueryRequest, SnapshotRequest
+from services.collection_pool import create_collection_pool
+from services.embedding_service import get_embedding_model, warm_up_embedding_model
+from services.job_queue import create_job_queue
+from services.pdf_parsing import shutdown_pdf_parse_pool
 from services.query_service import connect_to_google_ai
-from utils.logger import log
+from services.reranking import connect_to_reranker
+from services.response_cache import get_response_cache
+from services.vector_store_lifecycle import list_snapshots
+from utils.logger import correlation_id, log
+from utils.metrics import METRICS_ENABLED, REQUEST_SECONDS, render_metrics
+import time
+import uuid
 
 async def lifespan(app: FastAPI):
     """
@@ -11,16 +21,45 @@ async def lifespan(app: FastAPI):
     And before shutting down clean up.
     """
     log.info("Backend server starting up")
-    app.state.chroma_db = connect_to_chroma_db()
+    warm_up_embedding_model()
+    # Collections are checked against their manifest now and opened when they are first used
+    app.state.collection_pool = create_collection_pool()
+    app.state.collection_pool.check_collections()
     app.state.google_ai = connect_to_google_ai()
+    app.state.reranker = connect_to_reranker()
+    app.state.job_queue = create_job_queue()
     yield
     # Anything after yeild is for teardown / cleanup
+    log.warning("Waiting for running jobs to finish")
+    app.state.job_queue.shutdown()
+    shutdown_pdf_parse_pool()
     log.warning("Disconnecting from chroma DB")
-    disconnect_chroma_db(app.state.chroma_db )
+    app.state.collection_pool.close_all()
     log.warning("Backend server shutting down")
 
 app = FastAPI(title="Study Buddy", lifespan=lifespan)
 
+@app.middleware("http")
+async def track_request(request: Request, call_next):
+    """
+    Tags the request with a correlation ID, from the X-Request-ID header or a new one, and times it. \n
+    The ID is in every log line written while handling the request and is sent back in the X-Request-ID header.
+    """
+    request_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex
+    token = correlation_id.set(request_id)
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        response.headers["X-Request-ID"] = request_id
+        return response
+    finally:
+        # The route template rather than the path, so IDs in the path do not each become a time series
+        route = request.scope.get("route")
+        REQUEST_SECONDS.observe(time.perf_counter() - start, request.method, route.path if route else "unmatched", str(status))
+        correlation_id.reset(token)
+
 @app.get("/")
 async def root() -> dict:
     """
@@ -28,41 +67,140 @@ async def root() -> dict:
     """
     return {"message": "Running"}
 
-@app.post("/chunk/pdf")
+@app.post("/chunk/pdf", status_code=202)
 async def chunk_pdf_document(process_request: DocumentProcessRequest) -> dict:
     """
-    Takes in a PDF document locally and chunks it.
+    Queues a job that takes in a PDF document locally and chunks it.
     """
-    chunk_document(process_request, app.state.chroma_db)
-    get_document_count(app.state.chroma_db)
-    return {"message": "Document has been chunked"}
+    job = app.state.job_queue.submit("chunk/pdf", chunk_document, process_request, app.state.collection_pool)
+    return job.to_dict()
 
-@app.post("/chunk/pdf/semantic")
+@app.post("/chunk/pdf/semantic", status_code=202)
 async def chunk_pdf_document_semantically(process_request: DocumentProcessRequest) -> dict:
     """
-    Takes in a PDF document locally and chunks it.
+    Queues a job that takes in a PDF document locally and chunks it.
     """
-    chunk_document_semantically(process_request, app.state.chroma_db)
-    return {"message": "Document has been chunked"}
+    job = app.state.job_queue.submit("chunk/pdf/semantic", chunk_document_semantically, process_request, app.state.collection_pool)
+    return job.to_dict()
 
-@app.post("/chunk/pdf/layout")
+@app.post("/chunk/pdf/layout", status_code=202)
 async def chunk_pdf_document_with_layout(process_request: DocumentProcessRequest) -> dict:
     """
-    Takes in a PDF document locally and chunks it using layout-aware chunking.
+    Queues a job that takes in a PDF document locally and chunks it using layout-aware chunking.
+    """
+    job = app.state.job_queue.submit("chunk/pdf/layout", chunk_document_with_layout, process_request, app.state.collection_pool)
+    return job.to_dict()
+
+@app.post("/chunk/pdf/small-to-big", status_code=202)
+async def chunk_pdf_document_small_to_big(process_request: DocumentProcessRequest) -> dict:
+    """
+    Queues a job that takes in a PDF document locally and chunks it into layout sections with small child chunks.
+    """
+    job = app.state.job_queue.submit("chunk/pdf/small-to-big", chunk_document_small_to_big, process_request, app.state.collection_pool)
+    return job.to_dict()
+
+@app.post("/chunk/batch", status_code=202)
+async def chunk_pdf_documents_in_batch(batch_request: BatchProcessRequest) -> dict:
+    """
+    Queues a job that chunks a list of local PDF documents, or the ones matching a glob, with one chunking strategy.
+    """
+    job = app.state.job_queue.submit("chunk/batch", chunk_documents_in_batch, batch_request, app.state.collection_pool)
+    return job.to_dict()
+
+@app.get("/jobs/{job_id}")
+async def get_job_status(job_id: str) -> dict:
+    """
+    Returns the status, stage, progress and timings of a job.
+    """
+    job = app.state.job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+@app.get("/cache/stats")
+async def get_cache_stats() -> dict:
+    """
+    Returns the hit and miss counters of the response and embedding caches.
     """
-    chunk_document_with_layout(process_request, app.state.chroma_db)
-    return {"message": "Document has been chunked"}
+    response_cache = get_response_cache()
+    embedding_model = get_embedding_model()
+    return {
+        "responses": response_cache.stats() if response_cache else None,
+        "embeddings": embedding_model.stats() if hasattr(embedding_model, "stats") else None,
+    }
 
 @app.post("/ask")
 async def query_ai_modell(request: QueryRequest) -> dict:
     """
     Queries the AI model with no retrieval.
     """
-    return query_ai_model(request, app.state.google_ai) 
+    return await query_ai_model(request, app.state.google_ai)
 
 @app.post("/rag/ask")
 async def rag_query_ai_model(request: QueryRequest) -> dict:
     """
-    Retrieves and queries the model.
+    Retrieves from the requested collection and queries the model.
+    """
+    async with app.state.collection_pool.open_async(request.collection) as collection:
+        return await retrieve_and_query_ai_model(request, app.state.google_ai, collection.chroma_db, app.state.reranker)
+
+@app.post("/ask/stream")
+async def stream_query_ai_model(request: QueryRequest) -> StreamingResponse:
+    """
+    Queries the AI model with no retrieval and streams the answer as server-sent events.
+    """
+    return StreamingResponse(await stream_ai_model(request, app.state.google_ai), media_type="text/event-stream")
+
+@app.post("/rag/ask/stream")
+async def stream_rag_query_ai_model(request: QueryRequest) -> StreamingResponse:
+    """
+    Retrieves from the requested collection and queries the model, streaming the answer as server-sent events.
+    """
+    # Retrieval is done by the time the events are returned, so the collection does not have to stay open while they stream
+    async with app.state.collection_pool.open_async(request.collection) as collection:
+        events = await stream_retrieval_and_ai_model(request, app.state.google_ai, collection.chroma_db, app.state.reranker)
+    return StreamingResponse(events, media_type="text/event-stream")
+
+@app.get("/collections")
+def get_collections() -> dict:
+    """
+    Returns the stored collections and the ones that are open.
+    """
+    return {"collections": app.state.collection_pool.list_collections(), "open": app.state.collection_pool.get_open_collections()}
+
+@app.post("/admin/snapshots")
+def create_store_snapshot(snapshot_request: SnapshotRequest = SnapshotRequest()) -> dict:
+    """
+    Snapshots the vector store, the ingestion manifests and the BM25 indexes. Fails with 409 while ingestion jobs are running.
+    """
+    return snapshot_stores(app.state, snapshot_request.name)
+
+@app.get("/admin/snapshots")
+def get_store_snapshots() -> list:
+    """
+    Lists the snapshots, the newest first.
+    """
+    return list_snapshots()
+
+@app.post("/admin/snapshots/{name}/restore")
+def restore_store_snapshot(name: str) -> dict:
+    """
+    Replaces the vector store, the ingestion manifests and the BM25 indexes with a snapshot.
+    """
+    return restore_stores(app.state, name)
+
+@app.post("/admin/purge")
+def purge_vector_store(purge_request: PurgeRequest = PurgeRequest()) -> dict:
+    """
+    Deletes every chunk stored in a collection and forgets every document ingested into it.
+    """
+    return purge_stores(purge_request, app.state)
+
+@app.get("/metrics")
+async def get_metrics() -> PlainTextResponse:
+    """
+    Returns the latency histograms and counters in the Prometheus text format.
     """
-    return retrieve_and_query_ai_model(request, app.state.google_ai, app.state.chroma_db)
+    if not METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Metrics are disabled")
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,117 @@
+"""
+Golden-output check and throughput benchmark of clean_text.
+
+First checks that clean_text, with both ASCII filters, gives byte-identical results to the previous six-pass
+implementation on hand-picked edge cases and on randomized text built from the characters the patterns care about.
+Then reports the throughput of each implementation in MB/s on synthetic PDF page text.
+Exits with a non-zero status if any output differs.
+
+Run from the project root:
+    python -m benchmarks.bench_clean_text --pages 2000 --fuzz 20000
+"""
+import argparse
+import random
+import re
+from services.pdf_parsing import clean_text
+import sys
+import time
+
+GOLDEN_CASES = [
+    "",
+    "   ",
+    "plain text",
+    "<p>Hello</p>world",
+    "see http://example.com/a?b=c for details",
+    "www.example.com. next",
+    "http://a<b>c",
+    "http://a<><b>c",
+    "http://a<no close",
+    "<a <b> text",
+    "<<a>b>",
+    "[1] [23] [] [x] [1a]",
+    "[12www.example.com]",
+    "[http://x]",
+    "http\t",
+    "www.",
+    "a \u00e9 b",
+    "− x",
+    "x\u2212\u00e9\u2212y",
+    "a\x00 b\x7f c\x1c d",
+    "line\none\r\n\ttwo three　four",
+    "caf\u00e9 na\u00efve \u2014 \u201cquoted\u201d",
+    "<b>http://x.org</b>[3]\u2212\u2212",
+]
+
+ALPHABET = ["<", ">", "a", "b", "http", "www.", "[", "]", "1", "2", " ", "\n", "\t", " ", "\u2212", "\u00e9",
+            "\x00", "\x7f", "\x1c", "\x1f", "\x0b", "\x85", "\u2028", ".", "/", ":", "\u3000", "\u201c"]
+
+WORDS = ["matrix", "eigenvalue", "gradient", "descent", "probability", "the", "of", "and", "is", "a", "to",
+         "[12]", "http://example.com/paper.pdf", "www.example.org", "<b>", "</b>", "\u2212", "na\u00efve", "\u2014"]
+
+def legacy_clean_text(text: str) -> str:
+    """
+    clean_text as it was before the patterns were precompiled and the passes cut down.
+    """
+    text = re.sub(r"<[^>]+>", " ", text)
+    text = re.sub(r"http\S+|www\.\S+", "", text)
+    text = re.sub(r"\[[0-9]*\]", "", text)
+    text = re.sub(r"\s+", " ", text)
+    text = text.replace("\u2212", "-")
+    text = re.sub(r"[^\x20-\x7E]", "", text)
+    return text.strip()
+
+def check_golden_output(fuzz_cases: int, rng: random.Random) -> int:
+    cases = GOLDEN_CASES + ["".join(rng.choice(ALPHABET) for _ in range(rng.randint(0, 40))) for _ in range(fuzz_cases)]
+
+    mismatches = 0
+    for case in cases:
+        expected = legacy_clean_text(case)
+        for ascii_filter in ("regex", "translate"):
+            actual = clean_text(case, ascii_filter=ascii_filter)
+            if actual != expected:
+                mismatches += 1
+                if mismatches <= 10:
+                    print(f"MISMATCH ({ascii_filter}) for {case!r}: expected {expected!r}, got {actual!r}")
+
+    print(f"Golden output: {len(cases)} cases, {mismatches} mismatches")
+    return mismatches
+
+def make_pages(count: int, rng: random.Random) -> list:
+    """
+    Builds page text of roughly the size PyPDF extracts from a dense page, about 3KB.
+    """
+    return ["\n".join(" ".join(rng.choice(WORDS) for _ in range(12)) for _ in range(45)) for _ in range(count)]
+
+def measure(name: str, clean, pages: list, megabytes: float, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for page in pages:
+            clean(page)
+        best = min(best, time.perf_counter() - start)
+    print(f"{name:>19} | {best:>8.3f} | {megabytes / best:>8.1f}")
+    return best
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Check and benchmark clean_text")
+    parser.add_argument("--pages", type=int, default=2000, help="Synthetic pages to clean per run")
+    parser.add_argument("--fuzz", type=int, default=20000, help="Randomized golden-output cases")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per implementation, the fastest is reported")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    if check_golden_output(args.fuzz, rng):
+        sys.exit(1)
+
+    pages = make_pages(args.pages, rng)
+    megabytes = sum(len(page.encode("utf-8")) for page in pages) / 1e6
+    print(f"\n{args.pages} pages, {megabytes:.1f} MB")
+    print(f"{'implementation':>19} | {'seconds':>8} | {'MB/s':>8}")
+
+    legacy = measure("six passes", legacy_clean_text, pages, megabytes, args.repeat)
+    fused = measure("compiled, regex", lambda page: clean_text(page, ascii_filter="regex"), pages, megabytes, args.repeat)
+    translated = measure("compiled, translate", lambda page: clean_text(page, ascii_filter="translate"), pages, megabytes, args.repeat)
+    print(f"\nSpeedup: regex filter {legacy / fused:.2f}x, translate filter {legacy / translated:.2f}x")
+
+if __name__ == "__main__":
+    main()
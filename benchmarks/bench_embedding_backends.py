@@ -0,0 +1,100 @@
+"""
+Accuracy and throughput benchmark of the embedding backends.
+
+Embeds the same synthetic chunks and queries with the PyTorch fp32 reference and with every other backend, reporting
+texts embedded per second and the cosine drift from the reference: the mean and worst cosine similarity between the two
+vectors of each text, and the share of every query's top 10 nearest chunks that the backend agrees on.
+
+Uses HUGGINGFACE_EMBEDDING_MODEL unless --model is given. The ONNX backends need sentence-transformers[onnx],
+the first run exports the model into ./data/onnx_models.
+
+Run from the project root:
+    python -m benchmarks.bench_embedding_backends --backends onnx onnx-int8 --texts 1000 --threads 4
+"""
+import argparse
+import numpy as np
+import random
+from services.embedding_service import ENV_HUGGINGFACE_EMBEDDING_MODEL, load_embedding_model
+import time
+from utils.utils import get_envvar
+
+WORDS = ["matrix", "eigenvalue", "gradient", "descent", "probability", "variance", "the", "of", "and", "is",
+         "a", "to", "in", "that", "lemma", "proof", "theorem", "equation", "photosynthesis", "enzyme", "market",
+         "inflation", "recursion", "pointer", "entropy", "voltage", "protein", "integral", "vector", "basis"]
+
+def make_texts(count: int, min_words: int, max_words: int, rng: random.Random) -> list:
+    """
+    Builds texts of mixed lengths, so padding and truncation behave as they do on real chunks.
+    """
+    return [" ".join(rng.choice(WORDS) for _ in range(rng.randint(min_words, max_words))) for _ in range(count)]
+
+def embed(embeddings, texts: list, repeat: int) -> tuple:
+    """
+    Returns the normalized vectors of the texts and the best texts per second over the runs.
+    """
+    # The first call pays for lazy initialisation and thread pool set up
+    embeddings.embed_documents(texts[:8])
+
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        vectors = np.asarray(embeddings.embed_documents(texts), dtype=np.float32)
+        best = min(best, time.perf_counter() - start)
+
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors, len(texts) / best
+
+def top_k_agreement(reference_queries: np.ndarray, reference_chunks: np.ndarray, queries: np.ndarray, chunks: np.ndarray,
+                    k: int = 10) -> float:
+    """
+    Returns the mean share of each query's k nearest chunks under the reference that the backend also ranks in its k nearest.
+    """
+    reference_top_k = np.argsort(-(reference_queries @ reference_chunks.T), axis=1)[:, :k]
+    top_k = np.argsort(-(queries @ chunks.T), axis=1)[:, :k]
+    return float(np.mean([len(set(expected) & set(actual)) / k for expected, actual in zip(reference_top_k, top_k)]))
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the embedding backends against PyTorch fp32")
+    parser.add_argument("--model", help="Embedding model, HUGGINGFACE_EMBEDDING_MODEL by default")
+    parser.add_argument("--backends", nargs="+", default=["onnx", "onnx-int8"], help="Backends to compare with torch")
+    parser.add_argument("--quantization", default="avx2", help="Instruction set the int8 model is quantized for")
+    parser.add_argument("--texts", type=int, default=1000, help="Chunks to embed")
+    parser.add_argument("--queries", type=int, default=100, help="Queries to embed for the top 10 agreement")
+    parser.add_argument("--threads", type=int, default=0, help="Threads per encode, 0 for the library default")
+    parser.add_argument("--max-seq-length", type=int, default=0, help="Longest text in tokens, 0 for the model's limit")
+    parser.add_argument("--batch-size", type=int, default=32, help="Texts per batch")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per backend, the fastest is reported")
+    args = parser.parse_args()
+
+    model_name = args.model or get_envvar(ENV_HUGGINGFACE_EMBEDDING_MODEL)
+    rng = random.Random(0)
+    chunks = make_texts(args.texts, 20, 300, rng)
+    queries = make_texts(args.queries, 4, 16, rng)
+    settings = {"quantization": args.quantization, "threads": args.threads, "max_seq_length": args.max_seq_length,
+                "batch_size": args.batch_size}
+
+    print(f"{model_name}, {args.texts} chunks of 20 to 300 words, {args.queries} queries\n")
+    print(f"{'backend':>9} | {'load (s)':>8} | {'texts/s':>8} | {'speedup':>7} | {'mean cos':>8} | {'min cos':>8} | {'top 10':>6}")
+
+    reference = None
+    for backend in ["torch", *args.backends]:
+        start = time.perf_counter()
+        embeddings = load_embedding_model(model_name, backend=backend, **settings)
+        load_seconds = time.perf_counter() - start
+
+        chunk_vectors, texts_per_second = embed(embeddings, chunks, args.repeat)
+        query_vectors, _ = embed(embeddings, queries, 1)
+
+        if reference is None:
+            reference = (chunk_vectors, query_vectors, texts_per_second)
+            print(f"{backend:>9} | {load_seconds:>8.1f} | {texts_per_second:>8.1f} | {1.0:>6.2f}x | {1.0:>8.4f} | {1.0:>8.4f} | {1.0:>6.3f}")
+            continue
+
+        reference_chunks, reference_queries, reference_texts_per_second = reference
+        cosines = np.sum(chunk_vectors * reference_chunks, axis=1)
+        agreement = top_k_agreement(reference_queries, reference_chunks, query_vectors, chunk_vectors)
+        print(f"{backend:>9} | {load_seconds:>8.1f} | {texts_per_second:>8.1f} | {texts_per_second / reference_texts_per_second:>6.2f}x | "
+              f"{cosines.mean():>8.4f} | {cosines.min():>8.4f} | {agreement:>6.3f}")
+
+if __name__ == "__main__":
+    main()
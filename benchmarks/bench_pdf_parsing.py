@@ -0,0 +1,81 @@
+"""
+Benchmark of parsing PDFs in parallel page ranges against parsing them page by page in one process.
+
+Generates text-heavy PDFs of 100 and 1000 pages, reads them with iter_pdf_pages (PyPDF) and
+iter_pdf_pages_as_markdown (PyMuPDF4LLM) once with PDF_PARSE_WORKERS=1 and once per worker count,
+and checks the parallel runs produce exactly the same pages.
+The process pool is started before timing, as it is in the server after the first large PDF.
+
+Run from the project root:
+    python -m benchmarks.bench_pdf_parsing --pages 100 1000 --workers 2 4 8
+"""
+import argparse
+import os
+from pathlib import Path
+import pymupdf
+import random
+from services.document_chunking import iter_pdf_pages, iter_pdf_pages_as_markdown
+from services.pdf_parsing import ENV_PDF_PARSE_WORKERS, get_pdf_parse_pool, shutdown_pdf_parse_pool
+import tempfile
+import time
+
+WORDS = ["matrix", "eigenvalue", "gradient", "descent", "probability", "variance", "the", "of", "and", "is",
+         "a", "to", "in", "that", "lemma", "proof", "theorem", "equation", "[12]", "http://example.com/x"]
+
+def make_pdf(document_path: Path, pages: int, rng: random.Random) -> None:
+    """
+    Writes a PDF with a bold title and a few paragraphs of text on every page.
+    """
+    document = pymupdf.open()
+    for page_number in range(pages):
+        page = document.new_page()
+        page.insert_text((72, 72), f"{page_number + 1} Section {page_number + 1}", fontname="hebo", fontsize=14)
+        text = "\n".join(" ".join(rng.choice(WORDS) for _ in range(12)) for _ in range(45))
+        page.insert_textbox(pymupdf.Rect(72, 90, 540, 760), text, fontsize=9)
+    document.save(document_path)
+    document.close()
+
+def time_reader(read_pages, document_path: Path, workers: int) -> tuple:
+    os.environ[ENV_PDF_PARSE_WORKERS] = str(workers)
+    shutdown_pdf_parse_pool()
+    if workers > 1:
+        get_pdf_parse_pool()
+        # Make sure every process has started and imported the parsing module
+        list(read_pages(str(document_path)))
+
+    start = time.perf_counter()
+    pages = [(page.page_content, page.metadata) for page in read_pages(str(document_path))]
+    return time.perf_counter() - start, pages
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark parallel PDF parsing")
+    parser.add_argument("--pages", type=int, nargs="+", default=[100, 1000], help="Pages per generated PDF")
+    parser.add_argument("--workers", type=int, nargs="+", default=[2, 4, 8], help="Parsing processes to compare")
+    parser.add_argument("--skip-markdown", action="store_true", help="Only benchmark the PyPDF reader")
+    args = parser.parse_args()
+
+    readers = [("pypdf", iter_pdf_pages)]
+    if not args.skip_markdown:
+        readers.append(("markdown", iter_pdf_pages_as_markdown))
+
+    rng = random.Random(0)
+    print(f"{'reader':>9} | {'pages':>6} | {'workers':>7} | {'seconds':>8} | {'pages/s':>8} | {'speedup':>7} | same pages")
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for pages in args.pages:
+            document_path = Path(temp_dir) / f"bench_{pages}.pdf"
+            make_pdf(document_path, pages, rng)
+
+            for name, read_pages in readers:
+                serial_seconds, serial_pages = time_reader(read_pages, document_path, 1)
+                print(f"{name:>9} | {pages:>6} | {1:>7} | {serial_seconds:>8.2f} | {pages / serial_seconds:>8.1f} | {1.0:>6.2f}x | -")
+
+                for workers in args.workers:
+                    seconds, parallel_pages = time_reader(read_pages, document_path, workers)
+                    print(f"{name:>9} | {pages:>6} | {workers:>7} | {seconds:>8.2f} | {pages / seconds:>8.1f} | "
+                          f"{serial_seconds / seconds:>6.2f}x | {parallel_pages == serial_pages}")
+
+    shutdown_pdf_parse_pool()
+
+if __name__ == "__main__":
+    main()
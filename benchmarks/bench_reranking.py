@@ -0,0 +1,66 @@
+"""
+Latency and throughput benchmark of the re-ranking backends.
+
+Reranks 20, 50 and 100 synthetic candidate passages with the local cross-encoder and, when COHERE_API_KEY is set,
+with Cohere, reporting the median latency per call and the number of candidates scored per second.
+
+Run from the project root:
+    python -m benchmarks.bench_reranking --candidates 20 50 100 --repeat 5
+"""
+import argparse
+import os
+import random
+from services.reranking import CohereReranker, CrossEncoderReranker, connect_to_cohere_reranker
+import statistics
+import time
+
+TOPICS = ["eigenvalues", "gradient descent", "binary search trees", "photosynthesis", "supply and demand",
+          "thermodynamics", "recursion", "the French revolution", "hash tables", "cell division"]
+
+def make_candidates(count: int, words_per_passage: int, rng: random.Random) -> list:
+    """
+    Builds candidate passages of roughly the length of a native chunk.
+    """
+    vocabulary = " ".join(TOPICS).split() + ["the", "is", "of", "a", "and", "to", "in", "that", "for", "with"]
+    return [" ".join(rng.choice(vocabulary) for _ in range(words_per_passage)) for _ in range(count)]
+
+def benchmark_backend(name: str, reranker, query: str, candidate_counts: list, repeat: int, rng: random.Random) -> None:
+    for count in candidate_counts:
+        candidates = make_candidates(count, 90, rng)
+
+        # The first call pays for lazy initialisation and connection set up
+        reranker.rerank(query, candidates)
+
+        latencies = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            reranker.rerank(query, candidates)
+            latencies.append(time.perf_counter() - start)
+
+        median = statistics.median(latencies)
+        print(f"{name:>14} | {count:>10} | {median * 1000:>12.1f} | {count / median:>14.1f}")
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the re-ranking backends")
+    parser.add_argument("--candidates", type=int, nargs="+", default=[20, 50, 100], help="Number of candidates per call")
+    parser.add_argument("--repeat", type=int, default=5, help="Timed calls per candidate count")
+    parser.add_argument("--model", default="cross-encoder/ms-marco-MiniLM-L-6-v2", help="Cross-encoder model")
+    parser.add_argument("--batch-size", type=int, default=32, help="Cross-encoder batch size")
+    parser.add_argument("--max-length", type=int, default=512, help="Cross-encoder truncation length in tokens")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    query = "How do you find the eigenvalues of a matrix?"
+
+    print(f"{'backend':>14} | {'candidates':>10} | {'median (ms)':>12} | {'candidates/s':>14}")
+
+    cross_encoder = CrossEncoderReranker(args.model, args.batch_size, args.max_length, max(args.candidates))
+    benchmark_backend("cross-encoder", cross_encoder, query, args.candidates, args.repeat, rng)
+
+    if os.getenv("COHERE_API_KEY"):
+        benchmark_backend("cohere", CohereReranker(connect_to_cohere_reranker()), query, args.candidates, args.repeat, rng)
+    else:
+        print("COHERE_API_KEY is not set, skipping the cohere backend")
+
+if __name__ == "__main__":
+    main()
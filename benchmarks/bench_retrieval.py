@@ -0,0 +1,144 @@
+"""
+Retrieval quality and latency benchmark for tuning the vector index and k.
+
+Loads a corpus of chunks and a labelled question set, builds one chroma DB collection per combination of
+distance metric, M and ef_construction, and for every ef_search, retrieval mode (dense or hybrid) and k reports
+recall@k, MRR and the p50/p95 latency of a query. The corpus is embedded once and the vectors reused for every build.
+
+The corpus is a JSONL file of {"id": ..., "text": ...} chunks and the questions a JSONL file of
+{"question": ..., "relevant_ids": [...]}. Without them a synthetic corpus is generated, which only says
+something about latency and the lexical side of hybrid retrieval.
+Uses the embedding model set by HUGGINGFACE_EMBEDDING_MODEL. Every question is asked once before timing,
+so the timed queries hit the embedding cache and mostly measure the search itself.
+
+Run from the project root:
+    python -m benchmarks.bench_retrieval --corpus chunks.jsonl --questions questions.jsonl --k 5 10 20 --ef-search 10 50 100
+"""
+import argparse
+import itertools
+import json
+import random
+from services import bm25_index
+from services.bm25_index import get_bm25_index
+from services.chroma_db_service import DEFAULT_MAX_DISTANCES, batched_retrieve, connect_to_chroma_db
+from services.embedding_service import get_embedding_model
+import statistics
+import tempfile
+import time
+
+TOPICS = ["eigenvalues", "gradient", "recursion", "photosynthesis", "inflation", "entropy", "hashing", "mitosis",
+          "derivative", "covalent", "topology", "sorting", "voltage", "allele", "monopoly", "integral"]
+FILLER = ["the", "is", "of", "a", "and", "to", "in", "that", "for", "with", "which", "can", "be", "used", "when"]
+
+def load_jsonl(path: str) -> list:
+    with open(path, "r", encoding="utf-8") as jsonl_file:
+        return [json.loads(line) for line in jsonl_file if line.strip()]
+
+def make_synthetic_corpus(chunks: int, questions: int, rng: random.Random) -> tuple:
+    """
+    Builds chunks of about 90 words around two topics and a made-up term, and questions that reuse a few of their words.
+    """
+    corpus = []
+    for number in range(chunks):
+        words = rng.sample(TOPICS, 2) + [f"term{number}"] + [rng.choice(FILLER) for _ in range(87)]
+        rng.shuffle(words)
+        corpus.append({"id": f"chunk-{number}", "text": " ".join(words)})
+
+    labelled_questions = []
+    for chunk in rng.sample(corpus, min(questions, chunks)):
+        words = chunk["text"].split()
+        keywords = [word for word in words if word not in FILLER]
+        labelled_questions.append({
+            "question": "What does it say about " + " ".join(keywords + rng.sample(words, 3)) + "?",
+            "relevant_ids": [chunk["id"]],
+        })
+    return corpus, labelled_questions
+
+def build_collection(persist_directory: str, collection_name: str, hnsw_configuration: dict, corpus: list,
+                     embeddings: list):
+    """
+    Creates a collection with the HNSW settings and writes the pre-computed vectors and the BM25 index.
+    """
+    chroma_db = connect_to_chroma_db(collection_name, persist_directory, hnsw_configuration)
+    ids = [chunk["id"] for chunk in corpus]
+    texts = [chunk["text"] for chunk in corpus]
+    max_batch_size = chroma_db._client.get_max_batch_size()
+    for start in range(0, len(corpus), max_batch_size):
+        end = start + max_batch_size
+        chroma_db._collection.upsert(ids=ids[start:end], embeddings=embeddings[start:end], documents=texts[start:end])
+    get_bm25_index(collection_name).add(ids, texts)
+    return chroma_db
+
+def evaluate(chroma_db, questions: list, k: int, hybrid: bool, max_distance: float, repeat: int) -> tuple:
+    """
+    Returns recall@k and MRR over the questions and the p50 and p95 query latency in milliseconds.
+    """
+    recalls = []
+    reciprocal_ranks = []
+    latencies = []
+    for question in questions:
+        relevant_ids = set(question["relevant_ids"])
+        retrieved = batched_retrieve([question["question"]], chroma_db, k, max_distance, hybrid)
+        retrieved_ids = [document.id for document, _ in retrieved[:k]]
+
+        recalls.append(len(relevant_ids.intersection(retrieved_ids)) / len(relevant_ids))
+        first_relevant = next((rank for rank, doc_id in enumerate(retrieved_ids, start=1) if doc_id in relevant_ids), None)
+        reciprocal_ranks.append(1 / first_relevant if first_relevant else 0.0)
+
+        for _ in range(repeat):
+            start = time.perf_counter()
+            batched_retrieve([question["question"]], chroma_db, k, max_distance, hybrid)
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    percentiles = statistics.quantiles(latencies, n=20, method="inclusive")
+    return statistics.mean(recalls), statistics.mean(reciprocal_ranks), percentiles[9], percentiles[18]
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark retrieval quality and latency")
+    parser.add_argument("--corpus", help="JSONL file of {id, text} chunks")
+    parser.add_argument("--questions", help="JSONL file of {question, relevant_ids} labelled questions")
+    parser.add_argument("--synthetic", type=int, default=2000, help="Synthetic chunks to generate without a corpus")
+    parser.add_argument("--space", nargs="+", default=["l2", "cosine"], help="Distance metrics to compare")
+    parser.add_argument("--m", type=int, nargs="+", default=[16], help="HNSW max neighbors (M) to compare")
+    parser.add_argument("--ef-construction", type=int, nargs="+", default=[100], help="HNSW ef_construction to compare")
+    parser.add_argument("--ef-search", type=int, nargs="+", default=[10, 100], help="HNSW ef_search to compare")
+    parser.add_argument("--k", type=int, nargs="+", default=[5, 10, 20], help="Chunks retrieved per query")
+    parser.add_argument("--modes", nargs="+", default=["dense", "hybrid"], choices=["dense", "hybrid"])
+    parser.add_argument("--max-distance", type=float, help="Distance cut-off, the metric's default if not given")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed queries per question")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    if args.corpus and args.questions:
+        corpus, questions = load_jsonl(args.corpus), load_jsonl(args.questions)
+    else:
+        corpus, questions = make_synthetic_corpus(args.synthetic, 200, rng)
+
+    start = time.perf_counter()
+    embeddings = get_embedding_model().embed_documents([chunk["text"] for chunk in corpus])
+    print(f"{len(corpus)} chunks embedded in {time.perf_counter() - start:.1f} seconds, {len(questions)} questions\n")
+
+    print(f"{'space':>6} | {'M':>3} | {'ef_c':>4} | {'ef_s':>4} | {'mode':>6} | {'k':>3} | {'recall@k':>8} | "
+          f"{'MRR':>5} | {'p50 (ms)':>8} | {'p95 (ms)':>8}")
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # Keep the BM25 indexes of the benchmark collections out of the server's data directory
+        bm25_index.BM25_INDEX_DIRECTORY = temp_dir
+
+        for build, (space, max_neighbors, ef_construction) in enumerate(itertools.product(args.space, args.m, args.ef_construction)):
+            hnsw_configuration = {"space": space, "ef_construction": ef_construction, "max_neighbors": max_neighbors,
+                                  "ef_search": args.ef_search[0]}
+            start = time.perf_counter()
+            chroma_db = build_collection(temp_dir, f"bench_retrieval_{build}", hnsw_configuration, corpus, embeddings)
+            print(f"Built {space}, M={max_neighbors}, ef_construction={ef_construction} in {time.perf_counter() - start:.1f} seconds")
+
+            max_distance = args.max_distance if args.max_distance is not None else DEFAULT_MAX_DISTANCES[space]
+            for ef_search in args.ef_search:
+                chroma_db._collection.modify(configuration={"hnsw": {"ef_search": ef_search}})
+                for mode, k in itertools.product(args.modes, args.k):
+                    recall, mrr, p50, p95 = evaluate(chroma_db, questions, k, mode == "hybrid", max_distance, args.repeat)
+                    print(f"{space:>6} | {max_neighbors:>3} | {ef_construction:>4} | {ef_search:>4} | {mode:>6} | {k:>3} | "
+                          f"{recall:>8.3f} | {mrr:>5.3f} | {p50:>8.2f} | {p95:>8.2f}")
+
+if __name__ == "__main__":
+    main()
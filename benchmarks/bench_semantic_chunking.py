@@ -0,0 +1,102 @@
+"""
+Micro-benchmark for the breakpoint detection part of semantic chunking.
+
+Compares the previous implementation (list of dicts, one sklearn cosine_similarity call per adjacent pair)
+with the vectorized NumPy path on random embeddings, so no embedding model is needed.
+
+Run from the project root:
+    python -m benchmarks.bench_semantic_chunking --sizes 1000 10000 100000
+"""
+import argparse
+import numpy as np
+from services.document_chunking import calculate_cosine_distances, combine_sentences, find_breakpoints, group_sentences
+from sklearn.metrics.pairwise import cosine_similarity
+import time
+
+def legacy_semantic_breakpoints(sentences: list, embeddings: list, max_sentences_per_chunk: int = 6) -> list:
+    """
+    The semantic chunking pipeline as it was before vectorization, minus the embedding call.
+    """
+    sentences = [{'sentence': x, 'index': i} for i, x in enumerate(sentences) if x]
+
+    for i in range(len(sentences)):
+        combined_sentence = ''
+        for j in range(i - 1, i):
+            if j >= 0:
+                combined_sentence += sentences[j]['sentence'] + ' '
+        combined_sentence += sentences[i]['sentence']
+        for j in range(i + 1, i + 2):
+            if j < len(sentences):
+                combined_sentence += ' ' + sentences[j]['sentence']
+        sentences[i]['combined_sentence'] = combined_sentence
+
+    for i, sentence in enumerate(sentences):
+        sentence['embedding'] = embeddings[i]
+
+    distances = []
+    for i in range(len(sentences) - 1):
+        similarity = cosine_similarity([sentences[i]['embedding']], [sentences[i + 1]['embedding']])[0][0]
+        distance = 1 - similarity
+        distances.append(distance)
+        sentences[i]['distance_to_next'] = distance
+
+    breakpoint_distance_threshold = np.percentile(distances, 60)
+    indices_above_thresh = [i for i, x in enumerate(distances) if x > breakpoint_distance_threshold]
+
+    start_index = 0
+    chunks = []
+    for index in sorted(list(set(indices_above_thresh))):
+        group = sentences[start_index:index + 1]
+        for j in range(0, len(group), max_sentences_per_chunk):
+            chunks.append(' '.join([d['sentence'] for d in group[j:j + max_sentences_per_chunk]]))
+        start_index = index + 1
+
+    if start_index < len(sentences):
+        remaining_group = sentences[start_index:]
+        for j in range(0, len(remaining_group), max_sentences_per_chunk):
+            chunks.append(' '.join([d['sentence'] for d in remaining_group[j:j + max_sentences_per_chunk]]))
+
+    return chunks
+
+def vectorized_semantic_breakpoints(sentences: list, embeddings: np.ndarray, max_sentences_per_chunk: int = 6) -> list:
+    """
+    The current semantic chunking pipeline, minus the embedding call.
+    """
+    combine_sentences(sentences, buffer_size=1)
+    distances = calculate_cosine_distances(embeddings)
+    breakpoints = find_breakpoints(distances)
+    return group_sentences(sentences, breakpoints, max_sentences_per_chunk)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark semantic chunking breakpoint detection")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000], help="Number of sentences")
+    parser.add_argument("--dim", type=int, default=384, help="Embedding dimension")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per size, the best one is reported")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print(f"{'sentences':>10} | {'legacy (s)':>10} | {'vectorized (s)':>14} | {'speedup':>8} | {'same chunks':>11}")
+
+    for size in args.sizes:
+        sentences = [f"Sentence number {i} about topic {i % 97}." for i in range(size)]
+        embeddings = rng.standard_normal((size, args.dim), dtype=np.float32)
+        embeddings_as_lists = embeddings.tolist()
+
+        legacy_times, vectorized_times = [], []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            legacy_chunks = legacy_semantic_breakpoints(sentences, embeddings_as_lists)
+            legacy_times.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            vectorized_chunks = vectorized_semantic_breakpoints(sentences, embeddings)
+            vectorized_times.append(time.perf_counter() - start)
+
+        # The legacy path works in float64, so a distance sitting exactly on the threshold may flip
+        same_chunks = "yes" if legacy_chunks == vectorized_chunks else "no"
+
+        legacy, vectorized = min(legacy_times), min(vectorized_times)
+        print(f"{size:>10} | {legacy:>10.4f} | {vectorized:>14.4f} | {legacy / vectorized:>7.1f}x | {same_chunks:>11}")
+
+if __name__ == "__main__":
+    main()
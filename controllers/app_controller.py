@@ -1,71 +1,658 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from fastapi import HTTPException
+import glob
+import json
 from langchain_chroma import Chroma
+from langchain_core.messages import AIMessage
 from langchain_google_genai import ChatGoogleGenerativeAI
-from models.app_models import DocumentProcessRequest, QueryRequest
+from models.app_models import BatchProcessRequest, DocumentProcessRequest, PurgeRequest, QueryRequest
+import time
+from typing import AsyncIterator, Awaitable, Callable, Iterable, Iterator
 
-from services.document_chunking import layout_chunking, read_pdf_document, native_chunking, read_pdf_document_into_markdown, semantic_chunking
-from services.chroma_db_service import embed_and_add_document, multi_retrieve
+from services.document_chunking import iter_layout_chunks, iter_native_chunks, iter_pdf_pages, iter_pdf_pages_as_markdown, iter_semantic_chunks, iter_small_to_big_chunks
+from services.context_packing import pack_context
+from services.bm25_index import reset_bm25_indexes
+from services.chroma_db_service import build_where_filter, delete_documents, embed_and_add_document, expand_to_parents, get_document_count, list_collection_names, merge_retrieved_documents, multi_retrieve, purge_chroma_db
+from services.collection_pool import CollectionPool
+from services.ingestion_manifest import IngestionManifest, get_chunk_id, get_document_key, hash_file
+from services.job_queue import Job, report_progress, report_stage
+from services.parent_store import reset_parent_stores
 
 from services.query_service import query_google_ai
-from services.reranking import rerank
-from services.query_service import query_google_ai, query_transformation
+from services.reranking import Reranker
+from services.response_cache import ASK_NAMESPACE, get_response_cache, get_retrieval_namespace, invalidate_retrieval_responses
+from services.vector_store_lifecycle import create_snapshot, restore_snapshot
+from starlette.datastructures import State
+from utils.logger import log
+from utils.metrics import FIRST_TOKEN_SECONDS, STAGE_SECONDS, STAGE_TIMEOUTS, time_stage
+from services.query_service import query_google_ai, query_transformation, stream_google_ai
+from utils.utils import get_envvar
 
-def chunk_document(process_request: DocumentProcessRequest, chroma_db: Chroma) -> None:
+# Per-stage timeouts of the query pipeline in seconds
+TRANSFORM_TIMEOUT = float(get_envvar("RAG_TRANSFORM_TIMEOUT", "10"))
+RETRIEVE_TIMEOUT = float(get_envvar("RAG_RETRIEVE_TIMEOUT", "10"))
+RERANK_TIMEOUT = float(get_envvar("RAG_RERANK_TIMEOUT", "10"))
+GENERATE_TIMEOUT = float(get_envvar("RAG_GENERATE_TIMEOUT", "60"))
+
+# How the query transformation stage runs, full, fast or off
+TRANSFORMATION_MODE = get_envvar("QUERY_TRANSFORMATION_MODE", "full")
+TRANSFORMATION_BUDGET = float(get_envvar("QUERY_TRANSFORMATION_BUDGET", "1.5"))
+
+# Batch ingestion parses this many files at once and packs the chunks of many files into embedding batches of this size
+BATCH_PARSE_WORKERS = int(get_envvar("BATCH_PARSE_WORKERS", "4"))
+BATCH_EMBED_SIZE = int(get_envvar("BATCH_EMBED_SIZE", "256"))
+
+# How each chunking strategy reads and chunks a document
+CHUNKING_STRATEGIES = {
+    "native": (iter_pdf_pages, iter_native_chunks),
+    "semantic": (iter_pdf_pages, iter_semantic_chunks),
+    "layout": (iter_pdf_pages_as_markdown, iter_layout_chunks),
+    "small_to_big": (iter_pdf_pages_as_markdown, iter_small_to_big_chunks),
+}
+
+def chunk_document(process_request: DocumentProcessRequest, collection_pool: CollectionPool, job: Job | None = None) -> dict:
     """
-    Performs native chunking on the given document and stores it in the chroma vector database.
+    Performs native chunking on the given document and stores it in the requested collection of the chroma vector database.
 
     Returns
     -------
-    A list of langchain document objects.
+    The number of chunks skipped, added and removed.
     """
-    list_of_documents = read_pdf_document(process_request.document_path)
-    native_chunks = native_chunking(list_of_documents)
-    embed_and_add_document(native_chunks, chroma_db)
+    with collection_pool.open(process_request.collection, create=True) as collection:
+        return ingest_document(process_request.document_path, "native", *CHUNKING_STRATEGIES["native"],
+                               collection.chroma_db, collection.ingestion_manifest, job)
     
-def chunk_document_semantically(process_request: DocumentProcessRequest, chroma_db: Chroma) -> None:
+def chunk_document_semantically(process_request: DocumentProcessRequest, collection_pool: CollectionPool, job: Job | None = None) -> dict:
     """
-    Performs semantic chunking on the given document and stores it in the chroma vector database.
+    Performs semantic chunking on the given document and stores it in the requested collection of the chroma vector database.
 
     Returns
     -------
-    A list of langchain document objects.
+    The number of chunks skipped, added and removed.
     """
-    list_of_documents = read_pdf_document(process_request.document_path)
-    semantic_chunks = semantic_chunking(list_of_documents)
-    embed_and_add_document(semantic_chunks, chroma_db)
+    with collection_pool.open(process_request.collection, create=True) as collection:
+        return ingest_document(process_request.document_path, "semantic", *CHUNKING_STRATEGIES["semantic"],
+                               collection.chroma_db, collection.ingestion_manifest, job)
     
-def chunk_document_with_layout(process_request: DocumentProcessRequest, chroma_db: Chroma) -> None:
+def chunk_document_with_layout(process_request: DocumentProcessRequest, collection_pool: CollectionPool, job: Job | None = None) -> dict:
+    """
+    Performs layout-aware chunking on the given document and stores it in the requested collection of the chroma vector database.
+
+    Returns
+    -------
+    The number of chunks skipped, added and removed.
+    """
+    with collection_pool.open(process_request.collection, create=True) as collection:
+        return ingest_document(process_request.document_path, "layout", *CHUNKING_STRATEGIES["layout"],
+                               collection.chroma_db, collection.ingestion_manifest, job)
+
+def chunk_document_small_to_big(process_request: DocumentProcessRequest, collection_pool: CollectionPool, job: Job | None = None) -> dict:
+    """
+    Performs small-to-big chunking on the given document, storing its layout sections in the parent store of the requested
+    collection and only embedding their child chunks into the chroma vector database.
+
+    Returns
+    -------
+    The number of chunks skipped, added and removed.
+    """
+    with collection_pool.open(process_request.collection, create=True) as collection:
+        return ingest_document(process_request.document_path, "small_to_big", *CHUNKING_STRATEGIES["small_to_big"],
+                               collection.chroma_db, collection.ingestion_manifest, job)
+
+def ingest_document(document_path: str, strategy: str, read_document: Callable, chunk_documents: Callable,
+                    chroma_db: Chroma, ingestion_manifest: IngestionManifest, job: Job | None = None) -> dict:
+    """
+    Streams the document through parsing, chunking and embedding page by page, storing the new chunks
+    one embedding batch at a time, so memory stays flat however long the document is. \n
+    Only the chunks that are not stored yet are embedded and the ones that are gone are deleted at the end.
+    A document that has not changed since it was last ingested with the same strategy is skipped without being read.
+
+    Returns
+    -------
+    The number of chunks skipped, added and removed.
+    """
+    document_key = get_document_key(document_path, strategy)
+    file_hash = hash_file(document_path)
+
+    if ingestion_manifest.is_unchanged(document_key, file_hash):
+        skipped = len(ingestion_manifest.get_chunk_ids(document_key))
+        log.info(f"Document {document_path} is unchanged, skipped {skipped} chunks")
+        return {"skipped": skipped, "added": 0, "removed": 0}
+
+    stored_ids = ingestion_manifest.get_chunk_ids(document_key)
+    chunk_ids = set()
+    chunks = iter_timed_chunks(chunk_documents, track_pages(read_document(document_path), job))
+    added = embed_and_add_document(iter_new_chunks(chunks, document_key, stored_ids, chunk_ids), chroma_db, job=job)
+
+    report_stage(job, "store")
+    removed_ids = list(stored_ids - chunk_ids)
+    if removed_ids:
+        delete_documents(removed_ids, chroma_db)
+
+    ingestion_manifest.update(document_key, file_hash, list(chunk_ids))
+
+    result = {"skipped": len(chunk_ids) - added, "added": added, "removed": len(removed_ids)}
+    log.info(f"Document {document_path} ingested, {result}")
+    get_document_count(chroma_db)
+    return result
+
+def iter_new_chunks(chunks: Iterable, document_key: str, stored_ids: set, chunk_ids: set) -> Iterator:
+    """
+    Gives every chunk its ID and passes on the ones that are not stored yet.
+    The IDs of all the chunks, stored or not, are added to chunk_ids along the way.
+    """
+    for chunk in chunks:
+        chunk_id = get_chunk_id(document_key, chunk.page_content, chunk.metadata)
+
+        # Identical chunks in the same place within a document share an ID so they are only stored once
+        if chunk_id in chunk_ids:
+            continue
+        chunk_ids.add(chunk_id)
+        if chunk_id in stored_ids:
+            continue
+
+        chunk.id = chunk_id
+        yield chunk
+
+def chunk_documents_in_batch(batch_request: BatchProcessRequest, collection_pool: CollectionPool, job: Job | None = None) -> dict:
+    """
+    Ingests many documents with one chunking strategy into the requested collection, see ingest_documents_in_batch.
+    """
+    with collection_pool.open(batch_request.collection, create=True) as collection:
+        return ingest_documents_in_batch(batch_request, collection.chroma_db, collection.ingestion_manifest, job)
+
+def ingest_documents_in_batch(batch_request: BatchProcessRequest, chroma_db: Chroma, ingestion_manifest: IngestionManifest,
+                              job: Job | None = None) -> dict:
+    """
+    Ingests many documents with one chunking strategy. \n
+    BATCH_PARSE_WORKERS files are parsed and chunked at a time, with every page going through the PDF parsing processes.
+    The new chunks of the parsed files are packed into embedding batches of BATCH_EMBED_SIZE and written to chroma DB together.
+    A file that fails only fails itself, the rest of the batch carries on.
+
+    Returns
+    -------
+    The status, chunk counts and timings of every file, and the totals of the batch.
+    """
+    document_paths = resolve_document_paths(batch_request)
+    read_document, chunk_documents = CHUNKING_STRATEGIES[batch_request.strategy]
+    results = {document_path: {"document_path": document_path, "status": "queued"} for document_path in document_paths}
+    log.info(f"Batch of {len(document_paths)} documents started with {batch_request.strategy} chunking")
+
+    # Parsed documents waiting for their chunks to fill an embedding batch
+    pending_documents = []
+    pending_chunks = 0
+    finished = 0
+
+    report_stage(job, "parse")
+    with ThreadPoolExecutor(max_workers=BATCH_PARSE_WORKERS, thread_name_prefix="batch-parse") as executor:
+        futures = {
+            executor.submit(prepare_document, document_path, batch_request.strategy, read_document, chunk_documents, ingestion_manifest): document_path
+            for document_path in document_paths
+        }
+
+        for future in as_completed(futures):
+            document_path = futures[future]
+            try:
+                prepared_document = future.result()
+            except Exception as err:
+                results[document_path].update(status="failed", error=getattr(err, "detail", str(err)))
+                log.error(f"Batch document {document_path} failed: {results[document_path]['error']}")
+                finished += 1
+                report_progress(job, finished / len(document_paths))
+                continue
+
+            results[document_path].update(prepared_document["result"])
+            if prepared_document["unchanged"]:
+                finished += 1
+            else:
+                pending_documents.append(prepared_document)
+                pending_chunks += len(prepared_document["new_chunks"])
+
+            if pending_chunks >= BATCH_EMBED_SIZE:
+                finished += store_documents_in_batch(pending_documents, results, chroma_db, ingestion_manifest, job)
+                pending_documents, pending_chunks = [], 0
+            report_progress(job, finished / len(document_paths))
+            report_stage(job, "parse")
+
+    if pending_documents:
+        store_documents_in_batch(pending_documents, results, chroma_db, ingestion_manifest, job)
+
+    files = [results[document_path] for document_path in document_paths]
+    summary = {
+        status: sum(1 for file in files if file["status"] == status) for status in ("completed", "skipped", "failed")
+    }
+    summary.update(
+        added=sum(file.get("added", 0) for file in files),
+        removed=sum(file.get("removed", 0) for file in files),
+        files=files,
+    )
+    log.info(f"Batch finished, {summary['completed']} completed, {summary['skipped']} skipped, {summary['failed']} failed")
+    get_document_count(chroma_db)
+    return summary
+
+def resolve_document_paths(batch_request: BatchProcessRequest) -> list:
+    """
+    Returns the listed document paths followed by the ones matching the glob, without duplicates.
+    """
+    document_paths = list(batch_request.document_paths)
+    if batch_request.document_glob is not None:
+        document_paths += sorted(glob.glob(batch_request.document_glob, recursive=True))
+
+    document_paths = list(dict.fromkeys(document_paths))
+    if not document_paths:
+        log.error(f"No documents match {batch_request.document_glob}")
+        raise HTTPException(status_code=400, detail="No documents match the given glob")
+    return document_paths
+
+def prepare_document(document_path: str, strategy: str, read_document: Callable, chunk_documents: Callable,
+                     ingestion_manifest: IngestionManifest) -> dict:
+    """
+    Parses and chunks one document of a batch and works out which of its chunks are new and which are gone,
+    without storing anything yet.
+
+    Returns
+    -------
+    The document key, file hash, chunk IDs, new chunks and IDs to remove of the document, and its result so far.
     """
-    Performs layout-aware chunking on the given document and stores it in the chroma vector database.
+    start = time.perf_counter()
+    document_key = get_document_key(document_path, strategy)
+    file_hash = hash_file(document_path)
+
+    if ingestion_manifest.is_unchanged(document_key, file_hash):
+        skipped = len(ingestion_manifest.get_chunk_ids(document_key))
+        log.info(f"Document {document_path} is unchanged, skipped {skipped} chunks")
+        return {
+            "unchanged": True,
+            "result": {"status": "skipped", "skipped": skipped, "added": 0, "removed": 0,
+                       "timings": {"parse": round(time.perf_counter() - start, 4)}},
+        }
+
+    # Every page goes through the parsing processes, so the files being parsed at once do not compete for one core
+    chunks = iter_timed_chunks(chunk_documents, read_document(document_path, min_pages_per_worker=1))
+    chunks_by_id = {}
+    for chunk in chunks:
+        chunks_by_id.setdefault(get_chunk_id(document_key, chunk.page_content, chunk.metadata), chunk)
+
+    stored_ids = ingestion_manifest.get_chunk_ids(document_key)
+    new_ids = [chunk_id for chunk_id in chunks_by_id if chunk_id not in stored_ids]
+    return {
+        "unchanged": False,
+        "document_path": document_path,
+        "document_key": document_key,
+        "file_hash": file_hash,
+        "chunk_ids": list(chunks_by_id),
+        "new_ids": new_ids,
+        "new_chunks": [chunks_by_id[chunk_id] for chunk_id in new_ids],
+        "removed_ids": list(stored_ids - chunks_by_id.keys()),
+        "result": {"skipped": len(chunks_by_id) - len(new_ids), "added": len(new_ids),
+                   "timings": {"parse": round(time.perf_counter() - start, 4)}},
+    }
+
+def store_documents_in_batch(prepared_documents: list, results: dict, chroma_db: Chroma, ingestion_manifest: IngestionManifest,
+                             job: Job | None = None) -> int:
+    """
+    Embeds and stores the new chunks of the documents in batches of BATCH_EMBED_SIZE,
+    then deletes their removed chunks and records them in the manifest.
+    The embed timing of each document is the time of the whole batch it was stored in.
 
     Returns
     -------
-    A list of langchain document objects.
+    The number of documents that were finished, whether they were stored or failed.
+    """
+    start = time.perf_counter()
+    ids = [chunk_id for document in prepared_documents for chunk_id in document["new_ids"]]
+    chunks = [chunk for document in prepared_documents for chunk in document["new_chunks"]]
+
+    try:
+        embed_and_add_document(chunks, chroma_db, ids=ids, job=job, batch_size=BATCH_EMBED_SIZE)
+    except Exception as err:
+        # The chunks of several files share a batch, so none of those files can count as stored
+        log.exception(f"Storing a batch of {len(chunks)} chunks failed")
+        for document in prepared_documents:
+            results[document["document_path"]].update(status="failed", error=str(err))
+        return len(prepared_documents)
+
+    embed_seconds = round(time.perf_counter() - start, 4)
+    for document in prepared_documents:
+        result = results[document["document_path"]]
+        try:
+            if document["removed_ids"]:
+                delete_documents(document["removed_ids"], chroma_db)
+            ingestion_manifest.update(document["document_key"], document["file_hash"], document["chunk_ids"])
+            result.update(status="completed", removed=len(document["removed_ids"]))
+        except Exception as err:
+            log.exception(f"Finishing batch document {document['document_path']} failed")
+            result.update(status="failed", error=str(err))
+        result["timings"]["embed"] = embed_seconds
+    return len(prepared_documents)
+
+def track_pages(pages: Iterable, job: Job | None = None) -> Iterator:
+    """
+    Passes the pages through, reporting time spent reading them as the parse stage
+    and the share of the pages read so far as the job progress.
+    """
+    report_stage(job, "parse")
+    for page_number, page in enumerate(pages, start=1):
+        total_pages = page.metadata.get("total_pages")
+        if total_pages:
+            report_progress(job, page_number / total_pages)
+
+        report_stage(job, "chunk")
+        yield page
+        report_stage(job, "parse")
+
+def iter_timed_chunks(chunk_documents: Callable, pages: Iterable) -> Iterator:
+    """
+    Chunks the pages as they are read, timing the chunking of the whole document as one run of the chunk stage.
+    The time spent reading the pages, and by the consumer of the chunks, is left out.
+    """
+    read_seconds = 0.0
+
+    def iter_read_pages() -> Iterator:
+        nonlocal read_seconds
+        page_iterator = iter(pages)
+        while True:
+            read_start = time.perf_counter()
+            page = next(page_iterator, None)
+            read_seconds += time.perf_counter() - read_start
+            if page is None:
+                return
+            yield page
+
+    chunk_seconds = 0.0
+    chunk_iterator = iter(chunk_documents(iter_read_pages()))
+    while True:
+        chunk_start, read_seconds_before = time.perf_counter(), read_seconds
+        chunk = next(chunk_iterator, None)
+        chunk_seconds += time.perf_counter() - chunk_start - (read_seconds - read_seconds_before)
+        if chunk is None:
+            break
+        yield chunk
+    STAGE_SECONDS.observe(chunk_seconds, "chunk")
+
+def snapshot_stores(app_state: State, name: str | None = None) -> dict:
+    """
+    Snapshots chroma DB, the ingestion manifests, the BM25 indexes and the parent stores. \n
+    Ingestion is paused and every collection closed while the files are copied, so the snapshot is consistent.
+    """
+    with app_state.job_queue.paused(), app_state.collection_pool.closed():
+        return create_snapshot(name)
+
+def restore_stores(app_state: State, name: str) -> dict:
+    """
+    Replaces chroma DB, the ingestion manifests, the BM25 indexes and the parent stores with a snapshot.
+    Every collection is checked against its manifest before the collections are opened to requests again.
+    """
+    with app_state.job_queue.paused():
+        with app_state.collection_pool.closed() as closed_names:
+            collection_names = set(closed_names)
+            try:
+                snapshot = restore_snapshot(name)
+            finally:
+                # The indexes in memory are the ones from before the restore
+                reset_bm25_indexes()
+                reset_parent_stores()
+                collection_names.update(list_collection_names())
+                for collection_name in collection_names:
+                    invalidate_retrieval_responses(collection_name)
+            reports = app_state.collection_pool.check_collections()
+        return {**snapshot, "collections": sorted(reports)}
+
+def purge_stores(purge_request: PurgeRequest, app_state: State) -> dict:
+    """
+    Deletes every chunk stored in the collection and forgets every document ingested into it.
     """
-    list_of_documents = read_pdf_document_into_markdown(process_request.document_path)
-    layout_chunks = layout_chunking(list_of_documents)
-    embed_and_add_document(layout_chunks, chroma_db)
+    with app_state.job_queue.paused(), app_state.collection_pool.open(purge_request.collection) as collection:
+        deleted_chunks = get_document_count(collection.chroma_db)
+        purge_chroma_db(collection.chroma_db)
+        collection.ingestion_manifest.clear()
+    log.warning(f"Purged {deleted_chunks} chunks from collection {purge_request.collection}")
+    return {"collection": purge_request.collection, "deleted_chunks": deleted_chunks}
 
-def query_ai_model(request: QueryRequest, google_ai: ChatGoogleGenerativeAI) -> dict:
+async def query_ai_model(request: QueryRequest, google_ai: ChatGoogleGenerativeAI) -> dict:
     """
     Sends the query into the ai model and return its response.
     """
-    return query_google_ai(request.query, google_ai)
+    return await get_cached_response(
+        ASK_NAMESPACE, request.query,
+        lambda: run_stage("generate", query_google_ai(request.query, google_ai), GENERATE_TIMEOUT),
+    )
 
-def retrieve_and_query_ai_model(request: QueryRequest, google_ai: ChatGoogleGenerativeAI, chroma_db ) -> dict:
+async def stream_ai_model(request: QueryRequest, google_ai: ChatGoogleGenerativeAI) -> AsyncIterator[str]:
     """
-    Retrieves relevant documents and dends it as context to the model
+    Starts streaming the model's answer to the query as server-sent events, see stream_answer.
     """
-    queries = query_transformation(request.query, google_ai)
-    
-    context = multi_retrieve(queries, chroma_db)
+    async def prepare() -> tuple:
+        return request.query, []
+
+    return await stream_answer(ASK_NAMESPACE, request.query, prepare, google_ai)
+
+async def stream_retrieval_and_ai_model(request: QueryRequest, google_ai: ChatGoogleGenerativeAI, chroma_db, reranker: Reranker) -> AsyncIterator[str]:
+    """
+    Retrieves relevant documents and starts streaming the model's answer with them as context as server-sent events, see stream_answer.
+    """
+    where = get_where_filter(request)
+    return await stream_answer(
+        get_retrieval_namespace(request.collection, where), request.query,
+        lambda: build_query_with_context(request.query, google_ai, chroma_db, reranker, where), google_ai,
+    )
+
+async def retrieve_and_query_ai_model(request: QueryRequest, google_ai: ChatGoogleGenerativeAI, chroma_db, reranker: Reranker) -> dict:
+    """
+    Retrieves relevant documents and dends it as context to the model, unless a similar question was already answered.
+    """
+    return await get_cached_response(
+        get_retrieval_namespace(request.collection, get_where_filter(request)), request.query,
+        lambda: answer_with_retrieval(request, google_ai, chroma_db, reranker),
+    )
+
+async def answer_with_retrieval(request: QueryRequest, google_ai: ChatGoogleGenerativeAI, chroma_db, reranker: Reranker) -> dict:
+    """
+    Retrieves relevant documents and dends it as context to the model. \n
+    Every stage has its own timeout. A slow transformation falls back to the original query
+    and a slow re-rank falls back to the retrieval order.
+    """
+    query_with_context, sources = await build_query_with_context(request.query, google_ai, chroma_db, reranker, get_where_filter(request))
+
+    response = await run_stage("generate", query_google_ai(query_with_context, google_ai), GENERATE_TIMEOUT)
+    return {**response, "sources": sources}
+
+async def build_query_with_context(query: str, google_ai: ChatGoogleGenerativeAI, chroma_db, reranker: Reranker,
+                                   where: dict | None = None) -> tuple:
+    """
+    Retrieves and re-ranks documents for the query and puts them in front of it as context,
+    packed into CONTEXT_TOKEN_BUDGET tokens by pack_context. Retrieved small-to-big child chunks are swapped for their
+    parent sections before re-ranking, see expand_to_parents.
+
+    Returns
+    -------
+    The query with its context, and a list of the chunks used as context with their ID, metadata and re-rank score.
+    """
+    context = await retrieve_context(query, google_ai, chroma_db, where)
+    context = await asyncio.to_thread(expand_to_parents, context, chroma_db)
 
     if (context):
-        documents = [getattr(doc, "page_content", str(doc)) for doc in context]
-        reranked_context = rerank(request.query, documents)
+        documents = [doc.page_content for doc, _ in context]
+        reranked = await run_stage("rerank", asyncio.to_thread(reranker.rerank, query, documents), RERANK_TIMEOUT,
+                                   fallback=[(document, None) for document in documents[:10]])
+        packed = pack_context(reranked)
+        reranked_context = [packed_text for _, packed_text in packed] or ["No relevant documents retrieved"]
+
+        documents_by_text = {doc.page_content: doc for doc, _ in context}
+        sources = []
+        for index, _ in packed:
+            document, score = reranked[index]
+            sources.append({"id": documents_by_text[document].id, "metadata": documents_by_text[document].metadata, "score": score})
     else:
         reranked_context = ["No relevant documents retrieved"]
+        sources = []
 
     context = "\n\n".join(reranked_context)
-    query_with_context = f"Context:\n{context}\n\nQuestion:\n{request.query}"
+    return f"Context:\n{context}\n\nQuestion:\n{query}", sources
+
+async def retrieve_context(query: str, google_ai: ChatGoogleGenerativeAI, chroma_db: Chroma, where: dict | None = None) -> list:
+    """
+    Retrieves documents for the query and the alternative versions of it, depending on QUERY_TRANSFORMATION_MODE: \n
+    full waits for the alternative queries before retrieving, off only retrieves with the original query,
+    fast retrieves with the original query straight away while the alternatives are generated, and only uses them
+    if they arrive within QUERY_TRANSFORMATION_BUDGET seconds. Only chunks matching the where clause are retrieved.
+
+    Returns
+    -------
+    A list of (document, fused score) pairs sorted from the most to the least relevant.
+    """
+    if TRANSFORMATION_MODE == "off":
+        return await run_stage("retrieve", multi_retrieve([query], chroma_db, where=where), RETRIEVE_TIMEOUT)
+
+    if TRANSFORMATION_MODE == "full":
+        queries = await run_stage("transform", query_transformation(query, google_ai), TRANSFORM_TIMEOUT,
+                                  fallback=[query])
+        return await run_stage("retrieve", multi_retrieve(queries, chroma_db, where=where), RETRIEVE_TIMEOUT)
+
+    deadline = time.perf_counter() + TRANSFORMATION_BUDGET
+    # Left running past the budget on purpose, the variants are memoized for the next time the question is asked
+    transformation = asyncio.create_task(
+        run_stage("transform", query_transformation(query, google_ai), TRANSFORM_TIMEOUT, fallback=[])
+    )
+    transformation.add_done_callback(lambda task: task.cancelled() or task.exception())
+
+    context = await run_stage("retrieve", multi_retrieve([query], chroma_db, where=where), RETRIEVE_TIMEOUT)
+
+    await asyncio.wait({transformation}, timeout=max(0.0, deadline - time.perf_counter()))
+    if not transformation.done():
+        log.info("Query transformation missed its latency budget, using the original query only")
+        return context
+
+    try:
+        variants = transformation.result()
+    except Exception as err:
+        log.warning(f"Query transformation failed, using the original query only: {err}")
+        return context
+
+    variants = [variant for variant in variants if variant.lower() != query.lower()]
+    if not variants:
+        return context
+
+    variant_context = await run_stage("retrieve", multi_retrieve(variants, chroma_db, where=where), RETRIEVE_TIMEOUT)
+    return merge_retrieved_documents(context, variant_context)
+
+def get_where_filter(request: QueryRequest) -> dict | None:
+    """
+    Returns the chroma DB where clause of the request's filter, None if it has none.
+    """
+    return build_where_filter(**request.filter.model_dump()) if request.filter else None
+
+async def get_cached_response(namespace: str, query: str, answer: Callable[[], Awaitable]) -> dict:
+    """
+    Returns the cached response to the query if there is one, otherwise answers it and caches the response.
+    """
+    response_cache = get_response_cache()
+    if response_cache is None:
+        return await answer()
+
+    cached_response = await asyncio.to_thread(response_cache.get, namespace, query)
+    if cached_response is not None:
+        log.info(f"Answered {namespace} query from the response cache")
+        return cached_response
+
+    generation = response_cache.get_generation(namespace)
+    response = await answer()
+    await asyncio.to_thread(response_cache.put, namespace, query, response, generation)
+    return response
+
+async def stream_answer(namespace: str, query: str, prepare: Callable[[], Awaitable[tuple]], google_ai: ChatGoogleGenerativeAI) -> AsyncIterator[str]:
+    """
+    Looks the query up in the response cache, or awaits prepare for the query to send the model and the sources of its context,
+    so a failure up to here still fails the request with its own status code. \n
+    The events that follow are a metadata event with the query sent to the model, the sources and whether the answer was cached,
+    a token event for every piece of the answer as it is generated, and a done event with the time to the first token.
+    A cached answer is sent as a single token event and a streamed one is cached once it is complete.
+    If generation fails part way an error event is sent instead of done.
+
+    Returns
+    -------
+    An async iterator of server-sent events.
+    """
+    start = time.perf_counter()
+    response_cache = get_response_cache()
+
+    cached_response = await asyncio.to_thread(response_cache.get, namespace, query) if response_cache else None
+    if cached_response is not None:
+        log.info(f"Streaming {namespace} query from the response cache")
+        return iter_cached_answer_events(cached_response, start)
+
+    generation = response_cache.get_generation(namespace) if response_cache else None
+    query_with_context, sources = await prepare()
+
+    async def iter_answer_events() -> AsyncIterator[str]:
+        yield format_event("metadata", {"query": query_with_context, "sources": sources, "cached": False})
+
+        tokens = []
+        first_token_seconds = None
+        stream = stream_google_ai(query_with_context, google_ai)
+        deadline = time.perf_counter() + GENERATE_TIMEOUT
+        try:
+            while True:
+                # Waits on each piece rather than the whole stream, so a slow client is not counted against the model
+                try:
+                    token = await asyncio.wait_for(anext(stream), max(0.0, deadline - time.perf_counter()))
+                except StopAsyncIteration:
+                    break
+
+                if first_token_seconds is None:
+                    first_token_seconds = round(time.perf_counter() - start, 4)
+                    FIRST_TOKEN_SECONDS.observe(first_token_seconds)
+                tokens.append(token)
+                yield format_event("token", {"text": token})
+        except TimeoutError:
+            STAGE_TIMEOUTS.inc("generate")
+            log.error(f"The generate stage timed out after {GENERATE_TIMEOUT} seconds while streaming")
+            yield format_event("error", {"detail": "The generate stage took too long"})
+            return
+        except Exception as err:
+            log.exception("Streaming the response failed")
+            yield format_event("error", {"detail": str(err)})
+            return
+        finally:
+            await stream.aclose()
+
+        if response_cache:
+            response = {"query": query_with_context, "response": AIMessage(content="".join(tokens)), "sources": sources}
+            await asyncio.to_thread(response_cache.put, namespace, query, response, generation)
+
+        yield format_event("done", {"first_token_seconds": first_token_seconds, "seconds": round(time.perf_counter() - start, 4)})
+
+    return iter_answer_events()
+
+async def iter_cached_answer_events(cached_response: dict, start: float) -> AsyncIterator[str]:
+    """
+    Sends a cached answer as the same events as a streamed one.
+    """
+    yield format_event("metadata", {"query": cached_response["query"], "sources": cached_response.get("sources", []), "cached": True})
+    yield format_event("token", {"text": cached_response["response"].text})
+    seconds = round(time.perf_counter() - start, 4)
+    yield format_event("done", {"first_token_seconds": seconds, "seconds": seconds})
+
+def format_event(event: str, data: dict) -> str:
+    """
+    Formats a server-sent event with a JSON payload.
+    """
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def run_stage(stage: str, awaitable: Awaitable, timeout: float, fallback=None):
+    """
+    Awaits one stage of the query pipeline with a timeout in seconds. \n
+    When it times out the fallback is returned instead, or the request fails if there is none.
+    """
+    try:
+        with time_stage(stage):
+            return await asyncio.wait_for(awaitable, timeout)
+    except TimeoutError:
+        STAGE_TIMEOUTS.inc(stage)
+        if fallback is None:
+            log.error(f"The {stage} stage timed out after {timeout} seconds")
+            raise HTTPException(status_code=504, detail=f"The {stage} stage took too long")
 
-    return query_google_ai(query_with_context, google_ai)
\ No newline at end of file
+        log.warning(f"The {stage} stage timed out after {timeout} seconds, continuing without it")
+        return fallback
@@ -2,6 +2,55 @@ import streamlit as st
 import requests
 import os
 import json
+import time
+
+BACKEND_URL = "http://localhost:8000"
+
+def wait_for_job(job: dict) -> dict:
+    """
+    Polls the backend until the chunking job finishes, showing its stage and progress.
+    """
+    progress_bar = st.progress(0.0, text="Queued")
+    while job["status"] in ("queued", "running"):
+        time.sleep(1)
+        response = requests.get(f"{BACKEND_URL}/jobs/{job['job_id']}")
+        response.raise_for_status()
+        job = response.json()
+        progress_bar.progress(job["progress"], text=f"{job['status'].capitalize()}: {job['stage'] or 'waiting'}")
+    progress_bar.empty()
+    return job
+
+def show_job_result(job: dict) -> None:
+    """
+    Shows how the chunking job ended.
+    """
+    if job["status"] == "completed":
+        result = job["result"]
+        st.success(f"Document has been chunked: {result['added']} chunks added, "
+                   f"{result['skipped']} unchanged, {result['removed']} removed")
+    else:
+        st.error(f"Chunking failed: {job['error']}")
+
+def iter_events(response: requests.Response):
+    """
+    Parses the server-sent events of a streamed answer into (event, data) pairs as they arrive.
+    """
+    event = None
+    for line in response.iter_lines(decode_unicode=True):
+        if line.startswith("event: "):
+            event = line[len("event: "):]
+        elif line.startswith("data: "):
+            yield event, json.loads(line[len("data: "):])
+
+def iter_answer_tokens(events):
+    """
+    Yields the pieces of the answer as they are generated, for st.write_stream.
+    """
+    for event, data in events:
+        if event == "token":
+            yield data["text"]
+        elif event == "error":
+            st.error(f"The answer could not be completed: {data['detail']}")
 
 # --- Page Configuration ---
 st.set_page_config(
@@ -14,6 +63,9 @@ st.set_page_config(
 st.title("📄 PDF Processing and Question Answering")
 st.markdown("Upload a PDF, choose a chunking method, and then ask questions based on the document's content.")
 
+# Every course or student keeps their documents in a collection of their own, questions only search that collection
+collection = st.text_input("Collection", value="document_store", help="Course or student the documents belong to")
+
 # --- PDF Upload ---
 st.header("1. Upload your PDF")
 uploaded_file = st.file_uploader("Choose a PDF file", type="pdf")
@@ -30,18 +82,18 @@ if uploaded_file is not None:
 
     # --- Chunking Section ---
     st.header("2. Chunk the Document")
-    col1, col2, col3 = st.columns(3)
+    col1, col2, col3, col4 = st.columns(4)
 
     with col1:
         if st.button("Normal Chunking"):
             with st.spinner("Processing with normal chunking..."):
                 try:
                     response = requests.post(
-                        "http://localhost:8000/chunk/pdf",
-                        json={"document_path": file_path}
+                        f"{BACKEND_URL}/chunk/pdf",
+                        json={"document_path": file_path, "collection": collection}
                     )
                     response.raise_for_status()  # Raise an exception for bad status codes
-                    st.success(response.json().get("message", "Chunking complete!"))
+                    show_job_result(wait_for_job(response.json()))
                 except requests.exceptions.RequestException as e:
                     st.error(f"An error occurred: {e}")
 
@@ -50,11 +102,11 @@ if uploaded_file is not None:
             with st.spinner("Processing with semantic chunking..."):
                 try:
                     response = requests.post(
-                        "http://localhost:8000/chunk/pdf/semantic",
-                        json={"document_path": file_path}
+                        f"{BACKEND_URL}/chunk/pdf/semantic",
+                        json={"document_path": file_path, "collection": collection}
                     )
                     response.raise_for_status()
-                    st.success(response.json().get("message", "Chunking complete!"))
+                    show_job_result(wait_for_job(response.json()))
                 except requests.exceptions.RequestException as e:
                     st.error(f"An error occurred: {e}")
 
@@ -63,11 +115,24 @@ if uploaded_file is not None:
             with st.spinner("Processing with layout chunking..."):
                 try:
                     response = requests.post(
-                        "http://localhost:8000/chunk/pdf/layout",
-                        json={"document_path": file_path}
+                        f"{BACKEND_URL}/chunk/pdf/layout",
+                        json={"document_path": file_path, "collection": collection}
                     )
                     response.raise_for_status()
-                    st.success(response.json().get("message", "Chunking complete!"))
+                    show_job_result(wait_for_job(response.json()))
+                except requests.exceptions.RequestException as e:
+                    st.error(f"An error occurred: {e}")
+
+    with col4:
+        if st.button("Small-to-big Chunking"):
+            with st.spinner("Processing with small-to-big chunking..."):
+                try:
+                    response = requests.post(
+                        f"{BACKEND_URL}/chunk/pdf/small-to-big",
+                        json={"document_path": file_path, "collection": collection}
+                    )
+                    response.raise_for_status()
+                    show_job_result(wait_for_job(response.json()))
                 except requests.exceptions.RequestException as e:
                     st.error(f"An error occurred: {e}")
 
@@ -77,32 +142,38 @@ if uploaded_file is not None:
 
     if st.button("Ask"):
         if query:
-            with st.spinner("Retrieving answer..."):
-                try:
+            try:
+                with st.spinner("Retrieving answer..."):
                     response = requests.post(
-                        "http://localhost:8000/rag/ask",
-                        json={"query": query}
+                        f"{BACKEND_URL}/rag/ask/stream",
+                        json={"query": query, "collection": collection},
+                        stream=True,
                     )
                     response.raise_for_status()
-                    data = response.json()
+                    events = iter_events(response)
+                    metadata = {}
+                    # Retrieval is done once the metadata event arrives, the answer is rendered as it streams in
+                    for event, data in events:
+                        if event == "metadata":
+                            metadata.update(data)
+                            break
 
-                    st.subheader("Answer:")
-                    st.write(data.get("response", {}).get("content", "No content found."))
+                st.subheader("Answer:")
+                st.write_stream(iter_answer_tokens(events))
 
-                    st.subheader("Retrieved Context:")
-                    # The context might be nested in the 'query' part of the response
-                    retrieved_query = data.get("query", "")
-                    context_start = retrieved_query.find("Context:")
-                    if context_start != -1:
-                        context = retrieved_query[context_start + len("Context:"):]
-                        st.text_area("Context", context, height=200)
-                    else:
-                        st.warning("Could not extract context from the response.")
+                st.subheader("Retrieved Context:")
+                retrieved_query = metadata.get("query", "")
+                context_start = retrieved_query.find("Context:")
+                if context_start != -1:
+                    context = retrieved_query[context_start + len("Context:"):]
+                    st.text_area("Context", context, height=200)
+                else:
+                    st.warning("Could not extract context from the response.")
 
-                except requests.exceptions.RequestException as e:
-                    st.error(f"An error occurred while asking the question: {e}")
-                except json.JSONDecodeError:
-                    st.error("Failed to decode the JSON response from the server.")
+            except requests.exceptions.RequestException as e:
+                st.error(f"An error occurred while asking the question: {e}")
+            except json.JSONDecodeError:
+                st.error("Failed to decode the streamed response from the server.")
         else:
             st.warning("Please enter a question.")
 
@@ -1,8 +1,48 @@
-from pydantic import BaseModel, Field
-from typing import Annotated
+from pydantic import BaseModel, Field, model_validator
+from typing import Annotated, Literal
+
+# Chroma DB collection names, 3 to 63 letters, digits, '.', '-' and '_' that start and end with a letter or digit
+CollectionName = Annotated[str, Field(pattern=r"^[A-Za-z0-9][A-Za-z0-9._-]{1,61}[A-Za-z0-9]$")]
 
 class DocumentProcessRequest(BaseModel):
     document_path: Annotated[str, Field(min_length=1)]
+    collection: CollectionName = "document_store"
+
+class BatchProcessRequest(BaseModel):
+    document_paths: list[Annotated[str, Field(min_length=1)]] = []
+    document_glob: Annotated[str, Field(min_length=1)] | None = None
+    strategy: Literal["native", "semantic", "layout", "small_to_big"] = "native"
+    collection: CollectionName = "document_store"
+
+    @model_validator(mode="after")
+    def check_documents_given(self):
+        if not self.document_paths and self.document_glob is None:
+            raise ValueError("Either document_paths or document_glob is required")
+        return self
+
+class RetrievalFilter(BaseModel):
+    """
+    Narrows retrieval down to chunks from the given files, under a header with the given title,
+    or overlapping the given pages, counted from 0.
+    """
+    sources: list[Annotated[str, Field(min_length=1)]] = []
+    section: Annotated[str, Field(min_length=1)] | None = None
+    page_from: Annotated[int, Field(ge=0)] | None = None
+    page_to: Annotated[int, Field(ge=0)] | None = None
+
+    @model_validator(mode="after")
+    def check_page_range(self):
+        if self.page_from is not None and self.page_to is not None and self.page_from > self.page_to:
+            raise ValueError("page_from cannot be after page_to")
+        return self
 
 class QueryRequest(BaseModel):
-    query: Annotated[str, Field(min_length=1)]
\ No newline at end of file
+    query: Annotated[str, Field(min_length=1)]
+    collection: CollectionName = "document_store"
+    filter: RetrievalFilter | None = None
+
+class PurgeRequest(BaseModel):
+    collection: CollectionName = "document_store"
+
+class SnapshotRequest(BaseModel):
+    name: Annotated[str, Field(pattern=r"^[A-Za-z0-9][A-Za-z0-9._-]{0,63}$")] | None = None
@@ -0,0 +1,179 @@
+from collections import Counter
+import heapq
+import json
+import math
+from pathlib import Path
+import re
+import sqlite3
+import threading
+from utils.logger import log
+from utils.utils import get_envvar
+
+ENV_BM25_K1 = "BM25_K1"
+ENV_BM25_B = "BM25_B"
+
+# Kept next to the chroma DB directory, one file per collection
+BM25_INDEX_DIRECTORY = "./data/bm25_index"
+
+# Lowercased runs of letters and digits, so course codes like CS2040 and formula names stay whole terms
+TOKEN = re.compile(r"\w+")
+
+class BM25Index:
+    """
+    In-process inverted index that scores chunks against a query with BM25. \n
+    It is updated incrementally as chunks are stored in or deleted from chroma DB, so exact terms that dense retrieval
+    misses can still be found. The term frequencies of every chunk are kept in SQLite and written as each change is made,
+    so persisting a change costs as much as the change and never the whole index. The postings are rebuilt from them on load.
+    """
+
+    def __init__(self, index_path: str, k1: float = 1.5, b: float = 0.75):
+        self.index_path = Path(index_path)
+        self.index_path.parent.mkdir(parents=True, exist_ok=True)
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.Lock()
+        # Term frequencies of every term, keyed by term then by chunk ID
+        self._postings = {}
+        # Number of terms in every chunk, keyed by chunk ID
+        self._document_lengths = {}
+        # Distinct terms of every chunk, so a chunk can be removed without going through every posting list
+        self._chunk_terms = {}
+        self._total_length = 0
+
+        self._connection = sqlite3.connect(self.index_path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS chunks (id TEXT PRIMARY KEY, term_frequencies TEXT NOT NULL)")
+        self._connection.commit()
+        for chunk_id, term_frequencies in self._connection.execute("SELECT id, term_frequencies FROM chunks"):
+            self._index(chunk_id, json.loads(term_frequencies))
+        log.info(f"BM25 index loaded with {len(self._document_lengths)} chunks from {self.index_path}")
+
+    def __len__(self) -> int:
+        return len(self._document_lengths)
+
+    def add(self, ids: list, texts: list) -> None:
+        """
+        Indexes the chunks, replacing any chunk that is already indexed under the same ID.
+        """
+        with self._lock:
+            rows = []
+            for chunk_id, text in zip(ids, texts):
+                self._remove(chunk_id)
+                term_frequencies = Counter(tokenize(text))
+                self._index(chunk_id, term_frequencies)
+                rows.append((chunk_id, json.dumps(term_frequencies)))
+            self._connection.executemany("INSERT OR REPLACE INTO chunks (id, term_frequencies) VALUES (?, ?)", rows)
+            self._connection.commit()
+
+    def delete(self, ids: list) -> None:
+        """
+        Removes the chunks from the index.
+        """
+        with self._lock:
+            for chunk_id in ids:
+                self._remove(chunk_id)
+            self._connection.executemany("DELETE FROM chunks WHERE id = ?", [(chunk_id,) for chunk_id in ids])
+            self._connection.commit()
+
+    def search(self, query: str, k: int) -> list:
+        """
+        Scores every chunk that shares a term with the query.
+
+        Returns
+        -------
+        A list of at most k (chunk ID, BM25 score) pairs, the highest score first.
+        """
+        with self._lock:
+            chunk_count = len(self._document_lengths)
+            if chunk_count == 0:
+                return []
+            average_length = self._total_length / chunk_count
+
+            scores = {}
+            for term in set(tokenize(query)):
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (chunk_count - len(postings) + 0.5) / (len(postings) + 0.5))
+                for chunk_id, frequency in postings.items():
+                    length_norm = self.k1 * (1 - self.b + self.b * self._document_lengths[chunk_id] / average_length)
+                    scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * frequency * (self.k1 + 1) / (frequency + length_norm)
+
+        return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+
+    def clear(self) -> None:
+        """
+        Forgets every chunk, used when the chroma DB collection is deleted.
+        """
+        with self._lock:
+            self._postings = {}
+            self._document_lengths = {}
+            self._chunk_terms = {}
+            self._total_length = 0
+            self._connection.execute("DELETE FROM chunks")
+            self._connection.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    def _index(self, chunk_id: str, term_frequencies: dict) -> None:
+        for term, frequency in term_frequencies.items():
+            self._postings.setdefault(term, {})[chunk_id] = frequency
+        self._chunk_terms[chunk_id] = list(term_frequencies)
+        length = sum(term_frequencies.values())
+        self._document_lengths[chunk_id] = length
+        self._total_length += length
+
+    def _remove(self, chunk_id: str) -> None:
+        length = self._document_lengths.pop(chunk_id, None)
+        if length is None:
+            return
+        self._total_length -= length
+
+        for term in self._chunk_terms.pop(chunk_id):
+            postings = self._postings[term]
+            del postings[chunk_id]
+            if not postings:
+                del self._postings[term]
+
+def tokenize(text: str) -> list:
+    """
+    Splits the text into lowercased terms.
+    """
+    return TOKEN.findall(text.lower())
+
+_bm25_indexes = {}
+_bm25_indexes_lock = threading.Lock()
+
+def reset_bm25_indexes() -> None:
+    """
+    Closes every loaded index, so they are read from disk again the next time they are asked for.
+    """
+    with _bm25_indexes_lock:
+        bm25_indexes = list(_bm25_indexes.values())
+        _bm25_indexes.clear()
+    for bm25_index in bm25_indexes:
+        bm25_index.close()
+
+def unload_bm25_index(collection_name: str) -> None:
+    """
+    Closes the index of the collection and drops it from memory, it is read from disk again the next time it is asked for.
+    """
+    with _bm25_indexes_lock:
+        bm25_index = _bm25_indexes.pop(collection_name, None)
+    if bm25_index is not None:
+        bm25_index.close()
+
+def get_bm25_index(collection_name: str) -> BM25Index:
+    """
+    Returns the BM25 index of the chroma DB collection, loading it the first time it is asked for.
+    """
+    with _bm25_indexes_lock:
+        if collection_name not in _bm25_indexes:
+            _bm25_indexes[collection_name] = BM25Index(
+                index_path=f"{BM25_INDEX_DIRECTORY}/{collection_name}.sqlite3",
+                k1=float(get_envvar(ENV_BM25_K1, "1.5")),
+                b=float(get_envvar(ENV_BM25_B, "0.75")),
+            )
+        return _bm25_indexes[collection_name]
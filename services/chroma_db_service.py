@@ -1,78 +1,495 @@
+import asyncio
+import chromadb
+from chromadb.api.client import SharedSystemClient
+from concurrent.futures import ThreadPoolExecutor
+import itertools
 from langchain_chroma import Chroma
-from services.document_chunking import get_embedding_model
-import time
+from langchain_core.documents import Document
+from pathlib import Path
+from services.bm25_index import get_bm25_index, unload_bm25_index
+from services.context_packing import CONTEXT_MAX_PASSAGE_TOKENS, estimate_tokens
+from services.embedding_service import get_embedding_model
+from services.job_queue import Job, report_stage
+from services.parent_store import CHILD_METADATA_KEYS, get_parent_store, take_parent_texts, unload_parent_store
+from services.response_cache import invalidate_retrieval_responses
+from typing import Iterable
 from utils.logger import log
+from utils.metrics import time_stage
+from utils.utils import get_envvar
+import uuid
 
-def connect_to_chroma_db() -> Chroma:
+ENV_EMBED_BATCH_SIZE = "EMBED_BATCH_SIZE"
+ENV_EMBED_WRITE_OVERLAP = "EMBED_WRITE_OVERLAP"
+ENV_HYBRID_RETRIEVAL = "HYBRID_RETRIEVAL"
+ENV_RRF_K = "RRF_K"
+ENV_CHROMA_HNSW_SPACE = "CHROMA_HNSW_SPACE"
+ENV_CHROMA_HNSW_EF_CONSTRUCTION = "CHROMA_HNSW_EF_CONSTRUCTION"
+ENV_CHROMA_HNSW_M = "CHROMA_HNSW_M"
+ENV_CHROMA_HNSW_EF_SEARCH = "CHROMA_HNSW_EF_SEARCH"
+ENV_RETRIEVAL_K = "RETRIEVAL_K"
+ENV_RETRIEVAL_MAX_DISTANCE = "RETRIEVAL_MAX_DISTANCE"
+
+CHROMA_DB_DIRECTORY = "./data/chroma_langchain_db"
+COLLECTION_NAME = "document_store"
+
+# Number of chunks embedded and written to chroma DB at a time, capped by the largest batch chroma DB accepts
+EMBED_BATCH_SIZE = int(get_envvar(ENV_EMBED_BATCH_SIZE, "64"))
+# Embed the next batch while the previous one is being written
+EMBED_WRITE_OVERLAP = get_envvar(ENV_EMBED_WRITE_OVERLAP, "true").lower() == "true"
+
+# Retrieve with a BM25 index alongside the vectors and fuse both rankings with reciprocal rank fusion
+HYBRID_RETRIEVAL = get_envvar(ENV_HYBRID_RETRIEVAL, "true").lower() == "true"
+# Dampens the weight of the top ranks in reciprocal rank fusion, 60 is the value from the original paper
+RRF_K = int(get_envvar(ENV_RRF_K, "60"))
+# How many times k BM25 hits are checked against a where clause at a time, the index itself cannot filter on metadata
+BM25_FILTER_OVERFETCH = 4
+
+# Number of chunks retrieved per query from each index
+RETRIEVAL_K = int(get_envvar(ENV_RETRIEVAL_K, "20"))
+# Metadata keys of the headers a chunk sits under, as layout chunking names them
+SECTION_HEADERS = ("Header 1", "Header 2", "Header 3")
+
+# Distance past which a vector match is dropped, when not set it depends on the distance metric of the collection.
+# The defaults are the same cut-off for normalized embeddings, a squared L2 distance of 0.8 is a cosine similarity of 0.6
+DEFAULT_MAX_DISTANCES = {"l2": 0.8, "cosine": 0.4, "ip": 0.4}
+
+def get_hnsw_configuration() -> dict:
+    """
+    Returns the HNSW settings of the vector index, chroma DB's own defaults unless set: \n
+    CHROMA_HNSW_SPACE is the distance metric (l2, cosine or ip), CHROMA_HNSW_EF_CONSTRUCTION and CHROMA_HNSW_M
+    trade build time and memory for recall, and CHROMA_HNSW_EF_SEARCH trades query latency for recall.
+    """
+    return {
+        "space": get_envvar(ENV_CHROMA_HNSW_SPACE, "l2"),
+        "ef_construction": int(get_envvar(ENV_CHROMA_HNSW_EF_CONSTRUCTION, "100")),
+        "max_neighbors": int(get_envvar(ENV_CHROMA_HNSW_M, "16")),
+        "ef_search": int(get_envvar(ENV_CHROMA_HNSW_EF_SEARCH, "100")),
+    }
+
+def get_max_distance(chroma_db: Chroma) -> float:
+    """
+    Returns RETRIEVAL_MAX_DISTANCE, or the default cut-off for the distance metric of the collection.
+    """
+    max_distance = get_envvar(ENV_RETRIEVAL_MAX_DISTANCE, "")
+    if max_distance:
+        return float(max_distance)
+    return DEFAULT_MAX_DISTANCES[chroma_db._collection.configuration["hnsw"]["space"]]
+
+def connect_to_chroma_db(collection_name: str = COLLECTION_NAME, persist_directory: str = CHROMA_DB_DIRECTORY,
+                         hnsw_configuration: dict | None = None, create: bool = True) -> Chroma:
     """
-    Establishes a connection with chroma database.
+    Establishes a connection with chroma database. \n
+    A new collection is created with hnsw_configuration (get_hnsw_configuration by default), unless create is False,
+    in which case a missing collection raises chromadb.errors.NotFoundError. An existing one keeps the
+    settings it was built with, only ef_search can be changed without rebuilding the index.
     """
+    hnsw_configuration = hnsw_configuration or get_hnsw_configuration()
     vector_store = Chroma(
-        collection_name="document_store",
+        collection_name=collection_name,
         embedding_function= get_embedding_model(),
-        persist_directory="./data/chroma_langchain_db",  # Where to save data locally, remove if not necessary
+        persist_directory=persist_directory,  # Where to save data locally
+        collection_configuration={"hnsw": hnsw_configuration},
+        create_collection_if_not_exists=create,
     )
-    log.info("INFO: Connected to chroma DB")
+    log.info(f"INFO: Connected to chroma DB collection {collection_name}")
+
+    collection = vector_store._collection
+    current_configuration = collection.configuration["hnsw"]
+    if current_configuration["ef_search"] != hnsw_configuration["ef_search"]:
+        collection.modify(configuration={"hnsw": {"ef_search": hnsw_configuration["ef_search"]}})
+    built_with = {setting: current_configuration[setting] for setting in ("space", "ef_construction", "max_neighbors")}
+    if any(hnsw_configuration[setting] != value for setting, value in built_with.items()):
+        log.warning(f"Collection {collection_name} was built with {built_with}, the configured HNSW settings only apply once it is rebuilt")
+
+    if HYBRID_RETRIEVAL:
+        sync_bm25_index(vector_store)
 
     return vector_store
 
+def list_collection_names(persist_directory: str = CHROMA_DB_DIRECTORY) -> list:
+    """
+    Returns the names of the collections stored in chroma database.
+    """
+    client = chromadb.PersistentClient(path=persist_directory)
+    return sorted(collection.name for collection in client.list_collections())
+
+def sync_bm25_index(chroma_db: Chroma) -> None:
+    """
+    Rebuilds the BM25 index of the collection from the stored chunks if it does not hold the same number of chunks,
+    which happens when hybrid retrieval is turned on for a collection that was filled without it.
+    """
+    collection = chroma_db._collection
+    bm25_index = get_bm25_index(collection.name)
+    chunk_count = collection.count()
+    if len(bm25_index) == chunk_count:
+        return
+
+    log.warning(f"BM25 index has {len(bm25_index)} chunks but collection {collection.name} has {chunk_count}, rebuilding it")
+    bm25_index.clear()
+    page_size = collection._client.get_max_batch_size()
+    for offset in range(0, chunk_count, page_size):
+        stored_chunks = collection.get(include=["documents"], limit=page_size, offset=offset)
+        bm25_index.add(stored_chunks["ids"], stored_chunks["documents"])
+
 def disconnect_chroma_db(chroma_db: Chroma) -> None:
     """
-    Severs the connection to the chroma DB
+    Disconnects from the chroma DB collection, closing its BM25 index and parent store and dropping them from memory.
+    Everything stored stays on disk and is there again on the next connect. \n
+    The clients of one directory all share the same chroma DB system, which stays up until release_chroma_db is called.
+    """
+    if HYBRID_RETRIEVAL:
+        unload_bm25_index(chroma_db._collection.name)
+    unload_parent_store(chroma_db._collection.name)
+
+def release_chroma_db() -> None:
+    """
+    Stops the chroma DB systems shared by the clients, so the files of chroma DB can be copied or replaced.
+    Every collection must be disconnected first, the next client that connects starts a new system on the files as they are then.
     """
-    chroma_db.delete_collection()
+    for system in list(SharedSystemClient._identifier_to_system.values()):
+        system.stop()
+    SharedSystemClient.clear_system_cache()
 
-def embed_and_add_document(documents: list, chroma_db: Chroma) -> None:
+def purge_chroma_db(chroma_db: Chroma) -> None:
     """
-    Embeds the documents and adds it into chroma database.
+    Deletes every chunk, by dropping the collection and creating it again with the same settings,
+    its BM25 index and its parent sections.
     """
+    collection_name = chroma_db._collection.name
+    chroma_db.reset_collection()
+    if HYBRID_RETRIEVAL:
+        get_bm25_index(collection_name).clear()
+    get_parent_store(collection_name).clear()
+    invalidate_retrieval_responses(collection_name)
+
+def embed_and_add_document(documents: Iterable, chroma_db: Chroma, ids: list | None = None, job: Job | None = None,
+                           batch_size: int | None = None, overlap: bool | None = None) -> int:
+    """
+    Embeds the documents and adds it into chroma database, batch_size (EMBED_BATCH_SIZE by default) at a time. \n
+    Every batch is written as soon as it is embedded, so only a batch or two of vectors are held at once and the documents
+    can come from a generator. With overlap (EMBED_WRITE_OVERLAP by default) the next batch is embedded while the last one is written.
+    Documents are stored under the given IDs, otherwise under their own IDs or new random ones.
+    Documents whose ID already exists in the database are overwritten.
+
+    Returns
+    -------
+    The number of documents stored.
+    """
+    batch_size = min(batch_size or EMBED_BATCH_SIZE, chroma_db._client.get_max_batch_size())
+    overlap = EMBED_WRITE_OVERLAP if overlap is None else overlap
+
+    if ids is None:
+        documents_with_ids = ((document.id or str(uuid.uuid4()), document) for document in documents)
+    else:
+        documents_with_ids = zip(ids, documents)
+
     log.info("INFO: Embedding process has begun")
-    start = time.perf_counter()
+    stored = 0
+    submitted_batches = 0
+    pending_write = None
 
-    chroma_db.add_documents(documents)
-    
-    end = time.perf_counter()
-    log.info(f"INFO: Embedding process completed and has been stored into chroma database, took {end - start:.4f} seconds")
-        
-def multi_retrieve(queries: list, chroma_db: Chroma, k: int = 20) -> list:
+    try:
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix="chroma-write") as writer:
+            for batch in itertools.batched(documents_with_ids, batch_size):
+                batch_ids = [document_id for document_id, _ in batch]
+                texts = [document.page_content for _, document in batch]
+                # Chroma rejects empty metadata dictionaries
+                metadatas = [document.metadata or None for _, document in batch]
+
+                report_stage(job, "embed")
+                with time_stage("embed") as embed_timer:
+                    embeddings = chroma_db.embeddings.embed_documents(texts)
+
+                # At most one write is in flight, so a slow write holds back embedding instead of piling up batches
+                if pending_write is not None:
+                    report_stage(job, "store")
+                    stored += pending_write.result()
+                    pending_write = None
+
+                submitted_batches += 1
+                write_arguments = (chroma_db, submitted_batches, batch_ids, texts, embeddings, metadatas, embed_timer.seconds)
+                if overlap:
+                    pending_write = writer.submit(write_batch, *write_arguments)
+                else:
+                    report_stage(job, "store")
+                    stored += write_batch(*write_arguments)
+
+            if pending_write is not None:
+                report_stage(job, "store")
+                stored += pending_write.result()
+    finally:
+        if submitted_batches:
+            invalidate_retrieval_responses(chroma_db._collection.name)
+
+    log.info(f"INFO: Embedding process completed and {stored} documents have been stored into chroma database "
+             f"in {submitted_batches} batches")
+    return stored
+
+def write_batch(chroma_db: Chroma, batch_number: int, ids: list, texts: list, embeddings: list, metadatas: list,
+                embed_seconds: float) -> int:
     """
-    Retrieves the top k most relevent documents based on the query.
+    Writes one embedded batch into chroma database and logs the throughput of embedding and writing it.
+    The parent sections of small-to-big child chunks go to the parent store first, so a stored child always has its parent.
+
+    Returns
+    -------
+    The number of documents written.
     """
-    # Set of all unique docs for context
-    unique_contexts = set()
-    
-    # For debugging
-    all_retrieved_docs = []
-    
-    for query in queries:
-        retrieved_docs_with_scores = chroma_db.similarity_search_with_score(query, k=k)
-        retrieved_docs = [doc for doc, score in retrieved_docs_with_scores if score <= 0.8]
-        
-        # Update debugging list
-        all_retrieved_docs.extend(retrieved_docs)
+    with time_stage("store") as write_timer:
+        parents = take_parent_texts(metadatas)
+        if parents:
+            get_parent_store(chroma_db._collection.name).put(parents)
+        chroma_db._collection.upsert(ids=ids, embeddings=embeddings, documents=texts, metadatas=metadatas)
+        if HYBRID_RETRIEVAL:
+            get_bm25_index(chroma_db._collection.name).add(ids, texts)
+
+    log.info(f"Batch {batch_number} of {len(ids)} chunks, embedded at {len(ids) / max(embed_seconds, 1e-9):.1f} chunks/s, "
+             f"written at {len(ids) / max(write_timer.seconds, 1e-9):.1f} chunks/s")
+    return len(ids)
+
+def delete_documents(ids: list, chroma_db: Chroma) -> None:
+    """
+    Deletes the documents with the given IDs from chroma database, and the parent sections no remaining chunk belongs to.
+    """
+    collection = chroma_db._collection
+    max_batch_size = chroma_db._client.get_max_batch_size()
+    parent_ids = set()
+    for batch_start in range(0, len(ids), max_batch_size):
+        batch_ids = ids[batch_start:batch_start + max_batch_size]
+        metadatas = collection.get(ids=batch_ids, include=["metadatas"])["metadatas"]
+        parent_ids.update(metadata["parent_id"] for metadata in metadatas if metadata and "parent_id" in metadata)
+        chroma_db.delete(ids=batch_ids)
+
+    if parent_ids:
+        remaining_children = collection.get(where={"parent_id": {"$in": list(parent_ids)}}, include=["metadatas"])["metadatas"]
+        orphaned_parent_ids = parent_ids - {metadata["parent_id"] for metadata in remaining_children}
+        get_parent_store(collection.name).delete(list(orphaned_parent_ids))
+    if HYBRID_RETRIEVAL:
+        get_bm25_index(chroma_db._collection.name).delete(ids)
+    invalidate_retrieval_responses(chroma_db._collection.name)
+    log.info(f"INFO: Deleted {len(ids)} documents from chroma database")
         
-        # Extract page content
-        for doc in retrieved_docs:
-            content = getattr(doc, "page_content", str(doc))
-            unique_contexts.add(content)
-    
-    # Convert set to list
-    context_list = list(unique_contexts)
+def build_where_filter(sources: list | None = None, section: str | None = None, page_from: int | None = None,
+                       page_to: int | None = None) -> dict | None:
+    """
+    Builds a chroma DB where clause from the chunk metadata every chunking strategy sets, see get_chunk_metadata. \n
+    sources keeps the chunks of those files, section the chunks under a header with that title at any level,
+    and page_from and page_to the chunks that overlap those pages, counted from 0 like the page metadata.
+
+    Returns
+    -------
+    The where clause, or None if nothing is filtered on.
+    """
+    conditions = []
+    if sources:
+        conditions.append({"source": {"$in": [str(Path(source).resolve()) for source in sources]}})
+    if section:
+        conditions.append({"$or": [{header: section} for header in SECTION_HEADERS]})
+    if page_from is not None:
+        conditions.append({"page_end": {"$gte": page_from}})
+    if page_to is not None:
+        conditions.append({"page_start": {"$lte": page_to}})
+
+    if not conditions:
+        return None
+    return conditions[0] if len(conditions) == 1 else {"$and": conditions}
+
+async def multi_retrieve(queries: list, chroma_db: Chroma, k: int = RETRIEVAL_K, where: dict | None = None) -> list:
+    """
+    Retrieves the top k most relevent documents based on the queries, without blocking the event loop.
+
+    Returns
+    -------
+    A list of (document, fused score) pairs sorted from the most to the least relevant.
+    """
+    return await asyncio.to_thread(batched_retrieve, queries, chroma_db, k, where=where)
+
+def batched_retrieve(queries: list, chroma_db: Chroma, k: int = RETRIEVAL_K, max_distance: float | None = None,
+                     hybrid: bool = HYBRID_RETRIEVAL, where: dict | None = None) -> list:
+    """
+    Embeds all the queries in one call and searches chroma database with all of their vectors in one query,
+    dropping matches further than max_distance (get_max_distance by default). \n
+    With hybrid every query is also searched in the BM25 index, which finds the exact terms dense retrieval misses.
+    The top k of every ranking, one per query per index, are fused with reciprocal rank fusion,
+    so a document ranked high by several queries or by both indexes comes first.
+    A where clause (see build_where_filter) narrows both searches down to the chunks whose metadata matches it.
+
+    Returns
+    -------
+    A list of (document, fused score) pairs sorted from the most to the least relevant.
+    """
+    if not queries:
+        return []
+
+    query_embeddings = chroma_db.embeddings.embed_documents(queries)
+    results = chroma_db._collection.query(
+        query_embeddings=query_embeddings,
+        n_results=k,
+        where=where,
+        include=["documents", "metadatas", "distances"],
+    )
+
+    if max_distance is None:
+        max_distance = get_max_distance(chroma_db)
+
+    documents = {}
+    rankings = []
+    for ids, texts, metadatas, distances in zip(results["ids"], results["documents"], results["metadatas"], results["distances"]):
+        ranking = []
+        for doc_id, text, metadata, distance in zip(ids, texts, metadatas, distances):
+            if distance > max_distance:
+                continue
+            documents.setdefault(doc_id, Document(id=doc_id, page_content=text, metadata=metadata or {}))
+            ranking.append(doc_id)
+        rankings.append(ranking)
+
+    lexical_matches = 0
+    if hybrid:
+        vector_matches = len(documents)
+        rankings += lexical_retrieve(queries, chroma_db, k, documents, where)
+        lexical_matches = len(documents) - vector_matches
 
-    log.info(f"INFO: Retrieved  {len(context_list)} documents")
+    retrieved_docs = [(documents[doc_id], score) for doc_id, score in reciprocal_rank_fusion(rankings) if doc_id in documents]
+
+    log.info(f"INFO: Retrieved  {len(retrieved_docs)} documents for {len(queries)} queries, {lexical_matches} of them only by BM25")
     
-    return context_list
+    return retrieved_docs
+
+def lexical_retrieve(queries: list, chroma_db: Chroma, k: int, documents: dict, where: dict | None = None) -> list:
+    """
+    Searches every query in the BM25 index of the collection, adding the chunks it finds to documents,
+    which holds the chunks already retrieved keyed by ID. \n
+    The index knows nothing about metadata, so with a where clause only its top hits are checked against the clause,
+    k * BM25_FILTER_OVERFETCH of them per query at first, and more only for the queries left with fewer than k,
+    never every chunk the clause matches.
+
+    Returns
+    -------
+    The ranking of every query, a list of at most k chunk IDs, the best first.
+    """
+    collection = chroma_db._collection
+    bm25_index = get_bm25_index(collection.name)
+    # The vector search only returns chunks that match the where clause, so those need no check
+    checked_ids = set(documents)
+    hits_per_query = k if where is None else k * BM25_FILTER_OVERFETCH
+    rankings = [[] for _ in queries]
+    searched = range(len(queries))
+
+    while searched:
+        hits = {index: [chunk_id for chunk_id, _ in bm25_index.search(queries[index], hits_per_query)] for index in searched}
+
+        # Chunks only the BM25 index found still need their text and metadata, and the ones not matching the clause are dropped
+        unchecked_ids = list({chunk_id for chunk_ids in hits.values() for chunk_id in chunk_ids} - checked_ids)
+        if unchecked_ids:
+            stored_chunks = collection.get(ids=unchecked_ids, where=where, include=["documents", "metadatas"])
+            for doc_id, text, metadata in zip(stored_chunks["ids"], stored_chunks["documents"], stored_chunks["metadatas"]):
+                documents[doc_id] = Document(id=doc_id, page_content=text, metadata=metadata or {})
+            checked_ids.update(unchecked_ids)
+
+        for index in searched:
+            rankings[index] = [chunk_id for chunk_id in hits[index] if chunk_id in documents][:k]
+        # A query whose hits were all looked at has no more to give
+        searched = [index for index in searched if len(rankings[index]) < k and len(hits[index]) == hits_per_query]
+        hits_per_query *= BM25_FILTER_OVERFETCH
+
+    return rankings
+
+def expand_to_parents(retrieved_docs: list, chroma_db: Chroma, max_parent_tokens: int = CONTEXT_MAX_PASSAGE_TOKENS) -> list:
+    """
+    Swaps retrieved small-to-big child chunks, see iter_small_to_big_chunks, for their parent sections. \n
+    All the children of one parent become one passage, scored with the sum of their scores. A parent of at most
+    max_parent_tokens is returned whole, a longer one is cut down to its matched children, with children that are next
+    to each other in the parent merged into one run of text. Chunks that have no parent are kept as they are.
+
+    Returns
+    -------
+    A list of (document, score) pairs sorted from the most to the least relevant.
+    """
+    passages = []
+    children_by_parent = {}
+    for doc, score in retrieved_docs:
+        parent_id = doc.metadata.get("parent_id")
+        if parent_id is None:
+            passages.append((doc, score))
+        else:
+            children_by_parent.setdefault(parent_id, []).append((doc, score))
+    if not children_by_parent:
+        return retrieved_docs
+
+    parent_texts = get_parent_store(chroma_db._collection.name).get(list(children_by_parent))
+    for parent_id, children in children_by_parent.items():
+        metadata = {key: value for key, value in children[0][0].metadata.items() if key not in CHILD_METADATA_KEYS}
+        text = get_parent_passage(parent_texts.get(parent_id), [child for child, _ in children], max_parent_tokens)
+        passages.append((Document(id=parent_id, page_content=text, metadata=metadata), sum(score for _, score in children)))
+
+    log.info(f"INFO: Expanded {sum(len(children) for children in children_by_parent.values())} child chunks "
+             f"into {len(children_by_parent)} parent sections")
+    return sorted(passages, key=lambda match: match[1], reverse=True)
+
+def get_parent_passage(parent_text: str | None, children: list, max_parent_tokens: int) -> str:
+    """
+    Returns the parent text if it has at most max_parent_tokens, otherwise the runs of text the children cover in it
+    in the order they appear, separated by an ellipsis line.
+    """
+    children = sorted(children, key=lambda child: child.metadata["child_start"])
+    if parent_text is None:
+        # Only the children are left if the parent store lost their parent
+        return "\n".join(child.page_content for child in children)
+    if estimate_tokens(parent_text) <= max_parent_tokens:
+        return parent_text
+
+    runs = []
+    for child in children:
+        start, end = child.metadata["child_start"], child.metadata["child_end"]
+        # Children are split on whitespace, so only whitespace separates two that are next to each other
+        if runs and not parent_text[runs[-1][1]:start].strip():
+            runs[-1][1] = max(runs[-1][1], end)
+        else:
+            runs.append([start, end])
+    return "\n...\n".join(parent_text[start:end] for start, end in runs)
+
+def reciprocal_rank_fusion(rankings: list, rrf_k: int = RRF_K) -> list:
+    """
+    Fuses rankings of document IDs, every ranking adds 1 / (rrf_k + rank) to the score of each of its documents.
+
+    Returns
+    -------
+    A list of (document ID, fused score) pairs, the highest score first.
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, start=1):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1 / (rrf_k + rank)
+
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+def merge_retrieved_documents(*retrieved_lists: list) -> list:
+    """
+    Merges lists of (document, fused score) pairs, keeping each document once with its scores added up,
+    the same as if all their rankings had been fused together.
+
+    Returns
+    -------
+    A list of (document, fused score) pairs sorted from the most to the least relevant.
+    """
+    merged_matches = {}
+    for retrieved_docs in retrieved_lists:
+        for doc, score in retrieved_docs:
+            merged_doc, merged_score = merged_matches.get(doc.id, (doc, 0.0))
+            merged_matches[doc.id] = (merged_doc, merged_score + score)
+
+    return sorted(merged_matches.values(), key=lambda match: match[1], reverse=True)
 
 def get_document_count(chroma_db: Chroma) -> int:
     try:
         collection = chroma_db._collection
         count = collection.count()
         
-        print(f"Total documents in collection {collection.name} is {count}")
+        log.info(f"Total documents in collection {collection.name} is {count}")
         return count
     except AttributeError:
         log.error("Failed to access Chroma collection count. Ensure the Chroma object is correctly initialized.")
         return 0
     except Exception as e:
-        print(f"error in getting document count: {e}")
+        log.error(f"Failed to get the document count: {e}")
         return 0
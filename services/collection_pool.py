@@ -0,0 +1,240 @@
+import asyncio
+from chromadb.errors import NotFoundError
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass
+from fastapi import HTTPException
+from langchain_chroma import Chroma
+from services.chroma_db_service import CHROMA_DB_DIRECTORY, connect_to_chroma_db, disconnect_chroma_db, list_collection_names, release_chroma_db
+from services.ingestion_manifest import IngestionManifest, get_manifest_path
+from services.vector_store_lifecycle import check_vector_store
+import threading
+from typing import AsyncIterator, Iterator
+from utils.logger import log
+from utils.utils import get_envvar
+
+ENV_MAX_OPEN_COLLECTIONS = "MAX_OPEN_COLLECTIONS"
+
+# How long maintenance waits for the requests using a collection to finish before it gives up
+CLOSE_WAIT_SECONDS = 30
+
+@dataclass(eq=False)
+class OpenCollection:
+    """
+    A chroma DB collection and the ingestion manifest of the documents stored in it.
+    """
+    name: str
+    chroma_db: Chroma
+    ingestion_manifest: IngestionManifest
+    users: int = 0
+
+class CollectionPool:
+    """
+    Opens chroma DB collections the first time they are used and keeps up to max_open of them open. \n
+    Past that the least recently used collection nobody is using is closed, which drops it, its BM25 index, its parent store
+    and its manifest from memory. Collections are opened under a lock of their own, so loading one never holds up
+    requests for the others. They are checked against their manifest (see check_vector_store) by check_collections,
+    when the server starts and after a restore, never on the way to answering a request.
+    """
+
+    def __init__(self, max_open: int, persist_directory: str = CHROMA_DB_DIRECTORY):
+        self.max_open = max_open
+        self.persist_directory = persist_directory
+        self._collections = OrderedDict()
+        # Guards the pool itself and is only held for bookkeeping, never while a collection is loaded or closed
+        self._lock = threading.Lock()
+        # One lock per collection name, held while that collection is loaded so it is only loaded once
+        self._open_locks = {}
+        # Number of collections being loaded or listed right now
+        self._opening = 0
+        # Number of idle collections taken out of the pool that are still being disconnected
+        self._closing = 0
+        # Signalled whenever a request stops using a collection or a collection finishes loading or closing
+        self._released = threading.Condition(self._lock)
+        # Set while the files of chroma DB are copied or replaced, no collection may be opened then
+        self._maintenance = False
+        log.info(f"Collection pool started with room for {max_open} open collections")
+
+    @contextmanager
+    def open(self, collection_name: str, create: bool = False) -> Iterator[OpenCollection]:
+        """
+        Opens the collection for the duration of the block, it is not closed while the block runs. \n
+        Fails with 404 if the collection does not exist, unless create is True.
+        """
+        collection = self._acquire(collection_name, create)
+        try:
+            yield collection
+        finally:
+            self._release(collection)
+
+    @asynccontextmanager
+    async def open_async(self, collection_name: str, create: bool = False) -> AsyncIterator[OpenCollection]:
+        """
+        Same as open, for async handlers. Loading and closing collections happen in a worker thread,
+        so they never block the event loop.
+        """
+        collection = await asyncio.to_thread(self._acquire, collection_name, create)
+        try:
+            yield collection
+        finally:
+            await asyncio.to_thread(self._release, collection)
+
+    @contextmanager
+    def closed(self, timeout: float = CLOSE_WAIT_SECONDS) -> Iterator[list]:
+        """
+        Closes every collection and keeps them closed for the duration of the block, used while the files of chroma DB
+        are copied or replaced. \n
+        Opening a collection fails with 503 from the moment it is called. Collections still in use, being loaded or
+        being closed are waited on for up to timeout seconds, past that it fails with 409 and leaves them open.
+
+        Returns
+        -------
+        The names of the collections that were open.
+        """
+        with self._lock:
+            self._maintenance = True
+            try:
+                if not self._released.wait_for(lambda: not self._opening and not self._closing and not any(collection.users for collection in self._collections.values()), timeout):
+                    raise HTTPException(status_code=409, detail="Collections are still being used by other requests, try again once they finish")
+                closed_collections = list(self._collections.values())
+                self._collections.clear()
+                for collection in closed_collections:
+                    disconnect_chroma_db(collection.chroma_db)
+                release_chroma_db()
+            except BaseException:
+                self._maintenance = False
+                raise
+        try:
+            yield [collection.name for collection in closed_collections]
+        finally:
+            with self._lock:
+                self._maintenance = False
+
+    def check_collections(self) -> dict:
+        """
+        Checks every stored collection against its ingestion manifest, repairing what a crash left behind.
+        Run when the server starts and inside closed after a restore, before requests use the collections.
+        Each collection is loaded on its own for the check and is not left open in the pool.
+
+        Returns
+        -------
+        The report of check_vector_store, keyed by collection name.
+        """
+        reports = {}
+        for collection_name in list_collection_names(self.persist_directory):
+            collection = self._load(collection_name, create=False)
+            try:
+                reports[collection_name] = check_vector_store(collection.chroma_db, collection.ingestion_manifest)
+            finally:
+                disconnect_chroma_db(collection.chroma_db)
+        return reports
+
+    def list_collections(self) -> list:
+        """
+        Returns the names of the collections stored in chroma DB. Fails with 503 while the collections are closed for maintenance.
+        """
+        with self._lock:
+            self._check_available()
+            self._opening += 1
+        try:
+            return list_collection_names(self.persist_directory)
+        finally:
+            with self._lock:
+                self._opening -= 1
+                self._released.notify_all()
+
+    def close_all(self) -> None:
+        """
+        Closes every collection, even the ones still in use, used when the server shuts down.
+        """
+        with self._lock:
+            closed_collections = list(self._collections.values())
+            self._collections.clear()
+        for collection in closed_collections:
+            if collection.users:
+                log.warning(f"Closing collection {collection.name} while it is used by {collection.users} requests")
+            disconnect_chroma_db(collection.chroma_db)
+
+    def get_open_collections(self) -> list:
+        """
+        Returns the names of the open collections, the least recently used first.
+        """
+        with self._lock:
+            return list(self._collections)
+
+    def _check_available(self) -> None:
+        if self._maintenance:
+            raise HTTPException(status_code=503, detail="Collections are closed while a snapshot is taken or restored, try again shortly")
+
+    def _acquire(self, collection_name: str, create: bool) -> OpenCollection:
+        while True:
+            with self._lock:
+                self._check_available()
+                collection = self._collections.get(collection_name)
+                if collection is not None:
+                    self._collections.move_to_end(collection_name)
+                    collection.users += 1
+                    return collection
+                open_lock = self._open_locks.setdefault(collection_name, threading.Lock())
+
+            with open_lock:
+                with self._lock:
+                    self._check_available()
+                    # Another request may have loaded it while we were waiting on the lock
+                    if collection_name in self._collections:
+                        continue
+                    self._opening += 1
+
+                try:
+                    collection = self._load(collection_name, create)
+                finally:
+                    with self._lock:
+                        self._opening -= 1
+                        self._released.notify_all()
+
+                with self._lock:
+                    self._collections[collection_name] = collection
+                    collection.users += 1
+                    idle_collections = self._pop_idle()
+            self._disconnect(idle_collections)
+            return collection
+
+    def _load(self, collection_name: str, create: bool) -> OpenCollection:
+        try:
+            chroma_db = connect_to_chroma_db(collection_name, self.persist_directory, create=create)
+        except NotFoundError:
+            raise HTTPException(status_code=404, detail=f"Collection {collection_name} not found")
+        return OpenCollection(collection_name, chroma_db, IngestionManifest(get_manifest_path(collection_name)))
+
+    def _release(self, collection: OpenCollection) -> None:
+        with self._lock:
+            collection.users -= 1
+            idle_collections = self._pop_idle()
+            self._released.notify_all()
+        self._disconnect(idle_collections)
+
+    def _pop_idle(self) -> list:
+        idle_names = [name for name, collection in self._collections.items() if not collection.users]
+        idle_collections = [self._collections.pop(name) for name in idle_names[:max(0, len(self._collections) - self.max_open)]]
+        # Counted until they are disconnected, so closed never copies their files while they are still being written
+        self._closing += len(idle_collections)
+        return idle_collections
+
+    def _disconnect(self, collections: list) -> None:
+        for collection in collections:
+            try:
+                # Loading the collection again waits until its BM25 index and parent store are closed
+                with self._open_locks[collection.name]:
+                    disconnect_chroma_db(collection.chroma_db)
+                log.info(f"Closed idle collection {collection.name}")
+            finally:
+                with self._lock:
+                    self._closing -= 1
+                    self._released.notify_all()
+
+def create_collection_pool() -> CollectionPool:
+    """
+    Creates the collection pool from the environment configuration.
+    """
+    max_open = int(get_envvar(ENV_MAX_OPEN_COLLECTIONS, "8"))
+    return CollectionPool(max_open)
@@ -0,0 +1,104 @@
+import math
+import re
+from utils.logger import log
+from utils.utils import get_envvar
+
+ENV_CONTEXT_TOKEN_BUDGET = "CONTEXT_TOKEN_BUDGET"
+ENV_CONTEXT_MAX_PASSAGE_TOKENS = "CONTEXT_MAX_PASSAGE_TOKENS"
+ENV_CONTEXT_DUPLICATE_THRESHOLD = "CONTEXT_DUPLICATE_THRESHOLD"
+
+# Most tokens the retrieved passages may take up in the prompt
+CONTEXT_TOKEN_BUDGET = int(get_envvar(ENV_CONTEXT_TOKEN_BUDGET, "3000"))
+# Most tokens a single passage may take up, so one whole layout section cannot fill the budget on its own
+CONTEXT_MAX_PASSAGE_TOKENS = int(get_envvar(ENV_CONTEXT_MAX_PASSAGE_TOKENS, "800"))
+# Share of a passage that may already be in the context before the passage is dropped as a duplicate
+CONTEXT_DUPLICATE_THRESHOLD = float(get_envvar(ENV_CONTEXT_DUPLICATE_THRESHOLD, "0.8"))
+
+# Rough characters per token of English text for Gemini and most BPE tokenizers, no tokenizer is loaded to count exactly
+CHARS_PER_TOKEN = 4
+
+# Passages with less room left than this are not worth trimming down to fit
+MIN_PASSAGE_TOKENS = 32
+
+# Shorter sentences, such as "Yes!" or a bare number, are too common to say anything about duplication
+MIN_DUPLICATE_SEGMENT_CHARS = 20
+
+# Sentence ends and line breaks, captured so a trimmed passage keeps its markdown layout
+SEGMENT_BOUNDARY = re.compile(r"((?<=[.?!])\s+|\n+)")
+
+def estimate_tokens(text: str) -> int:
+    """
+    Estimates the number of tokens in the text from its length.
+    """
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+def pack_context(passages: list, token_budget: int = CONTEXT_TOKEN_BUDGET, max_passage_tokens: int = CONTEXT_MAX_PASSAGE_TOKENS,
+                 duplicate_threshold: float = CONTEXT_DUPLICATE_THRESHOLD) -> list:
+    """
+    Packs re-ranked passages into the context, the most relevant first, until token_budget is used up. \n
+    Passages are split into sentences and lines. Those already in the context are left out, so overlapping chunks are only
+    sent once, and a passage that is mostly (duplicate_threshold) in the context already is dropped altogether.
+    What is left of a passage is cut at a sentence or line to fit max_passage_tokens and the rest of the budget.
+
+    Returns
+    -------
+    A list of (index of the passage, packed text) pairs, in the order of the passages.
+    """
+    packed = []
+    seen_segments = set()
+    used_tokens = 0
+    duplicates = 0
+    trimmed = 0
+
+    for index, (text, _) in enumerate(passages):
+        remaining_tokens = token_budget - used_tokens
+        if remaining_tokens < MIN_PASSAGE_TOKENS:
+            break
+
+        parts = SEGMENT_BOUNDARY.split(text)
+        segments = [(parts[i], parts[i + 1] if i + 1 < len(parts) else "") for i in range(0, len(parts), 2)]
+        new_segments = [(segment, separator) for segment, separator in segments if get_segment_key(segment) not in seen_segments]
+
+        total_chars = sum(len(segment) for segment, _ in segments)
+        new_chars = sum(len(segment) for segment, _ in new_segments)
+        if total_chars == 0 or new_chars < total_chars * (1 - duplicate_threshold):
+            duplicates += 1
+            continue
+
+        passage_tokens = min(remaining_tokens, max_passage_tokens)
+        kept_segments = []
+        tokens = 0
+        for segment, separator in new_segments:
+            segment_tokens = estimate_tokens(segment + separator)
+            if tokens + segment_tokens > passage_tokens:
+                break
+            kept_segments.append(segment + separator)
+            tokens += segment_tokens
+
+        if len(kept_segments) < len(new_segments):
+            trimmed += 1
+        if not kept_segments:
+            # A single sentence or line longer than the room left, cut it at the last word that fits
+            segment = new_segments[0][0][:passage_tokens * CHARS_PER_TOKEN].rsplit(" ", 1)[0]
+            kept_segments = [segment]
+            tokens = estimate_tokens(segment)
+
+        packed_text = "".join(kept_segments).strip()
+        if not packed_text:
+            continue
+        seen_segments.update(get_segment_key(segment) for segment in kept_segments)
+        seen_segments.discard(None)
+        packed.append((index, packed_text))
+        used_tokens += tokens
+
+    log.info(f"Packed {len(packed)} of {len(passages)} passages into {used_tokens} of {token_budget} context tokens, "
+             f"{duplicates} dropped as duplicates, {trimmed} trimmed")
+
+    return packed
+
+def get_segment_key(segment: str) -> str | None:
+    """
+    Normalizes a sentence or line for spotting it again in another passage, None if it is too short to count.
+    """
+    key = " ".join(segment.split()).lower()
+    return key if len(key) >= MIN_DUPLICATE_SEGMENT_CHARS else None
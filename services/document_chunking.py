@@ -2,20 +2,41 @@ from fastapi import HTTPException
 from langchain_core.documents import Document
 from langchain_community.document_loaders import PyPDFLoader
 from langchain_core.documents import Document
-from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_pymupdf4llm import PyMuPDF4LLMLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter, MarkdownHeaderTextSplitter
 import numpy as np
 from pathlib import Path
 import re
-from sklearn.metrics.pairwise import cosine_similarity
-import time
+from services.embedding_service import get_embedding_model
+from services.parent_store import PARENT_TEXT, get_parent_id
+from services.pdf_parsing import (clean_text, extract_page_range, extract_page_range_as_markdown, get_page_ranges,
+                                  get_pdf_parse_settings, iter_pages_in_parallel)
+from typing import Callable, Iterable, Iterator
 from utils.logger import log
+from utils.metrics import time_stage
 from utils.utils import get_envvar
 
-ENV_HUGGINGFACE_EMBEDDING_MODEL = "HUGGINGFACE_EMBEDDING_MODEL"
+ENV_CHILD_CHUNK_SIZE = "CHILD_CHUNK_SIZE"
 
-def read_pdf_document(document_path: str) -> str:
+# Sentences are split on whitespace that follows a full stop, question mark or exclamation mark
+SENTENCE_BOUNDARY = re.compile(r'(?<=[.?!])\s+')
+
+# Longest run of text kept as one sentence, text without sentence endings is cut into pieces of at most this many characters
+SENTENCE_MAX_CHARACTERS = 2000
+
+# Number of sentences semantic chunking embeds and splits at a time
+SEMANTIC_WINDOW_SENTENCES = 1000
+
+# A line the markdown splitter treats as a header, "#", "##" or "###" followed by a space or the end of the line
+MARKDOWN_HEADER_LINE = re.compile(r"^[ \t]*(#{1,3})(?: |$)", re.MULTILINE)
+
+# A line that opens or closes a code block in markdown, the fence and the rest of the line
+CODE_FENCE_LINE = re.compile(r"^[ \t]*(```|~~~)(.*)$", re.MULTILINE)
+
+# Longest section layout chunking keeps in memory, a longer one is yielded in parts that share its headers
+LAYOUT_SECTION_MAX_CHARACTERS = 20000
+
+def read_pdf_document(document_path: str) -> list:
     """
     Reads the PDF document based on the document path.
 
@@ -23,6 +44,18 @@ def read_pdf_document(document_path: str) -> str:
     -------
     A list of langchain document objects.
     """
+    return list(iter_pdf_pages(document_path))
+
+def iter_pdf_pages(document_path: str, min_pages_per_worker: int | None = None) -> Iterator[Document]:
+    """
+    Lazily reads the PDF document page by page, so only a few pages are held in memory at a time. \n
+    Large documents are split into page ranges that are extracted and cleaned in the PDF parsing processes,
+    see PDF_PARSE_WORKERS and PDF_PARSE_MIN_PAGES_PER_WORKER, which min_pages_per_worker overrides.
+
+    Returns
+    -------
+    A generator of cleaned langchain document objects, one per page, in page order.
+    """
     path = Path(document_path)
 
     # If the path is not absolute, make it absolute
@@ -30,29 +63,31 @@ def read_pdf_document(document_path: str) -> str:
         path = path.resolve()
     try:
         loader = PyPDFLoader(str(path))
-        raw_docs = loader.load()
-        # Clean the text for each document/page
-        cleaned_docs = []
-        for doc in raw_docs:
-            cleaned_content = clean_text(doc.page_content)
-            cleaned_doc = Document(
-                page_content=cleaned_content,
-                metadata=doc.metadata
-            )
-            cleaned_docs.append(cleaned_doc)
-
-        return cleaned_docs
     except ValueError as value_err:
         log.error(f"File path {document_path} is invalid or the file cannot be found")
         raise HTTPException(status_code=400, detail="Invalid file path or file cannot be found")
+
+    # Pages extracted in parallel are cleaned in the parsing processes, the ones read here are cleaned as they come
+    yield from iter_pages(loader, extract_page_range, str(path), clean_text, min_pages_per_worker)
     
-def read_pdf_document_into_markdown(document_path: str) -> str:
+def read_pdf_document_into_markdown(document_path: str) -> list:
     """
     Reads the PDF document based on the document path and converts it into markdown format.
 
     Returns
     -------
-    A string containing the markdown representation of the PDF.
+    A list of langchain document objects containing the markdown representation of the PDF.
+    """
+    return list(iter_pdf_pages_as_markdown(document_path))
+
+def iter_pdf_pages_as_markdown(document_path: str, min_pages_per_worker: int | None = None) -> Iterator[Document]:
+    """
+    Lazily reads the PDF document page by page and converts each page into markdown format. \n
+    Large documents are converted in the PDF parsing processes, like in iter_pdf_pages.
+
+    Returns
+    -------
+    A generator of langchain document objects, one per page.
     """
     path = Path(document_path)
 
@@ -60,24 +95,49 @@ def read_pdf_document_into_markdown(document_path: str) -> str:
     if (not path.is_absolute()):
         path = path.resolve()
     try:
-        loader = PyMuPDF4LLMLoader(str(path))
-        return loader.load()
+        loader = PyMuPDF4LLMLoader(str(path), mode="page")
     except ValueError as value_err:
         log.error(f"File path {document_path} is invalid or the file cannot be found")
         raise HTTPException(status_code=400, detail="Invalid file path or file cannot be found")
 
-def clean_text(text: str) -> str:
+    yield from iter_pages(loader, extract_page_range_as_markdown, str(path), min_pages_per_worker=min_pages_per_worker)
+
+def iter_pages(loader, extract_range: Callable, document_path: str, clean: Callable | None = None,
+               min_pages_per_worker: int | None = None) -> Iterator[Document]:
     """
-    Light text cleaning for PDF content.
-    Removes HTML, URLs, extra whitespace, and non-printable characters.
+    Reads the first page with the loader, then the rest with the loader as well for short documents,
+    or in parallel page ranges for long ones. The first page gives the document metadata every page shares. \n
+    clean is applied to the pages read with the loader and timed as the clean stage, extract_range is expected to clean
+    its pages itself and send back its timings, see iter_pages_in_parallel.
     """
-    text = re.sub(r"<[^>]+>", " ", text)              # remove HTML
-    text = re.sub(r"http\S+|www\.\S+", "", text)      # remove URLs
-    text = re.sub(r"\[[0-9]*\]", "", text)            # remove citation marks [1], [2]
-    text = re.sub(r"\s+", " ", text)                  # collapse multiple spaces/newlines
-    text = text.replace("\u2212", "-")
-    text = re.sub(r"[^\x20-\x7E]", "", text)          # remove non-ASCII characters
-    return text.strip()
+    def read_with_loader(documents: Iterable) -> Iterator[Document]:
+        for doc in documents:
+            if clean is None:
+                yield doc
+                continue
+            with time_stage("clean"):
+                page_content = clean(doc.page_content)
+            yield Document(page_content=page_content, metadata=doc.metadata)
+
+    pages = loader.lazy_load()
+    first_page = next(pages, None)
+    if first_page is None:
+        return
+    yield from read_with_loader([first_page])
+
+    workers, default_min_pages_per_worker = get_pdf_parse_settings()
+    if min_pages_per_worker is None:
+        min_pages_per_worker = default_min_pages_per_worker
+    page_ranges = get_page_ranges(1, first_page.metadata["total_pages"], workers, min_pages_per_worker)
+    if not page_ranges:
+        yield from read_with_loader(pages)
+        return
+
+    # Stops the loader, PyMuPDF4LLMLoader holds a lock shared by every document until it is done
+    pages.close()
+    log.info(f"Parsing {document_path} in {len(page_ranges)} page ranges with {workers} processes")
+    for page_content, page_metadata in iter_pages_in_parallel(extract_range, document_path, page_ranges):
+        yield Document(page_content=page_content, metadata={**first_page.metadata, **page_metadata})
 
 def native_chunking(documents: list) -> list:
     """
@@ -87,89 +147,127 @@ def native_chunking(documents: list) -> list:
     -------
     Returns a list of documents but are smaller in text length than the original document list.
     """
+    log.info("Chunking process has begun")
+
+    with time_stage("chunk") as timer:
+        base_chunks = list(iter_native_chunks(documents))
+
+    log.info(f"Chunking process completed, took {timer.seconds:.4f} seconds")
+    
+    return base_chunks
+
+def iter_native_chunks(pages: Iterable) -> Iterator[Document]:
+    """
+    Streaming version of native_chunking, every page is split as soon as it is read.
+    """
     splitter = RecursiveCharacterTextSplitter(
         chunk_size=512,
         chunk_overlap=0,
         separators=["\n\n", "\n", " ", "."],
     )
-    log.info("Chunking process has begun")
-    start = time.perf_counter()
+    for page in pages:
+        for chunk in splitter.split_documents([page]):
+            chunk.metadata = get_chunk_metadata(page.metadata, page.metadata)
+            yield chunk
 
-    base_chunks = splitter.split_documents(documents)
+def get_chunk_metadata(first_page: dict, last_page: dict, headers: dict | None = None) -> dict:
+    """
+    Returns the metadata every chunking strategy gives its chunks: the document metadata of the page the chunk starts on,
+    such as source, the pages it spans as page_start and page_end, and the headers it sits under, one per level as
+    layout chunking names them and joined into section, which is empty when there are none.
+    """
+    headers = headers or {}
+    metadata = {**first_page, **headers, "section": " > ".join(headers[name] for name in sorted(headers))}
+    if "page" in first_page and "page" in last_page:
+        metadata.update(page_start=first_page["page"], page_end=last_page["page"])
+    return metadata
 
-    end = time.perf_counter()
-    log.info(f"Chunking process completed, took {end - start:.4f} seconds")
-    
-    return base_chunks
+def get_page_at(page_starts: list, position: int) -> dict:
+    """
+    Returns the metadata of the page that the character at the position of a text made of several pages comes from,
+    page_starts holding the offset every page starts at and its metadata.
+    """
+    return next((metadata for offset, metadata in reversed(page_starts) if offset <= position), page_starts[0][1])
 
-def get_embedding_model() -> HuggingFaceEmbeddings:
+def drop_page_starts(page_starts: list, start: int) -> list:
     """
-    Returns the embedding model.
+    Returns the page starts of the text from start onwards, dropping the pages that end before it.
     """
-    huggingface_embedding_model = get_envvar(ENV_HUGGINGFACE_EMBEDDING_MODEL)
-    embeddings = HuggingFaceEmbeddings(model_name=huggingface_embedding_model)
-    return embeddings
+    return [(max(0, offset - start), metadata) for index, (offset, metadata) in enumerate(page_starts)
+            if index + 1 == len(page_starts) or page_starts[index + 1][0] > start]
 
 
 #################################
 ### SEMANTIC CHUNKING STUFF
 #################################
 
-# Assuming you have a function to get your embedding model
-# from your_embedding_module import get_embedding_model
+def combine_sentences(sentences: list, buffer_size: int = 1) -> list:
+    """
+    Joins every sentence with the buffer_size sentences before and after it, giving the embedding model more context.
 
-def combine_sentences(sentences, buffer_size=1):
-    # Go through each sentence dict
-    for i in range(len(sentences)):
+    Returns
+    -------
+    A list of combined sentences, one per input sentence.
+    """
+    return [" ".join(sentences[max(0, i - buffer_size):i + buffer_size + 1])
+            for i in range(len(sentences))]
 
-        # Create a string that will hold the sentences which are joined
-        combined_sentence = ''
+def calculate_cosine_distances(embeddings: np.ndarray) -> np.ndarray:
+    """
+    Calculates the cosine distance between every pair of adjacent rows in one batched row-wise dot product.
 
-        # Add sentences before the current one, based on the buffer size.
-        for j in range(i - buffer_size, i):
-            # Check if the index j is not negative (to avoid index out of range like on the first one)
-            if j >= 0:
-                # Add the sentence at index j to the combined_sentence string
-                combined_sentence += sentences[j]['sentence'] + ' '
+    Returns
+    -------
+    An array of length len(embeddings) - 1 where element i is the distance between row i and row i + 1.
+    """
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    # Zero vectors stay zero instead of turning into NaNs, same as sklearn's cosine_similarity
+    normalized = embeddings / np.maximum(norms, np.finfo(embeddings.dtype).tiny)
+    similarities = np.einsum("ij,ij->i", normalized[:-1], normalized[1:])
+    return 1 - similarities
 
-        # Add the current sentence
-        combined_sentence += sentences[i]['sentence']
+def find_breakpoints(distances: np.ndarray, breakpoint_percentile_threshold: float = 60) -> np.ndarray:
+    """
+    Finds the indices of the distances that are above the given percentile. \n
+    A breakpoint at index i means a chunk ends after sentence i.
+    """
+    if distances.size == 0:
+        return np.empty(0, dtype=np.intp)
 
-        # Add sentences after the current one, based on the buffer size
-        for j in range(i + 1, i + 1 + buffer_size):
-            # Check if the index j is within the range of the sentences list
-            if j < len(sentences):
-                # Add the sentence at index j to the combined_sentence string
-                combined_sentence += ' ' + sentences[j]['sentence']
+    # If you want more chunks, lower the percentile cutoff
+    breakpoint_distance_threshold = np.percentile(distances, breakpoint_percentile_threshold)
+    return np.flatnonzero(distances > breakpoint_distance_threshold)
 
-        # Then add the whole thing to your dict
-        # Store the combined sentence in the current sentence dict
-        sentences[i]['combined_sentence'] = combined_sentence
+def group_sentences(sentences: list, breakpoints: np.ndarray, max_sentences_per_chunk: int) -> list:
+    """
+    Groups the sentences into chunks that end on the breakpoints, splitting groups that are longer than max_sentences_per_chunk.
 
-    return sentences
+    Returns
+    -------
+    A list of chunk strings.
+    """
+    return [" ".join(sentences[start:end]) for start, end in get_chunk_ranges(len(sentences), breakpoints, max_sentences_per_chunk)]
 
-def calculate_cosine_distances(sentences):
-    distances = []
-    for i in range(len(sentences) - 1):
-        embedding_current = sentences[i]['embedding']
-        embedding_next = sentences[i + 1]['embedding']
-        
-        # Calculate cosine similarity
-        similarity = cosine_similarity([embedding_current], [embedding_next])[0][0]
-        
-        # Convert to cosine distance
-        distance = 1 - similarity
+def get_chunk_ranges(sentence_count: int, breakpoints: np.ndarray, max_sentences_per_chunk: int) -> list:
+    """
+    Works out the chunks group_sentences makes.
 
-        # Append cosine distance to the list
-        distances.append(distance)
+    Returns
+    -------
+    A list of (first sentence, last sentence exclusive) index pairs, one per chunk.
+    """
+    group_starts = np.concatenate(([0], breakpoints + 1))
+    group_ends = np.concatenate((breakpoints + 1, [sentence_count]))
 
-        # Store distance in the dictionary
-        sentences[i]['distance_to_next'] = distance
+    # Number of chunks each group is split into, rounded up
+    pieces = -(-(group_ends - group_starts) // max_sentences_per_chunk)
+    first_piece = np.cumsum(pieces) - pieces
+    offsets = np.arange(pieces.sum()) - np.repeat(first_piece, pieces)
 
-    # Optionally handle the last sentence
-    # sentences[-1]['distance_to_next'] = None  # or a default value
+    chunk_starts = np.repeat(group_starts, pieces) + offsets * max_sentences_per_chunk
+    chunk_ends = np.minimum(chunk_starts + max_sentences_per_chunk, np.repeat(group_ends, pieces))
 
-    return distances, sentences
+    return list(zip(chunk_starts.tolist(), chunk_ends.tolist()))
 
 def semantic_chunking(documents: list, max_sentences_per_chunk: int = 6) -> list:
     """
@@ -179,86 +277,145 @@ def semantic_chunking(documents: list, max_sentences_per_chunk: int = 6) -> list
     -------
     Returns a list of documents but are smaller in text length than the original document list.
     """        
-    combined_text = "\n".join(getattr(document, "page_content", str(document))
-                               for document in documents)
-    if not combined_text.strip():
-        # Handle cases with no text content
-        return []
+    with time_stage("chunk") as timer:
+        chunks = list(iter_semantic_chunks(documents, max_sentences_per_chunk))
 
-    single_sentences_list = re.split(r'(?<=[.?!])\s+', combined_text)
-    print(f"{len(single_sentences_list)} sentences were found")
-    
-    sentences = [{'sentence': x, 'index' : i} for i, x in enumerate(single_sentences_list) if x]
-    
-    if not sentences:
-        return []
-
-    sentences = combine_sentences(sentences, buffer_size=1)
+    log.info(f"Semantic chunking completed, took {timer.seconds:.4f} seconds")
+    for i, chunk in enumerate(chunks[:10]):
+        log.debug(f"Semantic chunk #{i} preview: {chunk.page_content.strip()}")
+        
+    return chunks
 
-    # This part is a placeholder. You should have your own embedding model logic.
-    # For demonstration, we'll create dummy embeddings.
-    # In a real scenario, you would use a proper embedding model.
+def iter_semantic_chunks(pages: Iterable, max_sentences_per_chunk: int = 6,
+                         window_sentences: int = SEMANTIC_WINDOW_SENTENCES) -> Iterator[Document]:
+    """
+    Streaming version of semantic_chunking. \n
+    Sentences are embedded and split in windows of window_sentences, the breakpoint threshold is taken per window.
+    The sentences after the last breakpoint of a window are carried over into the next one, so no chunk is cut at a window edge.
+    """
     embedding_model = get_embedding_model()
-    embeddings = embedding_model.embed_documents(
-        [sentence['combined_sentence'] for sentence in sentences])
+    # (sentence, page it starts on, page it ends on) of the sentences that are not in a chunk yet
+    window = []
+
+    for sentence in iter_sentences(pages):
+        window.append(sentence)
+        if len(window) >= window_sentences:
+            chunk_ranges, chunked = split_semantic_window([sentence for sentence, _, _ in window], max_sentences_per_chunk,
+                                                          embedding_model, is_last_window=False)
+            yield from make_semantic_chunks(window, chunk_ranges)
+            window = window[chunked:]
+
+    if window:
+        chunk_ranges, _ = split_semantic_window([sentence for sentence, _, _ in window], max_sentences_per_chunk,
+                                                embedding_model, is_last_window=True)
+        yield from make_semantic_chunks(window, chunk_ranges)
+
+def make_semantic_chunks(window: list, chunk_ranges: list) -> Iterator[Document]:
+    """
+    Joins the sentences of every chunk, giving it the pages from the one its first sentence starts on to the one its last ends on.
+    """
+    for start, end in chunk_ranges:
+        yield Document(
+            page_content=" ".join(sentence for sentence, _, _ in window[start:end]),
+            metadata=get_chunk_metadata(window[start][1], window[end - 1][2]),
+        )
 
-    for i, sentence in enumerate(sentences):
-        sentence['embedding'] = embeddings[i]
-        
-    distances, sentences = calculate_cosine_distances(sentences)
+def iter_sentences(pages: Iterable, max_sentence_characters: int = SENTENCE_MAX_CHARACTERS) -> Iterator[tuple]:
+    """
+    Splits the pages into sentences as they are read, giving the same sentences as splitting all the pages joined by new lines,
+    except that sentences longer than max_sentence_characters are cut, see cut_sentence. \n
+    Only the text of the new page is searched for sentence endings, and text without one, such as tables or code listings,
+    is cut as it grows, so the unfinished sentence carried over to the next page never gets longer than the limit.
 
-    # We need to get the distance threshold that we'll consider an outlier
-    # We'll use numpy .percentile() for this
-    breakpoint_percentile_threshold = 60
-    breakpoint_distance_threshold = np.percentile(distances, breakpoint_percentile_threshold) # If you want more chunks, lower the percentile cutoff
+    Returns
+    -------
+    A generator of (sentence, metadata of the page it starts on, metadata of the page it ends on) tuples.
+    """
+    unfinished_text = None
+    # Offset every page still in the text starts at, and its metadata
+    page_starts = []
+    # Where the search for sentence endings picks up, the unfinished text has none before it
+    search_start = 0
+    for page in pages:
+        text = getattr(page, "page_content", str(page))
+        metadata = getattr(page, "metadata", {})
+        if unfinished_text is not None:
+            page_starts.append((len(unfinished_text) + 1, metadata))
+            text = unfinished_text + "\n" + text
+        else:
+            page_starts = [(0, metadata)]
+
+        start = 0
+        next_search_start = len(text)
+        for boundary in SENTENCE_BOUNDARY.finditer(text, search_start):
+            # Whitespace at the very end may continue on the next page, so the sentence before it is not finished yet
+            if boundary.end() == len(text):
+                next_search_start = boundary.start()
+                break
+            for sentence_start, sentence_end in cut_sentence(text, start, boundary.start(), max_sentence_characters):
+                yield text[sentence_start:sentence_end], get_page_at(page_starts, sentence_start), get_page_at(page_starts, sentence_end - 1)
+            start = boundary.end()
+
+        # Every piece of the unfinished sentence but the last one is finished
+        *finished, (start, _) = cut_sentence(text, start, len(text), max_sentence_characters) or [(start, len(text))]
+        for sentence_start, sentence_end in finished:
+            yield text[sentence_start:sentence_end], get_page_at(page_starts, sentence_start), get_page_at(page_starts, sentence_end - 1)
+
+        unfinished_text = text[start:]
+        page_starts = drop_page_starts(page_starts, start)
+        search_start = max(0, next_search_start - start)
+
+    if unfinished_text is not None and unfinished_text.strip():
+        start = 0
+        for boundary in [*SENTENCE_BOUNDARY.finditer(unfinished_text, search_start), None]:
+            end = boundary.start() if boundary else len(unfinished_text)
+            for sentence_start, sentence_end in cut_sentence(unfinished_text, start, end, max_sentence_characters):
+                yield unfinished_text[sentence_start:sentence_end], get_page_at(page_starts, sentence_start), get_page_at(page_starts, sentence_end - 1)
+            if boundary:
+                start = boundary.end()
+
+def cut_sentence(text: str, start: int, end: int, max_sentence_characters: int) -> list:
+    """
+    Cuts the sentence from start to end into pieces of at most max_sentence_characters, each at the last space
+    before the limit, or right at the limit when there is no space.
+
+    Returns
+    -------
+    A list of (start, end exclusive) offset pairs, one per piece, empty when the sentence is.
+    """
+    pieces = []
+    while end - start > max_sentence_characters:
+        cut = text.rfind(" ", start + 1, start + max_sentence_characters)
+        if cut == -1:
+            cut = start + max_sentence_characters
+        pieces.append((start, cut))
+        start = cut + (text[cut] == " ")
+    if start < end:
+        pieces.append((start, end))
+    return pieces
+
+def split_semantic_window(sentences: list, max_sentences_per_chunk: int, embedding_model, is_last_window: bool) -> tuple:
+    """
+    Embeds a window of sentences and groups them into chunks on the semantic breakpoints.
 
-    # Then we'll get the index of the distances that are above the threshold. This will tell us where we should split our text
-    indices_above_thresh = [i for i, x in enumerate(distances) if x > breakpoint_distance_threshold] # The indices of those breakpoints on your list
+    Returns
+    -------
+    The (first sentence, last sentence exclusive) index pairs of the chunks and the number of sentences they take up,
+    unless it is the last window the sentences after the last breakpoint still need a chunk.
+    """
+    combined_sentences = combine_sentences(sentences, buffer_size=1)
 
-    # Initialize the start index
-    start_index = 0
+    # One float32 matrix for the whole window, row i is the embedding of combined sentence i
+    embeddings = np.asarray(embedding_model.embed_documents(combined_sentences), dtype=np.float32)
 
-    # Create a list to hold the grouped sentences
-    chunks = []
-    
-    # Find all unique breakpoint indices and sort them.
-    breakpoint_indices = sorted(list(set(indices_above_thresh)))
+    distances = calculate_cosine_distances(embeddings)
+    breakpoints = find_breakpoints(distances)
 
-    # Iterate through the breakpoints to slice the sentences
-    for i, index in enumerate(breakpoint_indices):
-        # The end index is the current breakpoint
-        end_index = index
+    if is_last_window or breakpoints.size == 0:
+        return get_chunk_ranges(len(sentences), breakpoints, max_sentences_per_chunk), len(sentences)
 
-        # Slice the sentence_dicts from the current start index to the end index
-        group = sentences[start_index:end_index + 1]
-        
-        # Further split the group if it's too long
-        for j in range(0, len(group), max_sentences_per_chunk):
-            sub_group = group[j:j + max_sentences_per_chunk]
-            combined_text = ' '.join([d['sentence'] for d in sub_group])
-            chunks.append(combined_text)
-        
-        # Update the start index for the next group
-        start_index = index + 1
-
-    # The last group, if any sentences remain
-    if start_index < len(sentences):
-        remaining_group = sentences[start_index:]
-        for j in range(0, len(remaining_group), max_sentences_per_chunk):
-            sub_group = remaining_group[j:j+max_sentences_per_chunk]
-            combined_text = ' '.join([d['sentence'] for d in sub_group])
-            chunks.append(combined_text)
-
-    # grouped_sentences now contains the chunked sentences
-    
-    for i, chunk in enumerate(chunks[:10]):
-        buffer = 200
-        
-        print (f"Chunk #{i}")
-        print (chunk.strip())
-        print ("\n")
-        
-    return [Document(page_content=chunk) for chunk in chunks]
+    last_breakpoint = int(breakpoints[-1])
+    return get_chunk_ranges(last_breakpoint + 1, breakpoints[:-1], max_sentences_per_chunk), last_breakpoint + 1
 
 ## LAYOUT CHUNKING
 
@@ -270,19 +427,184 @@ def layout_chunking(documents: list) -> list:
     -------
     Returns a list of documents but are smaller in text length than the original document list.
     """
-    # Placeholder for layout-based chunking logic
-    # This would typically involve analyzing the document's layout elements
-    combined_text = "\n".join(getattr(document, "page_content", str(document))
-                               for document in documents)
-    if not combined_text.strip():
-        # Handle cases with no text content
+    log.info("Chunking based on layout structure has begun")
+    
+    with time_stage("chunk") as timer:
+        final_structured_documents = list(iter_layout_chunks(documents))
+    
+    log.info(f"Chunking process completed, took {timer.seconds:.4f} seconds")
+    
+    # Uncomment this to see all the chunks
+    # for document in final_structured_documents:
+    #     log.info(f"Layout-based chunk preview: {document.page_content}")
+    log.info(f"Number of layout-based chunks created: {len(final_structured_documents)}")
+    
+    return final_structured_documents
+
+def iter_layout_chunks(pages: Iterable, max_section_characters: int = LAYOUT_SECTION_MAX_CHARACTERS) -> Iterator[Document]:
+    """
+    Streaming version of layout_chunking. \n
+    Only the text of every new page is searched for header lines. At every header the splitter starts a new section at,
+    the text before it is split and yielded, and the buffer starts again from the header. A section that grows past
+    max_section_characters is split and yielded as it is, and the rest of it carries on under the same headers.
+    """
+    headers_to_split_on = [
+        ("#", "Header 1"),
+        ("##", "Header 2"),
+        ("###", "Header 3"),
+    ]
+
+    markdown_splitter = MarkdownHeaderTextSplitter(
+        headers_to_split_on=headers_to_split_on,
+        strip_headers=False
+    )
+    header_levels = {name: len(separator) for separator, name in headers_to_split_on}
+    header_names = {len(separator): name for separator, name in headers_to_split_on}
+
+    buffered_text = ""
+    # Headers that the start of the buffer sits under, the splitter only sees the buffer so it cannot know them
+    parent_headers = {}
+    # Headers that the end of the buffer sits under, kept up to date from the header lines as they are found
+    headers = {}
+    # Offset every page in the buffer starts at, and its metadata
+    page_starts = []
+    # Fence of the code block the start and the end of the buffer are in, empty when they are not in one
+    start_fence = end_fence = ""
+
+    for page_number, page in enumerate(pages):
+        text = getattr(page, "page_content", str(page))
+        search_start = len(buffered_text)
+        # Same as joining all the pages with new lines
+        page_starts.append((len(buffered_text) + (page_number > 0), getattr(page, "metadata", {})))
+        buffered_text += convert_bold_titles(text if page_number == 0 else "\n" + text)
+
+        section_start = 0
+        lines = [*MARKDOWN_HEADER_LINE.finditer(buffered_text, search_start), *CODE_FENCE_LINE.finditer(buffered_text, search_start)]
+        for line in sorted(lines, key=lambda line: line.start()):
+            if line.re is CODE_FENCE_LINE:
+                end_fence = get_code_fence(line, end_fence)
+                continue
+            # The splitter does not look for headers inside code blocks
+            if end_fence:
+                continue
+
+            header_level = len(line.group(1))
+            line_end = buffered_text.find("\n", line.end())
+            # Named the way the splitter names it, from the rest of the line without the characters that are not printable
+            header_text = "".join(filter(str.isprintable, buffered_text[line.end():line_end if line_end != -1 else None])).strip()
+            line_headers = {name: data for name, data in headers.items() if header_levels[name] < header_level}
+            line_headers[header_names[header_level]] = header_text
+
+            # The splitter carries on with the current section when the header changes nothing
+            if line_headers != headers and starts_section(buffered_text, section_start, line.start()):
+                yield from split_layout_section(markdown_splitter, buffered_text[section_start:line.start()],
+                                                drop_page_starts(page_starts, section_start), parent_headers, header_levels, start_fence)
+                # The headers above the one the new section starts with still apply to it
+                parent_headers = {name: data for name, data in headers.items() if header_levels[name] < header_level}
+                section_start = line.start()
+                start_fence = ""
+            headers = line_headers
+
+        buffered_text = buffered_text[section_start:]
+        page_starts = drop_page_starts(page_starts, section_start)
+
+        if len(buffered_text) > max_section_characters:
+            yield from split_layout_section(markdown_splitter, buffered_text, page_starts, parent_headers, header_levels, start_fence)
+            parent_headers = headers
+            buffered_text = ""
+            page_starts = []
+            start_fence = end_fence
+
+    yield from split_layout_section(markdown_splitter, buffered_text, page_starts, parent_headers, header_levels, start_fence)
+
+def split_layout_section(markdown_splitter: MarkdownHeaderTextSplitter, text: str, page_starts: list, parent_headers: dict,
+                         header_levels: dict, fence: str = "") -> list:
+    """
+    Splits the text with the markdown splitter, adding the parent headers (see add_parent_headers) and the chunk metadata
+    (see add_section_metadata) to the sections. \n
+    fence is the fence of the code block the text starts in, when a long section was cut inside one,
+    so the splitter keeps treating the lines of the block as code.
+    """
+    if not text.strip():
         return []
+    if not fence:
+        documents = markdown_splitter.split_text(text)
+    else:
+        documents = markdown_splitter.split_text(f"{fence}\n{text}")
+        documents[0].page_content = documents[0].page_content.removeprefix(f"{fence}\n")
+    add_parent_headers(documents, parent_headers, header_levels)
+    return add_section_metadata(documents, text, page_starts)
+
+def starts_section(text: str, section_start: int, header_start: int) -> bool:
+    """
+    Tells if the splitter ends the section that starts at section_start at the header line at header_start. \n
+    It does unless the section has nothing before the header or ends with a header line of its own,
+    the splitter merges a section that ends with its header into the section below it.
+    """
+    content_end = header_start
+    while content_end > section_start and text[content_end - 1].isspace():
+        content_end -= 1
+    if content_end == section_start:
+        return False
+    last_line_start = max(section_start, text.rfind("\n", section_start, content_end) + 1)
+    return not text[last_line_start:content_end].lstrip().startswith("#")
+
+def get_code_fence(line: re.Match, fence: str) -> str:
+    """
+    Returns the fence of the code block the text is in after the fence line, the same way the markdown splitter tracks them:
+    ``` opens a block unless it is closed on the same line, ~~~ always does, and a block ends at the fence that opened it.
+    Empty when the text is not in a code block.
+    """
+    if fence:
+        return "" if line.group(1) == fence else fence
+    if line.group(1) == "```":
+        return "```" if "```" not in line.group(2) else ""
+    return line.group(1)
 
+def add_section_metadata(documents: list, text: str, page_starts: list) -> list:
+    """
+    Gives the sections split from the text the chunk metadata, see get_chunk_metadata, with the pages
+    from the one their first line is on to the one their last line is on. \n
+    The splitter strips the lines of a section, so a section starts where its first line is next found in the text
+    and ends where its last line is last found before the next section.
+    """
+    if not page_starts:
+        return documents
+
+    section_lines = [[line.strip() for line in document.page_content.splitlines() if line.strip()] or [""] for document in documents]
+    starts = []
+    for lines in section_lines:
+        start = text.find(lines[0], starts[-1] if starts else 0)
+        starts.append(start if start != -1 else (starts[-1] if starts else 0))
+
+    for index, (document, lines) in enumerate(zip(documents, section_lines)):
+        start = starts[index]
+        end = text.rfind(lines[-1], start, starts[index + 1] if index + 1 < len(starts) else len(text))
+        document.metadata = get_chunk_metadata(get_page_at(page_starts, start), get_page_at(page_starts, max(start, end)),
+                                               document.metadata)
+    return documents
+
+def add_parent_headers(documents: list, parent_headers: dict, header_levels: dict) -> None:
+    """
+    Adds the parent headers to the sections, each one until a header of the same or a higher level replaces it.
+    """
+    highest_level_seen = max(header_levels.values()) + 1
+    for document in documents:
+        highest_level_seen = min([highest_level_seen, *(header_levels[name] for name in document.metadata)])
+        inherited_headers = {name: data for name, data in parent_headers.items() if header_levels[name] < highest_level_seen}
+        if not inherited_headers:
+            break
+        document.metadata = {**inherited_headers, **document.metadata}
+
+def convert_bold_titles(text: str) -> str:
+    """
+    Turns the bold titles that PyMuPDF4LLM produces into markdown headers.
+    """
     # --- REGEX CONVERSIONS ---
     # NOTE: The order is important. Go from most specific to most general.
 
     # 1. Handles formats like **1.2**Title and also ** 1.2 ** Title
-    processed_text = re.sub(r'\n\*\*\s*(\d\.\d)\s*\*\*\s*([^\n]+)', r'\n## \1 \2', combined_text)
+    processed_text = re.sub(r'\n\*\*\s*(\d\.\d)\s*\*\*\s*([^\n]+)', r'\n## \1 \2', text)
 
     # 2. Handles formats like **1**Title and also ** 1 ** Title
     processed_text = re.sub(r'\n\*\*\s*(\d)\s*\*\*\s*([^\n]+)', r'\n# \1 \2', processed_text)
@@ -290,34 +612,32 @@ def layout_chunking(documents: list) -> list:
     # 3. Handle any other bolded titles without numbers like **Introduction**
     processed_text = re.sub(r'\n\*\*\s*(.+?)\s*\*\*', r'\n# \1', processed_text)
 
-    processed_text = processed_text.encode("utf-8", errors="replace").decode()
+    return processed_text.encode("utf-8", errors="replace").decode()
 
-    # log.info(f"Document page content preview: {combined_text[:500]}")
-    # log.info("\n\n\n")
+## SMALL-TO-BIG CHUNKING
 
-    headers_to_split_on = [
-        ("#", "Header 1"),
-        ("##", "Header 2"),
-        ("###", "Header 3"),
-    ]
-
-    markdown_splitter = MarkdownHeaderTextSplitter(
-        headers_to_split_on=headers_to_split_on,
-        strip_headers=False
+def iter_small_to_big_chunks(pages: Iterable, child_chunk_size: int | None = None) -> Iterator[Document]:
+    """
+    Splits every layout section, see iter_layout_chunks, into child chunks of at most child_chunk_size
+    (CHILD_CHUNK_SIZE by default) characters. \n
+    Only the children are embedded, the section is their parent and is kept whole in the parent store.
+    Every child has the section's metadata, the ID of its parent as parent_id, where it sits in the parent as
+    child_start and child_end, and carries the parent text under PARENT_TEXT until it is stored.
+    """
+    splitter = RecursiveCharacterTextSplitter(
+        chunk_size=child_chunk_size or int(get_envvar(ENV_CHILD_CHUNK_SIZE, "512")),
+        chunk_overlap=0,
+        separators=["\n\n", "\n", " ", "."],
+        add_start_index=True,
     )
-    
-    log.info("Chunking based on layout structure has begun")
-    
-    start = time.perf_counter()
-    
-    final_structured_documents = markdown_splitter.split_text(processed_text)
-    
-    end = time.perf_counter()
-    log.info(f"Chunking process completed, took {end - start:.4f} seconds")
-    
-    # Uncomment this to see all the chunks
-    # for document in final_structured_documents:
-    #     log.info(f"Layout-based chunk preview: {document.page_content}")
-    log.info(f"Number of layout-based chunks created: {len(final_structured_documents)}")
-    
-    return final_structured_documents
+    for parent in iter_layout_chunks(pages):
+        parent_id = get_parent_id(parent.metadata.get("source", ""), parent.page_content)
+        for child in splitter.split_documents([parent]):
+            child_start = child.metadata.pop("start_index")
+            child.metadata.update({
+                "parent_id": parent_id,
+                "child_start": child_start,
+                "child_end": child_start + len(child.page_content),
+                PARENT_TEXT: parent.page_content,
+            })
+            yield child
@@ -0,0 +1,117 @@
+import hashlib
+from langchain_core.embeddings import Embeddings
+import numpy as np
+from pathlib import Path
+import sqlite3
+import threading
+import time
+from utils.logger import log
+
+EMBEDDING_CACHE_PATH = "./data/embedding_cache.sqlite3"
+
+# SQLite limits the number of parameters in a single statement
+SQLITE_BATCH_SIZE = 500
+
+class CachedEmbeddings(Embeddings):
+    """
+    Wraps an embedding model with a persistent SQLite cache of float32 vectors. \n
+    Entries are keyed by model name plus a hash of the text, and the least recently used entries are evicted
+    once the cache holds more than max_entries vectors.
+    """
+
+    def __init__(self, embeddings: Embeddings, model_name: str, max_entries: int, cache_path: str = EMBEDDING_CACHE_PATH):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        Path(cache_path).parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(cache_path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS embeddings_last_access ON embeddings (last_access)")
+        self._connection.commit()
+        self._entries = self._connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        log.info(f"Embedding cache opened with {self._entries} vectors")
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self._embed(texts, "document", self.embeddings.embed_documents)
+
+    def embed_query(self, text: str) -> list[float]:
+        return self._embed([text], "query", lambda texts: [self.embeddings.embed_query(texts[0])])[0]
+
+    def stats(self) -> dict:
+        """
+        Returns the hit and miss counters of the cache.
+        """
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": self._entries,
+        }
+
+    def _embed(self, texts: list, kind: str, embed_function) -> list:
+        keys = [self._get_key(kind, text) for text in texts]
+        vectors = self._lookup(keys)
+
+        # The same text may appear several times in one call, it only has to be embedded once
+        missing = {key: text for key, text in zip(keys, texts) if key not in vectors}
+        self.hits += sum(key in vectors for key in keys)
+        self.misses += len(missing)
+
+        if missing:
+            new_vectors = embed_function(list(missing.values()))
+            new_vectors = dict(zip(missing, np.asarray(new_vectors, dtype=np.float32)))
+            self._store(new_vectors)
+            vectors.update(new_vectors)
+
+        return [vectors[key].tolist() for key in keys]
+
+    def _get_key(self, kind: str, text: str) -> str:
+        return hashlib.sha256(f"{self.model_name}\0{kind}\0{text}".encode("utf-8")).hexdigest()
+
+    def _lookup(self, keys: list) -> dict:
+        unique_keys = list(dict.fromkeys(keys))
+        vectors = {}
+        with self._lock:
+            for i in range(0, len(unique_keys), SQLITE_BATCH_SIZE):
+                batch = unique_keys[i:i + SQLITE_BATCH_SIZE]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._connection.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch
+                ).fetchall()
+                vectors.update((key, np.frombuffer(vector, dtype=np.float32)) for key, vector in rows)
+
+                # Touch the hits so they are the last to be evicted
+                if rows:
+                    self._connection.execute(
+                        f"UPDATE embeddings SET last_access = ? WHERE key IN ({','.join('?' * len(rows))})",
+                        [time.time(), *(key for key, _ in rows)],
+                    )
+            self._connection.commit()
+        return vectors
+
+    def _store(self, vectors: dict) -> None:
+        now = time.time()
+        with self._lock:
+            cursor = self._connection.executemany(
+                "INSERT OR IGNORE INTO embeddings (key, vector, last_access) VALUES (?, ?, ?)",
+                [(key, vector.tobytes(), now) for key, vector in vectors.items()],
+            )
+            self._entries += cursor.rowcount
+
+            overflow = self._entries - self.max_entries
+            if overflow > 0:
+                self._connection.execute(
+                    "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_access LIMIT ?)",
+                    (overflow,),
+                )
+                self._entries -= overflow
+                log.info(f"Embedding cache evicted {overflow} least recently used vectors")
+            self._connection.commit()
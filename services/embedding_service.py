@@ -0,0 +1,181 @@
+from langchain_core.embeddings import Embeddings
+from langchain_huggingface import HuggingFaceEmbeddings
+from pathlib import Path
+from services.embedding_cache import CachedEmbeddings
+import threading
+import time
+from utils.logger import log
+from utils.metrics import EMBEDDING_LOAD_SECONDS, EMBEDDING_WARM_UP_SECONDS
+from utils.utils import get_envvar
+
+ENV_HUGGINGFACE_EMBEDDING_MODEL = "HUGGINGFACE_EMBEDDING_MODEL"
+ENV_EMBEDDING_WARMUP = "EMBEDDING_WARMUP"
+ENV_EMBEDDING_CACHE_ENABLED = "EMBEDDING_CACHE_ENABLED"
+ENV_EMBEDDING_CACHE_MAX_ENTRIES = "EMBEDDING_CACHE_MAX_ENTRIES"
+ENV_EMBEDDING_BACKEND = "EMBEDDING_BACKEND"
+ENV_EMBEDDING_QUANTIZATION = "EMBEDDING_QUANTIZATION"
+ENV_EMBEDDING_THREADS = "EMBEDDING_THREADS"
+ENV_EMBEDDING_MAX_SEQ_LENGTH = "EMBEDDING_MAX_SEQ_LENGTH"
+ENV_EMBEDDING_BATCH_SIZE = "EMBEDDING_BATCH_SIZE"
+
+# torch runs the model in PyTorch fp32, onnx on ONNX Runtime and onnx-int8 on ONNX Runtime with int8 dynamic quantization
+EMBEDDING_BACKENDS = ("torch", "onnx", "onnx-int8")
+
+# ONNX exports of the embedding models, made once on first use
+ONNX_MODEL_DIRECTORY = "./data/onnx_models"
+_onnx_export_lock = threading.Lock()
+
+# Loaded models keyed by model name, shared by every caller in the process
+_embedding_models: dict = {}
+_embedding_models_lock = threading.Lock()
+
+def get_embedding_model() -> Embeddings:
+    """
+    Returns the embedding model. \n
+    The model is loaded on first use and then shared for the lifetime of the process.
+    Unless disabled, it is wrapped in a persistent cache so the same text is only ever embedded once.
+    """
+    model_name = get_envvar(ENV_HUGGINGFACE_EMBEDDING_MODEL)
+
+    embeddings = _embedding_models.get(model_name)
+    if embeddings is not None:
+        return embeddings
+
+    with _embedding_models_lock:
+        # Another thread may have loaded it while we were waiting on the lock
+        embeddings = _embedding_models.get(model_name)
+        if embeddings is None:
+            settings = get_embedding_settings()
+            log.info(f"Loading embedding model {model_name} with the {settings['backend']} backend")
+            start = time.perf_counter()
+
+            embeddings = load_embedding_model(model_name, **settings)
+
+            end = time.perf_counter()
+            EMBEDDING_LOAD_SECONDS.set(end - start, model_name, settings["backend"])
+            log.info(f"Embedding model {model_name} loaded, took {end - start:.4f} seconds")
+
+            if get_envvar(ENV_EMBEDDING_CACHE_ENABLED, "true").lower() == "true":
+                max_entries = int(get_envvar(ENV_EMBEDDING_CACHE_MAX_ENTRIES, "200000"))
+                embeddings = CachedEmbeddings(embeddings, get_cache_model_name(model_name, settings, embeddings), max_entries)
+
+            _embedding_models[model_name] = embeddings
+
+    return embeddings
+
+def get_embedding_settings() -> dict:
+    """
+    Returns the embedding backend settings from the environment configuration, as keyword arguments of load_embedding_model.
+    """
+    return {
+        "backend": get_envvar(ENV_EMBEDDING_BACKEND, "torch"),
+        "quantization": get_envvar(ENV_EMBEDDING_QUANTIZATION, "avx2"),
+        "threads": int(get_envvar(ENV_EMBEDDING_THREADS, "0")),
+        "max_seq_length": int(get_envvar(ENV_EMBEDDING_MAX_SEQ_LENGTH, "0")),
+        "batch_size": int(get_envvar(ENV_EMBEDDING_BATCH_SIZE, "32")),
+    }
+
+def get_cache_model_name(model_name: str, settings: dict, embeddings: Embeddings) -> str:
+    """
+    Returns the name the embedding cache keys the model's vectors under. \n
+    Vectors from another backend are close but not identical, and a text truncated at another length is a different input,
+    so each backend, int8 quantization and effective max_seq_length gets its own entries.
+    """
+    cache_model_name = model_name if settings["backend"] == "torch" else f"{model_name}@{settings['backend']}"
+    if settings["backend"] == "onnx-int8":
+        cache_model_name += f"-{settings['quantization']}"
+
+    client = getattr(embeddings, "_client", None)
+    max_seq_length = getattr(client, "max_seq_length", None) or settings["max_seq_length"]
+    if max_seq_length:
+        cache_model_name += f"#{max_seq_length}"
+    return cache_model_name
+
+def load_embedding_model(model_name: str, backend: str = "torch", quantization: str = "avx2", threads: int = 0,
+                         max_seq_length: int = 0, batch_size: int = 32) -> HuggingFaceEmbeddings:
+    """
+    Loads the embedding model on CPU with one of EMBEDDING_BACKENDS. For onnx-int8, quantization is the instruction set
+    the int8 model is quantized for (arm64, avx2, avx512 or avx512_vnni). \n
+    threads caps the intra-op threads of the ONNX Runtime session, 0 leaves the library default. It is not applied to torch,
+    whose thread pool is shared by the whole process, the cross-encoder included. max_seq_length truncates longer texts,
+    0 keeps the model's own limit. batch_size is the number of texts encoded at a time.
+    """
+    if backend not in EMBEDDING_BACKENDS:
+        raise ValueError(f"Unknown embedding backend {backend}, expected one of {', '.join(EMBEDDING_BACKENDS)}")
+
+    encode_kwargs = {"batch_size": batch_size}
+    if backend == "torch":
+        if threads:
+            log.warning("EMBEDDING_THREADS only applies to the ONNX backends, torch threads are set for the whole process with OMP_NUM_THREADS")
+        embeddings = HuggingFaceEmbeddings(model_name=model_name, encode_kwargs=encode_kwargs)
+    else:
+        # ONNX Runtime and optimum are optional, only needed for these backends
+        import onnxruntime
+
+        model_path, file_name = export_onnx_model(model_name, quantization if backend == "onnx-int8" else None)
+        session_options = onnxruntime.SessionOptions()
+        if threads:
+            session_options.intra_op_num_threads = threads
+        embeddings = HuggingFaceEmbeddings(
+            model_name=model_path,
+            model_kwargs={
+                "backend": "onnx",
+                "model_kwargs": {"file_name": file_name, "provider": "CPUExecutionProvider", "session_options": session_options},
+            },
+            encode_kwargs=encode_kwargs,
+        )
+
+    if max_seq_length:
+        embeddings._client.max_seq_length = max_seq_length
+    return embeddings
+
+def export_onnx_model(model_name: str, quantization: str | None = None) -> tuple:
+    """
+    Exports the model to ONNX in ONNX_MODEL_DIRECTORY and, when quantization is given, quantizes the export to int8
+    for that instruction set. Exports that already exist are reused.
+
+    Returns
+    -------
+    The directory of the exported model and the path of the ONNX file to load within it.
+    """
+    from sentence_transformers import SentenceTransformer, export_dynamic_quantized_onnx_model
+
+    model_path = Path(ONNX_MODEL_DIRECTORY) / model_name.replace("/", "__")
+    file_name = "onnx/model.onnx" if quantization is None else f"onnx/model_qint8_{quantization}.onnx"
+
+    with _onnx_export_lock:
+        if not (model_path / "onnx" / "model.onnx").exists():
+            log.info(f"Exporting embedding model {model_name} to ONNX in {model_path}")
+            SentenceTransformer(model_name, backend="onnx", device="cpu").save_pretrained(str(model_path))
+
+        if not (model_path / file_name).exists():
+            log.info(f"Quantizing the ONNX export of {model_name} to int8 for {quantization}")
+            onnx_model = SentenceTransformer(str(model_path), backend="onnx", device="cpu")
+            export_dynamic_quantized_onnx_model(onnx_model, quantization, str(model_path))
+
+    return str(model_path), file_name
+
+def warm_up_embedding_model() -> float:
+    """
+    Loads the embedding model and runs a single encode through it so the first request does not pay for it.
+    The time it took is exported on /metrics, see EMBEDDING_WARM_UP_SECONDS.
+
+    Returns
+    -------
+    The number of seconds the load and warm-up took, 0 if warm-up is disabled.
+    """
+    if get_envvar(ENV_EMBEDDING_WARMUP, "true").lower() != "true":
+        log.info("Embedding model warm-up is disabled")
+        return 0.0
+
+    start = time.perf_counter()
+
+    embedding_model = get_embedding_model()
+    # Go around the cache, a cached vector would not exercise the model at all
+    getattr(embedding_model, "embeddings", embedding_model).embed_query("warm up")
+
+    end = time.perf_counter()
+    EMBEDDING_WARM_UP_SECONDS.set(end - start)
+    log.info(f"Embedding model warmed up, took {end - start:.4f} seconds")
+
+    return end - start
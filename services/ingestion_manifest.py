@@ -0,0 +1,127 @@
+from fastapi import HTTPException
+import hashlib
+import json
+import os
+from pathlib import Path
+import threading
+from utils.logger import log
+
+# One manifest per chroma DB collection, named after it
+MANIFEST_DIRECTORY = "./data/ingestion_manifests"
+
+# Files are hashed in blocks so large PDFs are never fully read into memory
+HASH_BLOCK_SIZE = 1024 * 1024
+
+# Chunk metadata that retrieval filters on (see build_where_filter) or expands to (see expand_to_parents),
+# part of the chunk ID so a chunk that moves gets a new one
+CHUNK_ID_METADATA_KEYS = ("source", "section", "page_start", "page_end", "parent_id")
+
+class IngestionManifest:
+    """
+    Persistent record of every ingested document, keyed by document path and chunking strategy. \n
+    For each document it stores the hash of the file and the IDs of the chunks stored in chroma DB,
+    so re-ingesting an unchanged file can be skipped and a changed file only touches the chunks that differ.
+    """
+
+    def __init__(self, manifest_path: str):
+        self.manifest_path = Path(manifest_path)
+        self._lock = threading.Lock()
+        self._documents = {}
+
+        if self.manifest_path.exists():
+            with open(self.manifest_path, "r", encoding="utf-8") as manifest_file:
+                self._documents = json.load(manifest_file).get("documents", {})
+        log.info(f"Ingestion manifest {self.manifest_path.name} loaded with {len(self._documents)} documents")
+
+    def is_unchanged(self, document_key: str, file_hash: str) -> bool:
+        """
+        Checks if the document was already ingested from a file with the same hash.
+        """
+        entry = self._documents.get(document_key)
+        return entry is not None and entry["file_hash"] == file_hash
+
+    def get_chunk_ids(self, document_key: str) -> set:
+        """
+        Returns the IDs of the chunks currently stored for the document.
+        """
+        entry = self._documents.get(document_key)
+        return set(entry["chunk_ids"]) if entry else set()
+
+    def update(self, document_key: str, file_hash: str, chunk_ids: list) -> None:
+        """
+        Records the file hash and chunk IDs of the document and persists the manifest.
+        """
+        with self._lock:
+            self._documents[document_key] = {"file_hash": file_hash, "chunk_ids": chunk_ids}
+            self._save()
+
+    def get_all_chunk_ids(self) -> dict:
+        """
+        Returns the IDs of the chunks stored for every document, keyed by document.
+        """
+        with self._lock:
+            return {document_key: set(entry["chunk_ids"]) for document_key, entry in self._documents.items()}
+
+    def forget(self, document_keys: list) -> None:
+        """
+        Forgets the documents, so they are ingested again in full the next time they are chunked.
+        """
+        with self._lock:
+            for document_key in document_keys:
+                self._documents.pop(document_key, None)
+            self._save()
+
+    def clear(self) -> None:
+        """
+        Forgets every document, used when the chroma DB collection is purged.
+        """
+        with self._lock:
+            self._documents = {}
+            self._save()
+
+    def _save(self) -> None:
+        self.manifest_path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Write to a temporary file first so a crash never leaves a half written manifest behind
+        temporary_path = self.manifest_path.with_suffix(".tmp")
+        with open(temporary_path, "w", encoding="utf-8") as manifest_file:
+            json.dump({"documents": self._documents}, manifest_file)
+        os.replace(temporary_path, self.manifest_path)
+
+def get_manifest_path(collection_name: str) -> str:
+    """
+    Returns the path of the manifest of the chroma DB collection.
+    """
+    return f"{MANIFEST_DIRECTORY}/{collection_name}.json"
+
+def get_document_key(document_path: str, strategy: str) -> str:
+    """
+    Returns the manifest key of a document, the same file chunked with different strategies is tracked separately.
+    """
+    return f"{strategy}:{Path(document_path).resolve()}"
+
+def hash_file(document_path: str) -> str:
+    """
+    Returns the SHA-256 hash of the file contents.
+    """
+    file_hash = hashlib.sha256()
+    try:
+        with open(Path(document_path).resolve(), "rb") as document_file:
+            while block := document_file.read(HASH_BLOCK_SIZE):
+                file_hash.update(block)
+    except OSError:
+        log.error(f"File path {document_path} is invalid or the file cannot be found")
+        raise HTTPException(status_code=400, detail="Invalid file path or file cannot be found")
+
+    return file_hash.hexdigest()
+
+def get_chunk_id(document_key: str, content: str, metadata: dict | None = None) -> str:
+    """
+    Returns a deterministic chunk ID, the same chunk text from the same document always maps to the same ID
+    as long as its CHUNK_ID_METADATA_KEYS are the same. \n
+    A chunk whose text is unchanged but that now sits on other pages, under another section or in another parent section,
+    such as after a page is inserted in front of it, gets a new ID, so it is stored again with its new metadata and the old one is removed.
+    """
+    metadata = metadata or {}
+    placement = json.dumps([metadata.get(key) for key in CHUNK_ID_METADATA_KEYS])
+    return hashlib.sha256(f"{document_key}\0{placement}\0{content}".encode("utf-8")).hexdigest()
@@ -0,0 +1,175 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import contextvars
+from dataclasses import dataclass, field
+from fastapi import HTTPException
+import threading
+import time
+from typing import Callable
+import uuid
+from utils.logger import correlation_id, log
+from utils.metrics import INGEST_STAGE_SECONDS
+from utils.utils import get_envvar
+
+ENV_INGEST_WORKERS = "INGEST_WORKERS"
+ENV_INGEST_QUEUE_SIZE = "INGEST_QUEUE_SIZE"
+
+# Finished jobs are kept around for status lookups until this many newer jobs have been submitted
+MAX_JOB_HISTORY = 1000
+
+@dataclass
+class Job:
+    """
+    A unit of background work and its status.
+    """
+    kind: str
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    status: str = "queued"
+    stage: str | None = None
+    progress: float = 0.0
+    timings: dict = field(default_factory=dict)
+    result: dict | None = None
+    error: str | None = None
+    created_at: float = field(default_factory=time.time)
+    # Correlation ID of the request that submitted the job
+    correlation_id: str | None = field(default_factory=correlation_id.get)
+    _stage_start: float | None = None
+
+    def set_stage(self, stage: str) -> None:
+        """
+        Moves the job to the given stage. Stages can be entered more than once, their timings add up.
+        """
+        if stage != self.stage:
+            self._finish_stage()
+            self.stage = stage
+            self._stage_start = time.perf_counter()
+
+    def _finish_stage(self) -> None:
+        if self.stage is not None and self._stage_start is not None:
+            self.timings[self.stage] = self.timings.get(self.stage, 0.0) + time.perf_counter() - self._stage_start
+            self._stage_start = None
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "stage": self.stage,
+            "progress": round(self.progress, 4),
+            "timings": {stage: round(seconds, 4) for stage, seconds in self.timings.items()},
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "correlation_id": self.correlation_id,
+        }
+
+def report_stage(job: Job | None, stage: str) -> None:
+    """
+    Reports the stage of the job, if the work is running as one.
+    """
+    if job is not None:
+        job.set_stage(stage)
+
+def report_progress(job: Job | None, progress: float) -> None:
+    """
+    Reports the fraction of the job that is done, if the work is running as one.
+    """
+    if job is not None:
+        job.progress = min(max(progress, job.progress), 1.0)
+
+class JobQueue:
+    """
+    Runs jobs on a bounded pool of worker threads so request handlers can return straight away. \n
+    Submitting more than max_pending unfinished jobs is rejected instead of queueing without limit.
+    """
+
+    def __init__(self, max_workers: int, max_pending: int):
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ingest")
+        self._jobs = OrderedDict()
+        self._pending = 0
+        self._paused = False
+        self._lock = threading.Lock()
+        log.info(f"Job queue started with {max_workers} workers and room for {max_pending} pending jobs")
+
+    def submit(self, kind: str, function: Callable, *args) -> Job:
+        """
+        Queues the function to be called with the given arguments and a trailing job argument.
+        """
+        with self._lock:
+            if self._paused:
+                log.warning(f"Job queue is paused, rejected {kind} job")
+                raise HTTPException(status_code=503, detail="Ingestion is paused for maintenance, try again shortly")
+            if self._pending >= self.max_pending:
+                log.warning(f"Job queue is full, rejected {kind} job")
+                raise HTTPException(status_code=429, detail="Too many jobs are queued, try again later")
+
+            job = Job(kind=kind)
+            self._pending += 1
+            self._jobs[job.id] = job
+            while len(self._jobs) > MAX_JOB_HISTORY:
+                self._jobs.popitem(last=False)
+
+        # The job logs under the correlation ID of the request that submitted it
+        self._executor.submit(contextvars.copy_context().run, self._run, job, function, args)
+        log.info(f"Queued {kind} job {job.id}")
+        return job
+
+    def get(self, job_id: str) -> Job | None:
+        return self._jobs.get(job_id)
+
+    @contextmanager
+    def paused(self):
+        """
+        Rejects new jobs while the block runs, for maintenance that needs the stores to stay still. \n
+        Fails with 409 if a job is still queued or running.
+        """
+        with self._lock:
+            if self._pending:
+                raise HTTPException(status_code=409, detail=f"{self._pending} ingestion jobs are still queued or running, try again once they finish")
+            if self._paused:
+                raise HTTPException(status_code=409, detail="Another maintenance operation is running")
+            self._paused = True
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._paused = False
+
+    def shutdown(self) -> None:
+        """
+        Lets the running jobs finish and drops the ones that have not started yet.
+        """
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def _run(self, job: Job, function: Callable, args: tuple) -> None:
+        job.status = "running"
+        start = time.perf_counter()
+        try:
+            job.result = function(*args, job)
+            job.status = "completed"
+            job.progress = 1.0
+        except HTTPException as err:
+            job.status = "failed"
+            job.error = err.detail
+        except Exception as err:
+            log.exception(f"Job {job.id} failed")
+            job.status = "failed"
+            job.error = str(err)
+        finally:
+            job._finish_stage()
+            job.timings["total"] = time.perf_counter() - start
+            with self._lock:
+                self._pending -= 1
+            for stage, seconds in job.timings.items():
+                INGEST_STAGE_SECONDS.observe(seconds, stage)
+        log.info(f"Job {job.id} {job.status}, took {job.timings['total']:.4f} seconds")
+
+def create_job_queue() -> JobQueue:
+    """
+    Creates the ingestion job queue from the environment configuration.
+    """
+    max_workers = int(get_envvar(ENV_INGEST_WORKERS, "2"))
+    max_pending = int(get_envvar(ENV_INGEST_QUEUE_SIZE, "16"))
+    return JobQueue(max_workers, max_pending)
@@ -0,0 +1,136 @@
+import hashlib
+from pathlib import Path
+import sqlite3
+import threading
+from utils.logger import log
+
+# Kept next to the chroma DB directory, one file per collection
+PARENT_STORE_DIRECTORY = "./data/parent_store"
+
+# Metadata key the parent text travels under from chunking until it is stored, it is never written to chroma DB
+PARENT_TEXT = "parent_text"
+
+# Metadata keys that only describe a child chunk, a parent has the rest of its children's metadata
+CHILD_METADATA_KEYS = ("parent_id", "child_start", "child_end")
+
+# SQLite limits the number of parameters in a single statement
+SQLITE_BATCH_SIZE = 500
+
+class ParentStore:
+    """
+    SQLite store of the parent sections of small-to-big chunking, keyed by parent ID. \n
+    Only the child chunks of a parent are embedded and stored in chroma DB, each with the ID of its parent,
+    the parent text is kept here so retrieval can swap matched children for the section around them.
+    """
+
+    def __init__(self, store_path: str):
+        self.store_path = Path(store_path)
+        self.store_path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.store_path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS parents (id TEXT PRIMARY KEY, text TEXT NOT NULL)")
+        self._connection.commit()
+        self._parents = self._connection.execute("SELECT COUNT(*) FROM parents").fetchone()[0]
+        log.info(f"Parent store opened with {self._parents} parents from {self.store_path}")
+
+    def __len__(self) -> int:
+        return self._parents
+
+    def put(self, parents: dict) -> None:
+        """
+        Stores the parent texts, keyed by parent ID, replacing any parent already stored under the same ID.
+        """
+        with self._lock:
+            self._connection.executemany("INSERT OR REPLACE INTO parents (id, text) VALUES (?, ?)", parents.items())
+            self._connection.commit()
+            self._parents = self._connection.execute("SELECT COUNT(*) FROM parents").fetchone()[0]
+
+    def get(self, ids: list) -> dict:
+        """
+        Returns the texts of the parents that are stored, keyed by parent ID.
+        """
+        unique_ids = list(dict.fromkeys(ids))
+        parents = {}
+        with self._lock:
+            for i in range(0, len(unique_ids), SQLITE_BATCH_SIZE):
+                batch = unique_ids[i:i + SQLITE_BATCH_SIZE]
+                placeholders = ",".join("?" * len(batch))
+                parents.update(self._connection.execute(f"SELECT id, text FROM parents WHERE id IN ({placeholders})", batch))
+        return parents
+
+    def delete(self, ids: list) -> None:
+        """
+        Removes the parents from the store.
+        """
+        with self._lock:
+            for i in range(0, len(ids), SQLITE_BATCH_SIZE):
+                batch = ids[i:i + SQLITE_BATCH_SIZE]
+                self._connection.execute(f"DELETE FROM parents WHERE id IN ({','.join('?' * len(batch))})", batch)
+            self._connection.commit()
+            self._parents = self._connection.execute("SELECT COUNT(*) FROM parents").fetchone()[0]
+
+    def clear(self) -> None:
+        """
+        Forgets every parent, used when the chroma DB collection is deleted.
+        """
+        with self._lock:
+            self._connection.execute("DELETE FROM parents")
+            self._connection.commit()
+            self._parents = 0
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+_parent_stores = {}
+_parent_stores_lock = threading.Lock()
+
+def reset_parent_stores() -> None:
+    """
+    Closes every open parent store, so they are read from disk again the next time they are asked for.
+    """
+    with _parent_stores_lock:
+        parent_stores = list(_parent_stores.values())
+        _parent_stores.clear()
+    for parent_store in parent_stores:
+        parent_store.close()
+
+def unload_parent_store(collection_name: str) -> None:
+    """
+    Closes the parent store of the collection, it is opened again the next time it is asked for.
+    """
+    with _parent_stores_lock:
+        parent_store = _parent_stores.pop(collection_name, None)
+    if parent_store is not None:
+        parent_store.close()
+
+def get_parent_store(collection_name: str) -> ParentStore:
+    """
+    Returns the parent store of the chroma DB collection, opening it the first time it is asked for.
+    """
+    with _parent_stores_lock:
+        if collection_name not in _parent_stores:
+            _parent_stores[collection_name] = ParentStore(f"{PARENT_STORE_DIRECTORY}/{collection_name}.sqlite3")
+        return _parent_stores[collection_name]
+
+def get_parent_id(source: str, text: str) -> str:
+    """
+    Returns the ID of a parent section, a hash of its document and text, so the same section gets the same ID every time.
+    """
+    return hashlib.sha256(f"{source}\0{text}".encode("utf-8")).hexdigest()
+
+def take_parent_texts(metadatas: list) -> dict:
+    """
+    Removes PARENT_TEXT from the metadata of the child chunks, without changing the dictionaries passed in.
+
+    Returns
+    -------
+    The parent texts keyed by parent ID.
+    """
+    parents = {}
+    for index, metadata in enumerate(metadatas):
+        if metadata and PARENT_TEXT in metadata:
+            metadatas[index] = {key: value for key, value in metadata.items() if key != PARENT_TEXT}
+            parents[metadata["parent_id"]] = metadata[PARENT_TEXT]
+    return parents
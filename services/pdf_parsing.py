@@ -0,0 +1,176 @@
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+import itertools
+import math
+import multiprocessing
+import pymupdf
+import pymupdf4llm
+import pypdf
+import re
+import threading
+import time
+from typing import Callable, Iterator
+from utils.logger import log
+from utils.metrics import STAGE_SECONDS
+from utils.utils import get_envvar
+
+# The parsing processes import this module, so it is kept free of the heavy embedding and langchain imports
+
+ENV_PDF_PARSE_WORKERS = "PDF_PARSE_WORKERS"
+ENV_PDF_PARSE_MIN_PAGES_PER_WORKER = "PDF_PARSE_MIN_PAGES_PER_WORKER"
+ENV_CLEAN_TEXT_ASCII_FILTER = "CLEAN_TEXT_ASCII_FILTER"
+
+# How clean_text drops non-ASCII characters, "regex" or "translate"
+CLEAN_TEXT_ASCII_FILTER = get_envvar(ENV_CLEAN_TEXT_ASCII_FILTER, "regex")
+
+# Compiled once, clean_text runs on every page
+HTML_TAG = re.compile(r"<[^>]+>")
+URL_OR_CITATION = re.compile(r"http\S+|www\.\S+|\[[0-9]*\]")
+NON_PRINTABLE = re.compile(r"[^\x20-\x7E]+")
+
+# Control characters that are left after whitespace is collapsed and the non-ASCII characters are encoded away,
+# str.split treats the others as whitespace
+CONTROL_CHARACTERS = str.maketrans("", "", "".join(map(chr, [*range(0x20), 0x7F])))
+
+# More ranges than workers, so a range of slow pages does not hold the others up, and results stream back in smaller steps
+RANGES_PER_WORKER = 4
+
+def clean_text(text: str, ascii_filter: str = CLEAN_TEXT_ASCII_FILTER) -> str:
+    """
+    Light text cleaning for PDF content.
+    Removes HTML, URLs, citation marks, extra whitespace, and non-printable characters. \n
+    ascii_filter picks how the non-ASCII characters are dropped, "regex" or "translate" for str.translate.
+    Both give exactly the same text, and text that is already printable ASCII skips the filter altogether.
+    """
+    text = HTML_TAG.sub(" ", text)                   # remove HTML, before URLs so a tag ends the URL before it
+    text = URL_OR_CITATION.sub("", text)             # remove URLs and citation marks [1], [2]
+    text = " ".join(text.split())                    # collapse multiple spaces/newlines, split uses the same whitespace as \s
+    if text.isascii() and text.isprintable():
+        return text
+
+    text = text.replace("\u2212", "-")
+    if ascii_filter == "translate":
+        text = text.encode("ascii", errors="ignore").decode("ascii").translate(CONTROL_CHARACTERS)
+    else:
+        text = NON_PRINTABLE.sub("", text)           # remove non-ASCII characters
+    return text.strip()
+
+def extract_page_range(document_path: str, start: int, end: int) -> tuple:
+    """
+    Extracts and cleans the text of pages start to end (exclusive) with PyPDF, the same way PyPDFLoader does.
+
+    Returns
+    -------
+    A list of (page text, page metadata) pairs, and the (stage, seconds) timings of cleaning every page,
+    which the parsing process cannot record in the metrics of the server itself.
+    """
+    reader = pypdf.PdfReader(document_path)
+    pages = []
+    timings = []
+    for page_number in range(start, end):
+        text = reader.pages[page_number].extract_text(extraction_mode="plain").strip()
+        clean_start = time.perf_counter()
+        text = clean_text(text)
+        timings.append(("clean", time.perf_counter() - clean_start))
+        pages.append((text, {"page": page_number, "page_label": reader.page_labels[page_number]}))
+    return pages, timings
+
+def extract_page_range_as_markdown(document_path: str, start: int, end: int) -> tuple:
+    """
+    Converts pages start to end (exclusive) into markdown with PyMuPDF4LLM, the same way PyMuPDF4LLMLoader does.
+
+    Returns
+    -------
+    A list of (page markdown, page metadata) pairs, and no timings, see extract_page_range.
+    """
+    pages = []
+    with pymupdf.open(document_path) as document:
+        for page_number in range(start, end):
+            page_markdown = pymupdf4llm.to_markdown(document, pages=[page_number], show_progress=False, graphics_limit=5000)
+            # The loader drops the page separator PyMuPDF4LLM ends every page with
+            if page_markdown.endswith("\n-----\n\n"):
+                page_markdown = page_markdown[:-8]
+            pages.append((page_markdown, {"page": page_number}))
+    return pages, []
+
+def get_page_ranges(start: int, total_pages: int, workers: int, min_pages_per_worker: int) -> list:
+    """
+    Splits the pages from start onwards into ranges for the workers.
+
+    Returns
+    -------
+    A list of (start, end) pairs, empty if there are too few pages for parsing them in parallel to pay off.
+    """
+    page_count = total_pages - start
+    if workers <= 1 or page_count < 2 * min_pages_per_worker:
+        return []
+
+    pages_per_range = max(min_pages_per_worker, math.ceil(page_count / (workers * RANGES_PER_WORKER)))
+    return [(range_start, min(range_start + pages_per_range, total_pages))
+            for range_start in range(start, total_pages, pages_per_range)]
+
+def iter_pages_in_parallel(extract_range: Callable, document_path: str, page_ranges: list) -> Iterator[tuple]:
+    """
+    Extracts the page ranges in the PDF parsing process pool and yields the pages in document order,
+    recording the stage timings the parsing processes send back with every range. \n
+    Only two ranges per worker are in flight at a time, so a slow consumer does not pile up parsed pages.
+    """
+    workers, _ = get_pdf_parse_settings()
+    parse_pool = get_pdf_parse_pool()
+    remaining_ranges = iter(page_ranges)
+    in_flight = deque(
+        parse_pool.submit(extract_range, document_path, start, end)
+        for start, end in itertools.islice(remaining_ranges, workers * 2)
+    )
+
+    try:
+        while in_flight:
+            pages, timings = in_flight.popleft().result()
+            for stage, seconds in timings:
+                STAGE_SECONDS.observe(seconds, stage)
+            next_range = next(remaining_ranges, None)
+            if next_range is not None:
+                in_flight.append(parse_pool.submit(extract_range, document_path, *next_range))
+            yield from pages
+    finally:
+        for future in in_flight:
+            future.cancel()
+
+def get_pdf_parse_settings() -> tuple:
+    """
+    Returns the number of PDF parsing processes and the minimum number of pages worth giving each of them.
+    """
+    workers = int(get_envvar(ENV_PDF_PARSE_WORKERS, str(multiprocessing.cpu_count())))
+    min_pages_per_worker = int(get_envvar(ENV_PDF_PARSE_MIN_PAGES_PER_WORKER, "8"))
+    return workers, min_pages_per_worker
+
+_pdf_parse_pool = None
+_pdf_parse_pool_lock = threading.Lock()
+
+def get_pdf_parse_pool() -> ProcessPoolExecutor:
+    """
+    Returns the process pool shared by every PDF being parsed, started the first time a large PDF comes in.
+    """
+    global _pdf_parse_pool
+
+    if _pdf_parse_pool is not None:
+        return _pdf_parse_pool
+
+    with _pdf_parse_pool_lock:
+        if _pdf_parse_pool is None:
+            workers, _ = get_pdf_parse_settings()
+            # Forking a process that is running threads can deadlock the child, so the workers are started fresh
+            _pdf_parse_pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+            log.info(f"PDF parsing pool started with {workers} processes")
+    return _pdf_parse_pool
+
+def shutdown_pdf_parse_pool() -> None:
+    """
+    Stops the PDF parsing processes, if they were ever started.
+    """
+    global _pdf_parse_pool
+
+    with _pdf_parse_pool_lock:
+        if _pdf_parse_pool is not None:
+            _pdf_parse_pool.shutdown(wait=True, cancel_futures=True)
+            _pdf_parse_pool = None
@@ -1,13 +1,28 @@
+from collections import OrderedDict
 from langchain_core.messages import SystemMessage, HumanMessage
 from langchain_google_genai import ChatGoogleGenerativeAI
 # If using the pro version you can uncomment the below import to have multi modal inputs
 # from langchain.messages import HumanMessage
+import re
 import time
+from typing import AsyncIterator
 from utils.logger import log
+from utils.metrics import time_stage
 from utils.utils import get_envvar
 
 ENV_GOOGLE_AI_MODEL = "GOOGLE_AI_MODEL"
 ENV_GOOGLE_APIKEY = "GOOGLE_APIKEY"
+ENV_QUERY_VARIANTS_MAX = "QUERY_VARIANTS_MAX"
+ENV_QUERY_TRANSFORMATION_CACHE_SIZE = "QUERY_TRANSFORMATION_CACHE_SIZE"
+
+QUERY_VARIANTS_MAX = int(get_envvar(ENV_QUERY_VARIANTS_MAX, "5"))
+QUERY_TRANSFORMATION_CACHE_SIZE = int(get_envvar(ENV_QUERY_TRANSFORMATION_CACHE_SIZE, "512"))
+
+# Bullets and numbering such as "-", "*", "1.", "2)" or "(3)" in front of a generated query
+QUERY_VARIANT_PREFIX = re.compile(r"^\s*(?:[-*\u2022]|\(?\d+[.)])\s+")
+
+# Least recently used memo of query text to its parsed variants
+query_transformation_cache = OrderedDict()
 
 SYSTEM_PROMPT = """
     You are an intelligent and patient study assistant designed to help students understand their course notes.
@@ -58,7 +73,7 @@ def connect_to_google_ai() -> ChatGoogleGenerativeAI:
     except Exception as err:
         log.error(f"Could not create google AI model due to, {err}")
 
-def query_google_ai(query: str, google_ai: ChatGoogleGenerativeAI) -> dict:
+async def query_google_ai(query: str, google_ai: ChatGoogleGenerativeAI) -> dict:
     """
     Invokes the google ai model with the query and returns its response.
     """
@@ -68,29 +83,79 @@ def query_google_ai(query: str, google_ai: ChatGoogleGenerativeAI) -> dict:
     ]
 
     log.info("Awaiting response from AI model")
-    start = time.perf_counter()
     
-    response = google_ai.invoke(messages)
+    response = await google_ai.ainvoke(messages)
 
-    end = time.perf_counter()
-    log.info(f"Response received, took {end - start:.4f} seconds")
+    log.info("Response received")
 
     return {"query" : query, "response": response}
 
-def query_transformation(query:str, google_ai: ChatGoogleGenerativeAI) -> list:
+async def stream_google_ai(query: str, google_ai: ChatGoogleGenerativeAI) -> AsyncIterator[str]:
+    """
+    Streams the google ai model's response to the query, yielding the text as it is generated.
+    """
+    messages = [
+        SystemMessage(content=SYSTEM_PROMPT),
+        HumanMessage(content=query)
+    ]
+
+    log.info("Streaming response from AI model")
+
+    with time_stage("generate") as timer:
+        first_token = True
+        async for chunk in google_ai.astream(messages):
+            if not chunk.text:
+                continue
+            if first_token:
+                first_token = False
+                log.info(f"First token received, took {time.perf_counter() - timer.start:.4f} seconds")
+            yield chunk.text
+
+    log.info(f"Response streamed, took {timer.seconds:.4f} seconds")
+
+async def query_transformation(query:str, google_ai: ChatGoogleGenerativeAI) -> list:
+    """
+    Asks the AI model for alternative versions of the query. \n
+    Results are memoized per query text, so a repeated question does not pay for another round-trip.
+
+    Returns
+    -------
+    A list of at most QUERY_VARIANTS_MAX unique, non-empty alternative queries.
+    """
+    cache_key = " ".join(query.split()).lower()
+    cached_variants = query_transformation_cache.get(cache_key)
+    if cached_variants is not None:
+        query_transformation_cache.move_to_end(cache_key)
+        log.info("Query transformation served from cache")
+        return list(cached_variants)
+
     messages = [
         SystemMessage(content = query_transformation_prompt),
         HumanMessage(content=query)
     ]
     
     log.info("Awaiting query transformation from AI model")
-    start = time.perf_counter()
-    
-    response = google_ai.invoke(messages)
-    
-    end = time.perf_counter()
-    log.info(f"Response received, took {end - start:.4f} seconds")
     
-    print(response.content.split('\n'))
+    response = await google_ai.ainvoke(messages)
     
-    return response.content.split('\n')
\ No newline at end of file
+    log.info("Query transformation received")
+
+    variants = parse_query_variants(response.content, QUERY_VARIANTS_MAX)
+    log.info(f"Query variants: {variants}")
+
+    query_transformation_cache[cache_key] = variants
+    while len(query_transformation_cache) > QUERY_TRANSFORMATION_CACHE_SIZE:
+        query_transformation_cache.popitem(last=False)
+
+    return list(variants)
+
+def parse_query_variants(content: str, max_variants: int) -> list:
+    """
+    Parses the model's newline separated alternative queries, dropping blank lines, list numbering and duplicates.
+    """
+    variants = {}
+    for line in content.split("\n"):
+        variant = QUERY_VARIANT_PREFIX.sub("", line).strip().strip('"')
+        if variant and variant.lower() not in variants:
+            variants[variant.lower()] = variant
+    return list(variants.values())[:max_variants]
@@ -1,32 +1,118 @@
 from cohere.client_v2 import ClientV2
+import numpy as np
+from sentence_transformers import CrossEncoder
 from utils.logger import log
 from utils.utils  import get_envvar
 
+ENV_RERANKER_BACKEND = "RERANKER_BACKEND"
+ENV_COHERE_API_KEY = "COHERE_API_KEY"
+ENV_CROSS_ENCODER_MODEL = "CROSS_ENCODER_MODEL"
+ENV_CROSS_ENCODER_BATCH_SIZE = "CROSS_ENCODER_BATCH_SIZE"
+ENV_CROSS_ENCODER_MAX_LENGTH = "CROSS_ENCODER_MAX_LENGTH"
+ENV_CROSS_ENCODER_MAX_CANDIDATES = "CROSS_ENCODER_MAX_CANDIDATES"
+
+class Reranker:
+    """
+    Common interface of the re-ranking backends.
+    """
+
+    def rerank(self, query: str, documents: list, k: int = 10) -> list:
+        """
+        Reranks the candidates against the query.
+
+        Returns
+        -------
+        A list of at most k (document, relevance score) pairs, the most relevant first.
+        """
+        raise NotImplementedError
+
+class CohereReranker(Reranker):
+    """
+    Reranks with Cohere's Rerank model, reusing one client and its connection pool for every request.
+    """
+
+    def __init__(self, cohere_client: ClientV2, model: str = "rerank-v3.5"):
+        self.cohere_client = cohere_client
+        self.model = model  # Can try rerank-multilingual-v3.0
+
+    def rerank(self, query: str, documents: list, k: int = 10) -> list:
+        log.info("INFO: Starting re-ranking process")
+
+        rerank_response = self.cohere_client.rerank(
+            model=self.model,
+            query=query,
+            documents=documents,
+            top_n=min(k, len(documents)),
+        )
+
+        # It is already sort by relevance and extract top results
+        reranked_docs = [
+            (documents[result.index], result.relevance_score) for result in rerank_response.results
+        ]
+        log.info("INFO: Re-ranking process completed")
+
+        return reranked_docs
+
+class CrossEncoderReranker(Reranker):
+    """
+    Reranks locally with a sentence-transformers cross-encoder, scoring the candidates in batches on CPU. \n
+    Only the first max_candidates documents are scored, they arrive sorted by retrieval distance so the tail is the least likely to make the top k.
+    """
+
+    def __init__(self, model_name: str, batch_size: int, max_length: int, max_candidates: int):
+        self.cross_encoder = CrossEncoder(model_name, max_length=max_length, device="cpu")
+        self.batch_size = batch_size
+        self.max_candidates = max_candidates
+        log.info(f"Cross-encoder reranker loaded: {model_name}")
+
+    def rerank(self, query: str, documents: list, k: int = 10) -> list:
+        log.info("INFO: Starting re-ranking process")
+        candidates = documents[:self.max_candidates]
+
+        # Nothing to reorder, skip the model entirely
+        if len(candidates) <= 1:
+            return [(document, 1.0) for document in candidates]
+
+        scores = self.cross_encoder.predict(
+            [(query, document) for document in candidates],
+            batch_size=self.batch_size,
+            show_progress_bar=False,
+        )
+
+        # Select the top k without sorting every candidate, then order just those
+        top_n = min(k, len(candidates))
+        top_indices = np.argpartition(-scores, top_n - 1)[:top_n]
+        top_indices = top_indices[np.argsort(-scores[top_indices])]
+
+        reranked_docs = [(candidates[i], float(scores[i])) for i in top_indices]
+        log.info("INFO: Re-ranking process completed")
+
+        return reranked_docs
+
 def connect_to_cohere_reranker() -> ClientV2:
     """
     Connect to cohere client using API key.
     """
-    cohere_client = ClientV2(api_key=get_envvar("COHERE_API_KEY"))
+    cohere_client = ClientV2(api_key=get_envvar(ENV_COHERE_API_KEY))
     return cohere_client
 
-def rerank(query: str, documents: list, k: int = 10) -> list:
+def connect_to_reranker() -> Reranker:
     """
-    Reranks the top-k candidates from Chroma using Cohere's Rerank model.
+    Sets up the re-ranking backend selected by the RERANKER_BACKEND environment variable, cohere by default.
     """
-    cohere_client = connect_to_cohere_reranker()
-    log.info("INFO: Starting re-ranking process")
-
-    rerank_response = cohere_client.rerank(
-        model="rerank-v3.5",  # Can try rerank-multilingual-v3.0
-        query=query,
-        documents=documents,
-        top_n=min(k, len(documents)),
-    )
+    backend = get_envvar(ENV_RERANKER_BACKEND, "cohere")
 
-    # It is already sort by relevance and extract top results
-    reranked_docs = [
-        documents[result.index] for result in rerank_response.results
-    ]
-    log.info("INFO: Re-ranking process completed")
+    if backend == "cohere":
+        reranker = CohereReranker(connect_to_cohere_reranker())
+    elif backend == "cross-encoder":
+        reranker = CrossEncoderReranker(
+            model_name=get_envvar(ENV_CROSS_ENCODER_MODEL, "cross-encoder/ms-marco-MiniLM-L-6-v2"),
+            batch_size=int(get_envvar(ENV_CROSS_ENCODER_BATCH_SIZE, "32")),
+            max_length=int(get_envvar(ENV_CROSS_ENCODER_MAX_LENGTH, "512")),
+            max_candidates=int(get_envvar(ENV_CROSS_ENCODER_MAX_CANDIDATES, "100")),
+        )
+    else:
+        raise ValueError(f"Unknown reranker backend {backend}, expected cohere or cross-encoder")
 
-    return reranked_docs
\ No newline at end of file
+    log.info(f"Reranker backend set: {backend}")
+    return reranker
@@ -0,0 +1,187 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+import hashlib
+import json
+import numpy as np
+import re
+from services.embedding_service import get_embedding_model
+import threading
+import time
+from utils.logger import log
+from utils.utils import get_envvar
+
+ENV_RESPONSE_CACHE_ENABLED = "RESPONSE_CACHE_ENABLED"
+ENV_RESPONSE_CACHE_MAX_ENTRIES = "RESPONSE_CACHE_MAX_ENTRIES"
+ENV_RESPONSE_CACHE_TTL_SECONDS = "RESPONSE_CACHE_TTL_SECONDS"
+ENV_RESPONSE_CACHE_SIMILARITY_THRESHOLD = "RESPONSE_CACHE_SIMILARITY_THRESHOLD"
+
+# Answers without retrieval never go stale, answers with retrieval do whenever documents are added to or removed from
+# the collection they were retrieved from, so every collection has a namespace of its own
+ASK_NAMESPACE = "ask"
+RAG_NAMESPACE = "rag"
+
+@dataclass
+class CachedResponse:
+    namespace: str
+    embedding: np.ndarray
+    response: dict
+    created_at: float
+
+class ResponseCache:
+    """
+    In-memory cache of model responses, so near-identical questions do not pay for retrieval and generation again. \n
+    A query hits when its normalized text was asked before, or when its embedding is at least similarity_threshold
+    cosine similar to a cached query in the same namespace. Entries expire after ttl_seconds and the least
+    recently used ones are evicted past max_entries.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float, similarity_threshold: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def get(self, namespace: str, query: str) -> dict | None:
+        """
+        Returns the cached response to the query, or None if there is no fresh one.
+        """
+        key = self._get_key(namespace, query)
+        with self._lock:
+            self._evict_expired()
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.exact_hits += 1
+                return entry.response
+
+        query_embedding = self._embed(query)
+        with self._lock:
+            candidates = [(key, entry) for key, entry in self._entries.items() if entry.namespace == namespace]
+            if candidates:
+                similarities = np.stack([entry.embedding for _, entry in candidates]) @ query_embedding
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.similarity_threshold:
+                    best_key, best_entry = candidates[best]
+                    self._entries.move_to_end(best_key)
+                    self.semantic_hits += 1
+                    return best_entry.response
+
+            self.misses += 1
+            return None
+
+    def get_generation(self, namespace: str) -> int:
+        """
+        Returns the number of times the namespace, or a namespace it is nested in, has been invalidated,
+        pass it to put to detect stale responses.
+        """
+        parts = namespace.split("/")
+        return sum(self._generations.get("/".join(parts[:depth]), 0) for depth in range(1, len(parts) + 1))
+
+    def put(self, namespace: str, query: str, response: dict, generation: int) -> None:
+        """
+        Caches the response, unless the namespace was invalidated since the given generation was read.
+        """
+        query_embedding = self._embed(query)
+        with self._lock:
+            if generation != self.get_generation(namespace):
+                return
+
+            key = self._get_key(namespace, query)
+            self._entries[key] = CachedResponse(namespace, query_embedding, response, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, namespace: str) -> None:
+        """
+        Drops every cached response in the namespace and the namespaces nested in it, such as "rag/notes/..." in "rag/notes",
+        used when the documents they were based on change.
+        """
+        with self._lock:
+            self._generations[namespace] = self._generations.get(namespace, 0) + 1
+            stale_keys = [key for key, entry in self._entries.items()
+                          if entry.namespace == namespace or entry.namespace.startswith(f"{namespace}/")]
+            for key in stale_keys:
+                del self._entries[key]
+        if stale_keys:
+            log.info(f"Invalidated {len(stale_keys)} cached {namespace} responses")
+
+    def stats(self) -> dict:
+        """
+        Returns the hit and miss counters of the cache.
+        """
+        lookups = self.exact_hits + self.semantic_hits + self.misses
+        return {
+            "exact_hits": self.exact_hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_rate": (self.exact_hits + self.semantic_hits) / lookups if lookups else 0.0,
+            "entries": len(self._entries),
+        }
+
+    def _evict_expired(self) -> None:
+        # Entries are in least recently used order, not creation order, so every entry has to be checked
+        now = time.monotonic()
+        expired_keys = [key for key, entry in self._entries.items() if now - entry.created_at > self.ttl_seconds]
+        for key in expired_keys:
+            del self._entries[key]
+
+    def _get_key(self, namespace: str, query: str) -> str:
+        return hashlib.sha256(f"{namespace}\0{normalize_query(query)}".encode("utf-8")).hexdigest()
+
+    def _embed(self, query: str) -> np.ndarray:
+        embedding = np.asarray(get_embedding_model().embed_query(normalize_query(query)), dtype=np.float32)
+        return embedding / max(float(np.linalg.norm(embedding)), np.finfo(np.float32).tiny)
+
+def normalize_query(query: str) -> str:
+    """
+    Lowercases the query, collapses whitespace and drops trailing punctuation.
+    """
+    return re.sub(r"\s+", " ", query).strip().lower().rstrip("?!. ")
+
+_response_cache = None
+_response_cache_loaded = False
+_response_cache_lock = threading.Lock()
+
+def get_response_cache() -> ResponseCache | None:
+    """
+    Returns the response cache shared by the whole process, or None if it is disabled.
+    """
+    global _response_cache, _response_cache_loaded
+
+    if _response_cache_loaded:
+        return _response_cache
+
+    with _response_cache_lock:
+        if not _response_cache_loaded:
+            if get_envvar(ENV_RESPONSE_CACHE_ENABLED, "true").lower() == "true":
+                _response_cache = ResponseCache(
+                    max_entries=int(get_envvar(ENV_RESPONSE_CACHE_MAX_ENTRIES, "1000")),
+                    ttl_seconds=float(get_envvar(ENV_RESPONSE_CACHE_TTL_SECONDS, "3600")),
+                    similarity_threshold=float(get_envvar(ENV_RESPONSE_CACHE_SIMILARITY_THRESHOLD, "0.95")),
+                )
+            _response_cache_loaded = True
+    return _response_cache
+
+def get_retrieval_namespace(collection_name: str, where: dict | None = None) -> str:
+    """
+    Returns the namespace of the responses based on documents retrieved from the collection.
+    Responses retrieved with a filter are kept in a namespace nested in it per filter, so they are invalidated with it.
+    """
+    namespace = f"{RAG_NAMESPACE}/{collection_name}"
+    if where:
+        namespace += "/" + hashlib.sha256(json.dumps(where, sort_keys=True).encode("utf-8")).hexdigest()
+    return namespace
+
+def invalidate_retrieval_responses(collection_name: str) -> None:
+    """
+    Drops every cached response that was based on documents retrieved from the collection.
+    """
+    response_cache = get_response_cache()
+    if response_cache is not None:
+        response_cache.invalidate(get_retrieval_namespace(collection_name))
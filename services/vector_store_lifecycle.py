@@ -0,0 +1,173 @@
+from fastapi import HTTPException
+import json
+from langchain_chroma import Chroma
+import os
+from pathlib import Path
+import re
+from services.bm25_index import BM25_INDEX_DIRECTORY
+from services.chroma_db_service import CHROMA_DB_DIRECTORY, delete_documents
+from services.ingestion_manifest import MANIFEST_DIRECTORY, IngestionManifest
+from services.parent_store import PARENT_STORE_DIRECTORY
+import shutil
+import time
+from utils.logger import log
+
+SNAPSHOT_DIRECTORY = "./data/snapshots"
+
+# Letters, digits, dots, dashes and underscores, so a name can never point outside the snapshot directory
+SNAPSHOT_NAME = re.compile(r"^[A-Za-z0-9][A-Za-z0-9._-]{0,63}$")
+
+# Everything that makes up the stored documents, by the name it is kept under in a snapshot.
+# The embedding cache is left out, it only saves work and fills up again by itself
+STORE_PATHS = {
+    "chroma_langchain_db": CHROMA_DB_DIRECTORY,
+    "ingestion_manifests": MANIFEST_DIRECTORY,
+    "bm25_index": BM25_INDEX_DIRECTORY,
+    "parent_store": PARENT_STORE_DIRECTORY,
+}
+
+def check_vector_store(chroma_db: Chroma, ingestion_manifest: IngestionManifest) -> dict:
+    """
+    Checks that a chroma DB collection and its ingestion manifest agree, run when the collection is first opened. \n
+    A document with chunks missing from the collection, such as one a crash stopped part way through, is forgotten so it
+    is ingested again in full. Chunks that no complete document owns are deleted, unless the manifest is empty,
+    in which case nothing is known about them and they are left alone.
+
+    Returns
+    -------
+    A dictionary with the number of stored chunks, documents, forgotten documents and deleted chunks.
+    """
+    start = time.perf_counter()
+    collection = chroma_db._collection
+
+    stored_ids = set()
+    page_size = collection._client.get_max_batch_size()
+    for offset in range(0, collection.count(), page_size):
+        stored_ids.update(collection.get(include=[], limit=page_size, offset=offset)["ids"])
+
+    documents = ingestion_manifest.get_all_chunk_ids()
+    incomplete_documents = [document_key for document_key, chunk_ids in documents.items() if not chunk_ids <= stored_ids]
+    if incomplete_documents:
+        log.warning(f"{len(incomplete_documents)} documents in collection {collection.name} are missing chunks, they will be ingested again in full")
+        ingestion_manifest.forget(incomplete_documents)
+
+    orphaned_ids = []
+    if documents:
+        owned_ids = set().union(*(chunk_ids for document_key, chunk_ids in documents.items()
+                                  if document_key not in incomplete_documents))
+        orphaned_ids = list(stored_ids - owned_ids)
+        if orphaned_ids:
+            log.warning(f"Deleting {len(orphaned_ids)} chunks that no ingested document owns")
+            delete_documents(orphaned_ids, chroma_db)
+    elif stored_ids:
+        log.warning(f"The ingestion manifest is empty but collection {collection.name} holds {len(stored_ids)} chunks, leaving them as they are")
+
+    report = {
+        "chunks": len(stored_ids) - len(orphaned_ids),
+        "documents": len(documents) - len(incomplete_documents),
+        "forgotten_documents": len(incomplete_documents),
+        "deleted_chunks": len(orphaned_ids),
+    }
+    log.info(f"Collection {collection.name} checked in {time.perf_counter() - start:.4f} seconds: {report}")
+    return report
+
+def create_snapshot(name: str | None = None) -> dict:
+    """
+    Copies chroma DB, the ingestion manifests, the BM25 indexes and the parent stores into SNAPSHOT_DIRECTORY/name,
+    named after the current time if no name is given. chroma DB must be disconnected while it runs. \n
+    The copy is made under a temporary name first, so a failed snapshot never looks like a complete one.
+
+    Returns
+    -------
+    The snapshot's name, creation time and size in bytes.
+    """
+    name = name or time.strftime("%Y%m%d-%H%M%S")
+    snapshot_path = get_snapshot_path(name)
+    if snapshot_path.exists():
+        raise HTTPException(status_code=409, detail=f"Snapshot {name} already exists")
+
+    start = time.perf_counter()
+    temporary_path = snapshot_path.with_name(f".{name}.tmp")
+    shutil.rmtree(temporary_path, ignore_errors=True)
+    temporary_path.mkdir(parents=True)
+    for store_name, store_path in STORE_PATHS.items():
+        copy_path(Path(store_path), temporary_path / store_name)
+
+    snapshot = {"name": name, "created_at": time.time(), "size_bytes": get_size(temporary_path)}
+    with open(temporary_path / "snapshot.json", "w", encoding="utf-8") as snapshot_file:
+        json.dump(snapshot, snapshot_file)
+    os.replace(temporary_path, snapshot_path)
+
+    log.info(f"Snapshot {name} of {snapshot['size_bytes']} bytes created, took {time.perf_counter() - start:.4f} seconds")
+    return snapshot
+
+def restore_snapshot(name: str) -> dict:
+    """
+    Replaces chroma DB, the ingestion manifests, the BM25 indexes and the parent stores with the ones in the snapshot.
+    chroma DB must be disconnected while it runs. \n
+    Every store is copied next to the one it replaces before they are swapped, so a failed copy leaves the current ones in place.
+
+    Returns
+    -------
+    The snapshot's name, creation time and size in bytes.
+    """
+    snapshot_path = get_snapshot_path(name)
+    if not (snapshot_path / "snapshot.json").exists():
+        raise HTTPException(status_code=404, detail=f"Snapshot {name} not found")
+
+    start = time.perf_counter()
+    staged_paths = []
+    try:
+        for store_name, store_path in STORE_PATHS.items():
+            staged_path = Path(f"{store_path}.restore")
+            remove_path(staged_path)
+            copy_path(snapshot_path / store_name, staged_path)
+            staged_paths.append((staged_path, Path(store_path)))
+    except Exception:
+        for staged_path, _ in staged_paths:
+            remove_path(staged_path)
+        raise
+
+    for staged_path, store_path in staged_paths:
+        remove_path(store_path)
+        if staged_path.exists():
+            os.replace(staged_path, store_path)
+
+    with open(snapshot_path / "snapshot.json", "r", encoding="utf-8") as snapshot_file:
+        snapshot = json.load(snapshot_file)
+    log.info(f"Snapshot {name} restored, took {time.perf_counter() - start:.4f} seconds")
+    return snapshot
+
+def list_snapshots() -> list:
+    """
+    Returns the name, creation time and size in bytes of every snapshot, the newest first.
+    """
+    snapshots = []
+    for snapshot_file in Path(SNAPSHOT_DIRECTORY).glob("*/snapshot.json"):
+        with open(snapshot_file, "r", encoding="utf-8") as file:
+            snapshots.append(json.load(file))
+    return sorted(snapshots, key=lambda snapshot: snapshot["created_at"], reverse=True)
+
+def get_snapshot_path(name: str) -> Path:
+    if not SNAPSHOT_NAME.match(name):
+        raise HTTPException(status_code=400, detail="Snapshot names may only use letters, digits, '.', '-' and '_'")
+    return Path(SNAPSHOT_DIRECTORY) / name
+
+def copy_path(source: Path, target: Path) -> None:
+    """
+    Copies a file or directory, nothing is copied if the source does not exist.
+    """
+    if source.is_dir():
+        shutil.copytree(source, target)
+    elif source.exists():
+        target.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copy2(source, target)
+
+def remove_path(path: Path) -> None:
+    if path.is_dir():
+        shutil.rmtree(path)
+    elif path.exists():
+        path.unlink()
+
+def get_size(path: Path) -> int:
+    return sum(file.stat().st_size for file in path.rglob("*") if file.is_file())
@@ -1,3 +1,4 @@
+from contextvars import ContextVar
 import logging
 import logging.handlers
 import os
@@ -11,15 +12,24 @@ log_dir = get_envvar("LOG_DIR")
 if not os.path.exists(log_dir):
     os.mkdir(log_dir)
 
+# ID of the request being handled, set by the correlation ID middleware and carried into the jobs it submits
+correlation_id = ContextVar("correlation_id", default=None)
+
 log = logging.getLogger(get_envvar("LOG_NAME"))
 log.propagate = False
 log.setLevel(get_envvar("LOG_LEVEL"))
 
 msg_formatter = logging.Formatter(
-    fmt="%(asctime)s|%(levelname)s|%(message)s", datefmt=LOG_DATE_FMT
+    fmt="%(asctime)s|%(levelname)s|%(correlation_id)s|%(message)s", datefmt=LOG_DATE_FMT
 )
 
 
+class CorrelationIdFilter(logging.Filter):
+    def filter(self, record):
+        record.correlation_id = correlation_id.get() or "-"
+        return True
+
+
 def create_time_rotating_file_handler(log_level, filename, formatter):
     handler = logging.handlers.TimedRotatingFileHandler(
         f"{log_dir}/{filename}.log", when="midnight", backupCount=30
@@ -54,3 +64,6 @@ log.addHandler(print_handler)
 log.addHandler(debug_handler)
 log.addHandler(error_handler)
 log.addHandler(info_handler)
+
+# Stamps every record with the correlation ID the formatter expects
+log.addFilter(CorrelationIdFilter())
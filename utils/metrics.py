@@ -0,0 +1,202 @@
+import functools
+import inspect
+import threading
+import time
+from typing import Callable
+from utils.logger import log
+from utils.utils import get_envvar
+
+ENV_METRICS_ENABLED = "METRICS_ENABLED"
+
+# When off, observations return straight away and the stage decorators hand back the undecorated function
+METRICS_ENABLED = get_envvar(ENV_METRICS_ENABLED, "true").lower() == "true"
+
+# Upper bounds in seconds, from a single page being cleaned up to a long generation
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+class Histogram:
+    """
+    Prometheus style histogram, counting observations into cumulative buckets per combination of label values.
+    """
+
+    def __init__(self, name: str, description: str, label_names: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+        METRICS.append(self)
+
+    def observe(self, value: float, *label_values: str) -> None:
+        """
+        Records a value, the label values are given in the order of label_names.
+        """
+        if not METRICS_ENABLED:
+            return
+
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            bucket_counts = series[0]
+            for index, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    bucket_counts[index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for label_values, (bucket_counts, total, count) in sorted(self._series.items()):
+                labels = format_labels(self.label_names, label_values)
+                for upper_bound, bucket_count in zip(self.buckets, bucket_counts):
+                    lines.append(f"{self.name}_bucket{format_labels(self.label_names + ('le',), label_values + (upper_bound,))} {bucket_count}")
+                lines.append(f"{self.name}_bucket{format_labels(self.label_names + ('le',), label_values + ('+Inf',))} {count}")
+                lines.append(f"{self.name}_sum{labels} {total}")
+                lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+class Counter:
+    """
+    Prometheus style counter per combination of label values.
+    """
+
+    def __init__(self, name: str, description: str, label_names: tuple = ()):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self._series = {}
+        self._lock = threading.Lock()
+        METRICS.append(self)
+
+    def inc(self, *label_values: str) -> None:
+        if not METRICS_ENABLED:
+            return
+
+        with self._lock:
+            self._series[label_values] = self._series.get(label_values, 0) + 1
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for label_values, count in sorted(self._series.items()):
+                lines.append(f"{self.name}{format_labels(self.label_names, label_values)} {count}")
+        return lines
+
+class Gauge:
+    """
+    Prometheus style gauge, holding the last value set per combination of label values.
+    """
+
+    def __init__(self, name: str, description: str, label_names: tuple = ()):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self._series = {}
+        self._lock = threading.Lock()
+        METRICS.append(self)
+
+    def set(self, value: float, *label_values: str) -> None:
+        if not METRICS_ENABLED:
+            return
+
+        with self._lock:
+            self._series[label_values] = value
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} gauge"]
+        with self._lock:
+            for label_values, value in sorted(self._series.items()):
+                lines.append(f"{self.name}{format_labels(self.label_names, label_values)} {value}")
+        return lines
+
+# Every metric, in the order they are rendered
+METRICS = []
+
+STAGE_SECONDS = Histogram(
+    "rag_stage_seconds",
+    "Seconds spent in one run of a pipeline stage, a page for clean, a document for chunk, a batch for embed and store, a request for the query stages",
+    ("stage",),
+)
+STAGE_TIMEOUTS = Counter("rag_stage_timeouts_total", "Pipeline stages that ran out of time", ("stage",))
+INGEST_STAGE_SECONDS = Histogram(
+    "rag_ingest_stage_seconds", "Seconds an ingestion job spent in each stage, parse, chunk, embed, store and total", ("stage",),
+)
+FIRST_TOKEN_SECONDS = Histogram("rag_first_token_seconds", "Seconds from a streamed answer being asked for to its first token")
+REQUEST_SECONDS = Histogram("http_request_seconds", "Seconds to handle an HTTP request", ("method", "route", "status"))
+EMBEDDING_LOAD_SECONDS = Gauge("rag_embedding_model_load_seconds", "Seconds it took to load the embedding model", ("model", "backend"))
+EMBEDDING_WARM_UP_SECONDS = Gauge(
+    "rag_embedding_warm_up_seconds", "Seconds the embedding model took to load and embed its first text when the server started",
+)
+
+class StageTimer:
+    """
+    Context manager that times a pipeline stage into STAGE_SECONDS. \n
+    The elapsed time is kept in seconds for callers that also log it, it is measured even when metrics are disabled.
+    """
+    __slots__ = ("stage", "start", "seconds")
+
+    def __init__(self, stage: str):
+        self.stage = stage
+        self.seconds = 0.0
+
+    def __enter__(self) -> "StageTimer":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.seconds = time.perf_counter() - self.start
+        if METRICS_ENABLED:
+            STAGE_SECONDS.observe(self.seconds, self.stage)
+            log.debug(f"Stage {self.stage} took {self.seconds:.4f} seconds")
+
+def time_stage(stage: str) -> StageTimer:
+    """
+    Times the block as one run of the stage.
+    """
+    return StageTimer(stage)
+
+def timed_stage(stage: str) -> Callable:
+    """
+    Decorator that times every call of a function or coroutine function as one run of the stage.
+    """
+    def decorator(function: Callable) -> Callable:
+        if not METRICS_ENABLED:
+            return function
+
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                with StageTimer(stage):
+                    return await function(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with StageTimer(stage):
+                return function(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+def format_labels(label_names: tuple, label_values: tuple) -> str:
+    """
+    Formats the labels of a sample as {name="value",...}, or nothing if it has none.
+    """
+    if not label_names:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label_value(value)}"' for name, value in zip(label_names, label_values)) + "}"
+
+def escape_label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def render_metrics() -> str:
+    """
+    Renders every metric in the Prometheus text exposition format.
+    """
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"